@@ -1,6 +1,12 @@
+import click
+import json
+import os
+import time
+import unittest
 from flask.cli import FlaskGroup
+from prometheus_client import start_http_server
 import redis
-from rq import Connection, Worker
+from rq import Connection
 
 from project.server import create_app
 from werkzeug.serving import WSGIRequestHandler
@@ -19,13 +25,108 @@ def test():
     return 1
 
 
+@cli.command("compare_parsers")
+@click.argument("paths", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def compare_parsers(paths):
+    """Parses MARCXML notices with every parser backend and reports differences."""
+    from project.server.main.parser import PARSER_BACKENDS, filter_notice, get_notice_from_xml, parse
+    timings = {backend: 0 for backend in PARSER_BACKENDS}
+    nb_diff = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            notice_xml = f.read()
+        sudoc_id = path.split("/")[-1].split(".")[0]
+        results = {}
+        for backend in PARSER_BACKENDS:
+            start = time.perf_counter()
+            notice = get_notice_from_xml(notice_xml, backend=backend)
+            results[backend] = (filter_notice(notice), parse(sudoc_id, notice))
+            timings[backend] += time.perf_counter() - start
+        if any(r != results[PARSER_BACKENDS[0]] for r in results.values()):
+            nb_diff += 1
+            click.echo(f"{path} differs: {json.dumps(results, ensure_ascii=False)}")
+    click.echo(f"{nb_diff} / {len(paths)} notices differ")
+    for backend, duration in timings.items():
+        click.echo(f"{backend}: {1000 * duration / max(len(paths), 1):.3f} ms per notice")
+
+
+@cli.command("harvest_dump")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=1000, show_default=True, help="Number of records written at once.")
+def harvest_dump(path, batch_size):
+    """Ingests a (possibly gzipped) MARCXML collection file."""
+    from project.server.main.tasks import create_task_harvest_dump
+    stats = create_task_harvest_dump(path, batch_size=batch_size)
+    click.echo(json.dumps(stats))
+
+
+@cli.command("migrate_indexes")
+@click.option("--collection", "name", default="sudoc", show_default=True)
+def migrate_indexes(name):
+    """Removes duplicated notices and makes the sudoc_id index unique, once, on collections from older harvests."""
+    from project.server.main.utils_mongo import get_client, MONGO_DB, migrate_indexes
+    migrate_indexes(get_client()[MONGO_DB][name])
+    click.echo(f"sudoc_id index of {name} is unique")
+
+
+@cli.command("build_storage_manifest")
+@click.option("--container", default="sudoc", show_default=True)
+@click.option("--prefix", "prefixes", multiple=True, default=["raw/", "parsed/"], show_default=True)
+def build_storage_manifest(container, prefixes):
+    """Lists the object storage to know which raw and parsed objects exist without asking it."""
+    from project.server.main.storage_manifest import build_manifest
+    from project.server.main.utils_swift import iter_listing_pages
+    for prefix in prefixes:
+        stats = build_manifest(container, prefix, iter_listing_pages(container, prefix))
+        click.echo(json.dumps(stats))
+
+
+@cli.command("reparse")
+@click.option("--sudoc-id", "sudoc_ids", multiple=True, help="Only this notice, may be repeated.")
+@click.option("--sudoc-ids-path", help="Object storage file of sudoc ids, as returned by harvest_notices/upload.")
+@click.option("--dry-run", is_flag=True, help="Only report what changed, write nothing.")
+def reparse(sudoc_ids, sudoc_ids_path, dry_run):
+    """Parses again the raw notices of the object storage, e.g. after a parser change, and writes what changed."""
+    from project.server.main.reparse import create_task_reparse
+    stats = create_task_reparse(list(sudoc_ids), sudoc_ids_path, dry_run=dry_run)
+    click.echo(json.dumps(stats, indent=2))
+
+
+@cli.command("bench")
+@click.option("--notices", default=1000, show_default=True, help="Number of synthetic notices.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--harvest/--no-harvest", default=True, help="Also run the end-to-end harvest benchmark.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the JSON results to this file.")
+def bench(notices, seed, harvest, output):
+    """Benchmarks the parser and the harvest pipeline against local stubs."""
+    from project.benchmarks.bench import run_benchmarks
+    results = json.dumps(run_benchmarks(notices, seed=seed, harvest=harvest), indent=2, default=str)
+    if output:
+        with open(output, "w") as f:
+            f.write(results)
+    click.echo(results)
+
+
 @cli.command("run_worker")
-def run_worker():
+@click.option("--persistent/--fork", default=False, show_default=True,
+              help="Run the jobs in the worker process, reusing its clients, instead of a forked process per job.")
+@click.option("--max-jobs", type=int, help="Stop after this many jobs, e.g. for a persistent worker to be restarted.")
+def run_worker(persistent, max_jobs):
+    from project.server.main.metrics import METRICS_PORT, MULTIPROC_DIR, get_registry
+    from project.server.main.worker import ForkingWorker, PersistentWorker, preload
+    if METRICS_PORT:
+        if MULTIPROC_DIR:
+            # files left by a previous worker would be merged with the new metrics
+            os.makedirs(MULTIPROC_DIR, exist_ok=True)
+            for filename in os.listdir(MULTIPROC_DIR):
+                os.remove(os.path.join(MULTIPROC_DIR, filename))
+        start_http_server(METRICS_PORT, registry=get_registry())
     redis_url = app.config["REDIS_URL"]
     redis_connection = redis.from_url(redis_url)
+    preload(connect=persistent)
     with Connection(redis_connection):
-        worker = Worker(app.config["QUEUES"])
-        worker.work()
+        worker = (PersistentWorker if persistent else ForkingWorker)(app.config["QUEUES"])
+        worker.work(max_jobs=max_jobs)
 
 
 if __name__ == "__main__":
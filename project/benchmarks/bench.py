@@ -0,0 +1,118 @@
+import functools
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from unittest import mock
+
+from project.benchmarks.generator import generate_corpus
+from project.benchmarks.stubs import MemoryCollection, SudocHandler, SwiftHandler, get_url, start_server
+from project.server.main import fetcher, parser, rate_limiter, storage_manifest, tasks, utils_swift
+from project.server.main.raw_cache import RawCache
+
+SET_FUNCTIONS = ['set_doi', 'set_genre', 'set_publication_date', 'set_title', 'set_publisher', 'set_authors',
+                 'set_id_external', 'set_thematics', 'set_summary', 'set_source']
+
+
+def summarize(durations: list) -> dict:
+    # timings in microseconds
+    durations = sorted(durations)
+    if not durations:
+        return {}
+    return {
+        'count': len(durations),
+        'mean_us': 1e6 * statistics.mean(durations),
+        'p50_us': 1e6 * durations[len(durations) // 2],
+        'p95_us': 1e6 * durations[int(len(durations) * 0.95)],
+        'total_s': sum(durations)
+    }
+
+
+def timed(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_parser_benchmark(corpus: list, backends: list = None) -> dict:
+    results = {}
+    for backend in backends or parser.PARSER_BACKENDS:
+        durations = {name: [] for name in ['index', 'filter_notice', 'parse'] + SET_FUNCTIONS}
+        nb_filtered = 0
+        for sudoc_id, notice_xml in corpus:
+            notice, duration = timed(parser.get_notice_from_xml, notice_xml, backend)
+            durations['index'].append(duration)
+            filtered, duration = timed(parser.filter_notice, notice)
+            durations['filter_notice'].append(duration)
+            if filtered:
+                nb_filtered += 1
+                continue
+            _, duration = timed(parser.parse, sudoc_id, notice)
+            durations['parse'].append(duration)
+            notice_json = {'sudoc_id': sudoc_id}
+            for name in SET_FUNCTIONS:
+                args = (notice_json, notice, sudoc_id) if name in ['set_doi', 'set_id_external'] else \
+                    (notice_json, notice)
+                notice_json, duration = timed(getattr(parser, name), *args)
+                durations[name].append(duration)
+        total = sum(durations['index']) + sum(durations['filter_notice']) + sum(durations['parse'])
+        # the path taken by the harvest, where the lxml backend rejects notices while scanning the raw XML
+        outcomes = {rule: [] for rule in parser.FILTER_RULES + ['kept']}
+        for sudoc_id, notice_xml in corpus:
+            (reason, _), duration = timed(parser.filter_and_parse_notice, sudoc_id, notice_xml, backend)
+            outcomes[reason or 'kept'].append(duration)
+        total_harvest = sum(sum(values) for values in outcomes.values())
+        results[backend] = {
+            'notices': len(corpus),
+            'filtered': nb_filtered,
+            'notices_per_second': len(corpus) / total if total else 0,
+            'filter_and_parse_notices_per_second': len(corpus) / total_harvest if total_harvest else 0,
+            'timings': {name: summarize(values) for name, values in durations.items()},
+            'filter_and_parse_timings': {outcome: summarize(values) for outcome, values in outcomes.items()}
+        }
+    return results
+
+
+def run_harvest_benchmark(corpus: list) -> dict:
+    # create_task_harvest_notices against local sudoc.fr and Swift stubs and an in-memory collection
+    # the shared rate limiter is off, the stubs never throttle
+    sudoc = start_server(SudocHandler, notices=dict(corpus))
+    swift = start_server(SwiftHandler, objects={})
+    collection = MemoryCollection()
+    sudoc_ids = [sudoc_id for sudoc_id, _ in corpus]
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            mock.patch.object(fetcher, 'SUDOC_URL', get_url(sudoc)), \
+            mock.patch.dict(utils_swift.auth, {'url': f'{get_url(swift)}/v1/AUTH_bench', 'token': 'bench'}), \
+            mock.patch.object(utils_swift, 'local', utils_swift.threading.local()), \
+            mock.patch.object(tasks, 'get_collection', return_value=collection), \
+            mock.patch.object(rate_limiter, 'RATE_LIMIT_ENABLED', False), \
+            mock.patch.object(storage_manifest, 'STORAGE_MANIFEST_ENABLED', False), \
+            mock.patch.object(tasks, 'RawCache', functools.partial(RawCache, directory=cache_dir)):
+        for run, kwargs in [('first_harvest', {}), ('reparse', {}), ('force_download', {'force_download': True})]:
+            start = time.perf_counter()
+            stats = tasks.create_task_harvest_notices(sudoc_ids, **kwargs)
+            duration = time.perf_counter() - start
+            results[run] = {'seconds': duration, 'notices_per_second': len(sudoc_ids) / duration, 'stats': stats}
+    sudoc.shutdown()
+    swift.shutdown()
+    return results
+
+
+def run_benchmarks(nb_notices: int = 1000, seed: int = 0, harvest: bool = True) -> dict:
+    logging.disable(logging.CRITICAL)
+    try:
+        corpus = generate_corpus(nb_notices, seed=seed)
+        results = {
+            'environment': {'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+                            'nb_notices': nb_notices, 'seed': seed},
+            'parser': run_parser_benchmark(corpus)
+        }
+        if harvest:
+            results['harvest'] = run_harvest_benchmark(corpus)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
@@ -0,0 +1,92 @@
+import random
+
+from xml.sax.saxutils import escape
+
+from project.server.main.utils import get_ppn_check_digit
+
+REJECT_RULES = ['008', '029', '205', '11x']
+FIRST_NAMES = ['Jean', 'Marie', 'Pierre', 'Anne', 'Louis', 'Claire', 'Paul', 'Sophie', 'Élise', 'François']
+LAST_NAMES = ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy', 'Moreau']
+WORDS = ['histoire', 'société', 'économie', 'droit', 'politique', 'sciences', 'culture', 'europe', 'france',
+         'méthodes', 'analyse', 'théorie', 'pratiques', 'réseaux', 'territoires', 'langues']
+
+
+def get_ppn(number: int) -> str:
+    base = f'{number:08d}'
+    return base + get_ppn_check_digit(base)
+
+
+def get_words(rng: random.Random, nb_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(nb_words))
+
+
+def get_datafield(tag: str, subfields: list, ind1: str = ' ', ind2: str = ' ') -> str:
+    content = ''.join(f'<subfield code="{code}">{escape(value)}</subfield>' for code, value in subfields)
+    return f'<datafield tag="{tag}" ind1="{ind1}" ind2="{ind2}">{content}</datafield>'
+
+
+def generate_notice(sudoc_id: str, rng: random.Random, nb_authors: int = 2, nb_thematics: int = 3,
+                    nb_ids: int = 2, reject: str = None) -> bytes:
+    # a UNIMARC bibliographic record as served by sudoc.fr, reject forces one of the filter rules
+    genre = rng.choice(['B', 'G', 'K']) if reject == '008' else 'A'
+    year = rng.randint(1950, 2024)
+    fields = [
+        '<leader>     cam0 22        450 </leader>',
+        f'<controlfield tag="001">{sudoc_id}</controlfield>',
+        f'<controlfield tag="008">{genre}ax3</controlfield>',
+        get_datafield('010', [('a', f'978-2-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}-{rng.randint(0, 9)}'),
+                              ('b', 'br.')]),
+    ]
+    if rng.random() < 0.3:
+        fields.append(get_datafield('017', [('a', f'10.{rng.randint(1000, 9999)}/{rng.randint(0, 10 ** 6)}'),
+                                            ('2', 'DOI')], '7', '0'))
+    if reject == '029':
+        fields.append(get_datafield('029', [('a', 'FR'), ('b', f'{year}PA01{rng.randint(1000, 9999)}')]))
+    for _ in range(nb_ids):
+        if rng.random() < 0.5:
+            fields.append(get_datafield('035', [('a', f'(OCoLC){rng.randint(10 ** 6, 10 ** 9)}')]))
+        else:
+            fields.append(get_datafield('035', [('a', f'sibil{rng.randint(10 ** 6, 10 ** 9)}')]))
+    fields.append(get_datafield('100', [('a', f'{year}0101d{year}    m  y0frey50      ba')]))
+    fields.append(get_datafield('101', [('a', 'fre')], '0'))
+    if reject == '11x':
+        fields.append(get_datafield(rng.choice(['110', '115', '121', '124']), [('a', 'a')]))
+    fields.append(get_datafield('200', [('a', get_words(rng, rng.randint(2, 8)).capitalize()),
+                                        ('e', get_words(rng, rng.randint(2, 6))),
+                                        ('f', f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}')], '1'))
+    if reject == '205':
+        fields.append(get_datafield('205', [('a', rng.choice(['2e éd.', '3e ed. revue', 'Nouvelle édition']))]))
+    fields.append(get_datafield('210', [('a', 'Paris'), ('c', rng.choice(['Gallimard', 'Seuil', 'PUF'])),
+                                        ('d', str(year))]))
+    fields.append(get_datafield('214', [('a', 'Paris'), ('c', rng.choice(['Gallimard', 'Seuil', 'PUF']))], ' ', '0'))
+    fields.append(get_datafield('215', [('a', f'{rng.randint(50, 900)} p.'), ('d', '24 cm')]))
+    if rng.random() < 0.6:
+        fields.append(get_datafield('330', [('a', get_words(rng, rng.randint(30, 120)))]))
+    if rng.random() < 0.2:
+        fields.append(get_datafield('461', [('t', get_words(rng, 3)), ('x', f'{rng.randint(1000, 9999)}-'
+                                                                             f'{rng.randint(1000, 9999)}')], ' ', '0'))
+    for _ in range(nb_thematics):
+        fields.append(get_datafield('606', [('3', get_ppn(rng.randint(0, 10 ** 8 - 1))),
+                                            ('a', get_words(rng, 2)), ('2', 'rameau')], ' ', ' '))
+    for i in range(nb_authors):
+        tag = '700' if i == 0 else rng.choice(['701', '702'])
+        fields.append(get_datafield(tag, [('3', get_ppn(rng.randint(0, 10 ** 8 - 1))),
+                                          ('a', rng.choice(LAST_NAMES)), ('b', rng.choice(FIRST_NAMES)),
+                                          ('4', '070')], ' ', '1'))
+    content = ''.join(fields)
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<record>{content}</record>'.encode('utf-8')
+
+
+def generate_corpus(nb_notices: int, seed: int = 0, reject_ratio: float = 0.3) -> list:
+    # list of (sudoc_id, notice_xml), with author, thematic and id counts spread like real notices
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(nb_notices):
+        sudoc_id = get_ppn(rng.randint(0, 10 ** 8 - 1))
+        reject = rng.choice(REJECT_RULES) if rng.random() < reject_ratio else None
+        corpus.append((sudoc_id, generate_notice(sudoc_id, rng,
+                                                 nb_authors=min(int(rng.expovariate(0.5)) + 1, 40),
+                                                 nb_thematics=rng.randint(0, 8),
+                                                 nb_ids=rng.randint(0, 4),
+                                                 reject=reject)))
+    return corpus
@@ -0,0 +1,119 @@
+import hashlib
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status: int, body: bytes = b'', headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+class SudocHandler(StubHandler):
+    # serves /{sudoc_id}.xml from server.notices
+    # when server.capacity is set, requests above that many per second are throttled with a 429
+    def is_throttled(self) -> bool:
+        capacity = getattr(self.server, 'capacity', None)
+        if not capacity:
+            return False
+        with self.server.lock:
+            now = time.monotonic()
+            self.server.requests = [t for t in getattr(self.server, 'requests', []) if t > now - 1]
+            if len(self.server.requests) >= capacity:
+                self.server.throttled = getattr(self.server, 'throttled', 0) + 1
+                return True
+            self.server.requests.append(now)
+            return False
+
+    def do_GET(self):
+        if self.is_throttled():
+            self.send(429, headers={'Retry-After': '1'})
+            return
+        sudoc_id = self.path.split('?')[0].strip('/').replace('.xml', '')
+        notice_xml = self.server.notices.get(sudoc_id)
+        if notice_xml is None:
+            self.send(404)
+        elif self.headers.get('If-None-Match') == hashlib.md5(notice_xml).hexdigest():
+            self.send(304)
+        else:
+            self.send(200, notice_xml, {'Content-Type': 'text/xml', 'ETag': hashlib.md5(notice_xml).hexdigest()})
+
+
+class SwiftHandler(StubHandler):
+    # a flat in-memory object store answering the Swift object API used by utils_swift
+    def get_key(self) -> str:
+        return self.path.split('?')[0]
+
+    def do_PUT(self):
+        body = self.read_body()
+        self.server.objects[self.get_key()] = body
+        self.send(201, headers={'ETag': hashlib.md5(body).hexdigest()})
+
+    def do_GET(self):
+        body = self.server.objects.get(self.get_key())
+        if body is None:
+            self.send(404)
+        else:
+            self.send(200, body, {'ETag': hashlib.md5(body).hexdigest()})
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        if self.server.objects.pop(self.get_key(), None) is None:
+            self.send(404)
+        else:
+            self.send(204)
+
+
+def start_server(handler, **attributes) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_url(server: ThreadingHTTPServer) -> str:
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+class MemoryCollection:
+    """Stand-in for the pymongo collection calls made by the harvest."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def find(self, query: dict, projection: dict = None):
+        sudoc_ids = query.get('sudoc_id', {}).get('$in', list(self.documents))
+        return [dict(self.documents[sudoc_id]) for sudoc_id in sudoc_ids if sudoc_id in self.documents]
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        for operation in operations:
+            document = operation._doc['$set']
+            self.documents.setdefault(document['sudoc_id'], {}).update(document)
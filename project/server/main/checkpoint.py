@@ -0,0 +1,57 @@
+import hashlib
+import os
+
+from bson import json_util
+
+from project.server.main.logger import get_logger
+from project.server.main.utils_redis import get_redis
+
+logger = get_logger(__name__)
+
+CHECKPOINT_TTL = int(os.getenv('CHECKPOINT_TTL', 7 * 24 * 3600))
+# stages recorded for each notice of a chunk in progress
+NOTICE_STAGES = ['raw', 'stored']
+
+
+def get_chunk_key(chunk: list) -> str:
+    # chunks are identified by their content, so that the same ids give the same chunks when a job is run again
+    return hashlib.sha1('\n'.join(chunk).encode('utf-8')).hexdigest()[:16]
+
+
+def get_chunks_key(run_id: str) -> str:
+    return f'checkpoint:{run_id}:chunks'
+
+
+def get_notices_key(run_id: str, chunk_key: str) -> str:
+    return f'checkpoint:{run_id}:{chunk_key}:notices'
+
+
+def get_completed_chunk(run_id: str, chunk_key: str) -> dict:
+    # what a chunk completed by a previous run of the job returned, None if the chunk is still to do
+    value = get_redis().hget(get_chunks_key(run_id), chunk_key)
+    return json_util.loads(value) if value is not None else None
+
+
+def complete_chunk(run_id: str, chunk_key: str, result: dict) -> None:
+    pipeline = get_redis().pipeline()
+    pipeline.hset(get_chunks_key(run_id), chunk_key, json_util.dumps(result))
+    pipeline.expire(get_chunks_key(run_id), CHECKPOINT_TTL)
+    pipeline.delete(get_notices_key(run_id, chunk_key))
+    pipeline.execute()
+
+
+def get_notice_stages(run_id: str, chunk_key: str) -> dict:
+    # sudoc_id -> (stage, state) of the notices of a chunk that a previous run left unfinished
+    values = get_redis().hgetall(get_notices_key(run_id, chunk_key))
+    notices = {}
+    for sudoc_id, value in values.items():
+        value = json_util.loads(value)
+        notices[sudoc_id.decode('utf-8')] = (value['stage'], value['state'])
+    return notices
+
+
+def set_notice_stage(run_id: str, chunk_key: str, sudoc_id: str, stage: str, state: dict) -> None:
+    pipeline = get_redis().pipeline(transaction=False)
+    pipeline.hset(get_notices_key(run_id, chunk_key), sudoc_id, json_util.dumps({'stage': stage, 'state': state}))
+    pipeline.expire(get_notices_key(run_id, chunk_key), CHECKPOINT_TTL)
+    pipeline.execute()
@@ -0,0 +1,97 @@
+import os
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from retry.api import retry_call
+
+from project.server.main.logger import get_logger
+from project.server.main.metrics import RetryLogger, timed
+from project.server.main.rate_limiter import acquire, report
+
+logger = get_logger(__name__)
+
+SUDOC_URL = os.getenv('SUDOC_URL', 'https://www.sudoc.fr')
+FETCH_MAX_CONCURRENCY = int(os.getenv('FETCH_MAX_CONCURRENCY', 10))
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 30))
+FETCH_TRIES = int(os.getenv('FETCH_TRIES', 5))
+FETCH_DELAY = float(os.getenv('FETCH_DELAY', 1))
+
+sessions = {}
+
+
+def get_session(max_concurrency: int = FETCH_MAX_CONCURRENCY) -> requests.Session:
+    # one keep-alive pool per concurrency level, reused by every chunk of the process
+    if max_concurrency not in sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        sessions[max_concurrency] = session
+    return sessions[max_concurrency]
+
+
+def reset_sessions() -> None:
+    for session in sessions.values():
+        session.close()
+    sessions.clear()
+
+
+def get_notice_url(sudoc_id: str) -> str:
+    return f'{SUDOC_URL}/{sudoc_id}.xml'
+
+
+def get(session: requests.Session, url: str, timeout: float = FETCH_TIMEOUT, tries: int = FETCH_TRIES,
+        delay: float = FETCH_DELAY, stage: str = 'notice_get', **kwargs) -> requests.Response:
+    host = urlparse(url).netloc
+
+    def _get():
+        # every worker shares the request rate allowed to the host, adapted to its answers
+        acquire(host)
+        with timed(stage):
+            try:
+                response = session.get(url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                report(host, healthy=False)
+                raise
+            # throttling and server errors are worth retrying, other statuses are final
+            if response.status_code == 429 or response.status_code >= 500:
+                report(host, healthy=False, retry_after=response.headers.get('Retry-After'))
+                response.raise_for_status()
+            report(host, healthy=True)
+        return response
+    return retry_call(_get, exceptions=requests.RequestException, tries=tries, delay=delay, backoff=2, jitter=(0, 1),
+                      logger=RetryLogger(stage))
+
+
+def fetch_notice(session: requests.Session, sudoc_id: str, **kwargs) -> requests.Response:
+    return get(session, get_notice_url(sudoc_id), **kwargs)
+
+
+def get_conditional_headers(state: dict) -> dict:
+    # validators previously returned by sudoc.fr for this notice
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+
+def fetch_notices(sudoc_ids: list, max_concurrency: int = FETCH_MAX_CONCURRENCY, states: dict = None, **kwargs):
+    # yield (sudoc_id, response) as soon as each download completes, response is None on failure
+    # when the known state of a notice is given, the request is conditional and may answer 304
+    session = get_session(max_concurrency)
+    states = states or {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {executor.submit(fetch_notice, session, sudoc_id,
+                                   headers=get_conditional_headers(states.get(sudoc_id, {})), **kwargs): sudoc_id
+                   for sudoc_id in sudoc_ids}
+        for future in as_completed(futures):
+            sudoc_id = futures[future]
+            try:
+                yield sudoc_id, future.result()
+            except requests.RequestException as error:
+                logger.error(f'Error while downloading notice {sudoc_id}: {error}')
+                yield sudoc_id, None
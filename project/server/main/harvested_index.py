@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+
+from project.server.main.logger import get_logger
+from project.server.main.metrics import observe, timed
+from project.server.main.ppn import PpnSet, is_valid_ppn
+
+logger = get_logger(__name__)
+
+# a job going through more sudoc ids than this loads every harvested PPN once instead of asking Mongo for each chunk
+# a harvest split in chunk jobs loads them once for all its chunks, past that many sudoc ids in total
+HARVESTED_INDEX_MIN_IDS = int(os.getenv('HARVESTED_INDEX_MIN_IDS', 50000))
+HARVESTED_INDEX_BATCH_SIZE = 10000
+KNOWN_STATE_PROJECTION = {'_id': 0, 'sudoc_id': 1, 'content_hash': 1, 'etag': 1, 'last_modified': 1, 'parsed_key': 1}
+
+
+def get_shared_key(run_id: str) -> str:
+    # a harvest resumed under the same id loads a new index
+    return f'harvested_index:{run_id}:{uuid.uuid4().hex}'
+
+
+def get_others_key(key: str) -> str:
+    return f'{key}:others'
+
+
+def get_bit_offset(ppn: str) -> int:
+    # Redis numbers the bits of a byte from the most significant one, a PpnSet from the least significant one
+    base = int(ppn[:8])
+    return (base >> 3) * 8 + 7 - (base & 7)
+
+
+def delete_shared(connection, key: str) -> None:
+    connection.delete(key, get_others_key(key))
+
+
+class HarvestedIndex:
+    """Sudoc ids already in Mongo, for one job.
+
+    Small jobs look their chunks up with $in. Past min_ids, every harvested PPN is loaded once in a PpnSet,
+    with a query covered by the sudoc_id index, and the job then only adds the notices it upserts.
+    The chunk jobs of a large harvest read the bits of their chunk in the index that their parent saved in Redis.
+    """
+
+    def __init__(self, collection, min_ids: int = HARVESTED_INDEX_MIN_IDS, connection=None, shared_key: str = None):
+        self.collection = collection
+        self.min_ids = min_ids
+        self.ppns = None
+        self.connection = connection
+        self.shared_key = shared_key
+        self.looked_up = 0
+        self.stats = {'loaded': 0, 'load_seconds': 0, 'queries': 0}
+
+    def load(self) -> None:
+        start = time.time()
+        self.ppns = PpnSet()
+        cursor = self.collection.find({}, {'_id': 0, 'sudoc_id': 1}, batch_size=HARVESTED_INDEX_BATCH_SIZE)
+        for notice in cursor.hint([('sudoc_id', 1)]):
+            self.ppns.add(notice['sudoc_id'])
+        duration = time.time() - start
+        self.stats.update({'loaded': len(self.ppns), 'load_seconds': round(duration, 3)})
+        observe('harvested_index_load', duration)
+        logger.debug(f'{len(self.ppns)} harvested sudoc ids loaded in {duration:.1f}s')
+
+    def save(self, connection, key: str, ttl: int) -> None:
+        # shared with the chunk jobs of the harvest through Redis, the bitmap as a string that they read bit by bit
+        pipeline = connection.pipeline()
+        pipeline.delete(key, get_others_key(key))
+        pipeline.set(key, bytes(self.ppns.bitmap), ex=ttl)
+        if self.ppns.others:
+            pipeline.sadd(get_others_key(key), *self.ppns.others)
+            pipeline.expire(get_others_key(key), ttl)
+        pipeline.execute()
+
+    @classmethod
+    def open_shared(cls, collection, connection, key: str):
+        # the index saved by the parent job, None when it expired
+        if not connection.exists(key):
+            return None
+        return cls(collection, connection=connection, shared_key=key)
+
+    def filter_shared(self, chunk: list) -> list:
+        # the sudoc ids of the chunk in the shared index, a bit read per id rather than the whole bitmap
+        pipeline = self.connection.pipeline(transaction=False)
+        for sudoc_id in chunk:
+            if is_valid_ppn(sudoc_id):
+                pipeline.getbit(self.shared_key, get_bit_offset(sudoc_id))
+            else:
+                pipeline.sismember(get_others_key(self.shared_key), sudoc_id)
+        with timed('harvested_index_read'):
+            found = pipeline.execute()
+        return [sudoc_id for sudoc_id, is_found in zip(chunk, found) if is_found]
+
+    def get_known_states(self, chunk: list, with_states: bool) -> dict:
+        # the Mongo states of the notices of the chunk already harvested, reduced to their id when not needed
+        if self.ppns is None and self.shared_key is None and self.looked_up + len(chunk) > self.min_ids:
+            self.load()
+        self.looked_up += len(chunk)
+        if self.ppns is not None:
+            chunk = [sudoc_id for sudoc_id in chunk if sudoc_id in self.ppns]
+        elif self.shared_key is not None:
+            chunk = self.filter_shared(chunk)
+        if self.ppns is not None or self.shared_key is not None:
+            if not with_states:
+                return {sudoc_id: {'sudoc_id': sudoc_id} for sudoc_id in chunk}
+        if not chunk:
+            return {}
+        self.stats['queries'] += 1
+        projection = KNOWN_STATE_PROJECTION if with_states else {'_id': 0, 'sudoc_id': 1}
+        with timed('mongo_read'):
+            return {k['sudoc_id']: k for k in self.collection.find({'sudoc_id': {'$in': chunk}}, projection)}
+
+    def update(self, sudoc_ids) -> None:
+        # the chunks of a harvest do not share sudoc ids, the shared index is left as the parent saved it
+        if self.ppns is not None:
+            for sudoc_id in sudoc_ids:
+                self.ppns.add(sudoc_id)
@@ -0,0 +1,135 @@
+import json
+import os
+import redis
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from project.server.main.fetcher import get, get_session
+from project.server.main.logger import get_logger
+from project.server.main.parser import parse_xml
+from project.server.main.utils_redis import get_redis
+
+logger = get_logger(__name__)
+
+IDREF_SPARQL_URL = os.getenv('IDREF_SPARQL_URL', 'https://www.idref.fr/Proxy?https://data.idref.fr/sparql')
+IDREF_CACHE_TTL = int(os.getenv('IDREF_CACHE_TTL', 7 * 24 * 3600))
+IDREF_BATCH_SIZE = int(os.getenv('IDREF_BATCH_SIZE', 20))
+IDREF_PAGE_SIZE = int(os.getenv('IDREF_PAGE_SIZE', 10000))
+IDREF_MAX_CONCURRENCY = int(os.getenv('IDREF_MAX_CONCURRENCY', 4))
+IDREF_TIMEOUT = float(os.getenv('IDREF_TIMEOUT', 120))
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+SPARQL_RESULTS_NS = 'http://www.w3.org/2005/sparql-results#'
+
+
+def get_cache_key(idref: str) -> str:
+    return f'idref:{idref}:sudoc_ids'
+
+
+def get_query(idrefs: list, limit: int, offset: int) -> str:
+    values = ' '.join([f'<http://www.idref.fr/{idref}/id>' for idref in idrefs])
+    return f'''select distinct ?author ?doc
+where
+{{VALUES ?author {{ {values} }}
+?doc ?rel ?author.
+?doc a ?type ; dcterms:bibliographicCitation ?citation.
+FILTER(regex(?doc,'http://www.sudoc'))
+}}
+ORDER BY ?author ?doc
+LIMIT {limit} OFFSET {offset}'''
+
+
+def get_query_url(query: str) -> str:
+    params = {'default-graph-uri': '', 'query': query, 'format': 'application/rdf+xml', 'timeout': 0}
+    return f'{IDREF_SPARQL_URL}?{urlencode(params)}'
+
+
+def parse_solutions(xml: bytes) -> tuple:
+    # list of (idref, sudoc_id) read from a SPARQL result set serialized as RDF/XML, and the number of solutions,
+    # including those skipped, that the pagination is based on
+    rows = []
+    root = parse_xml(xml)
+    if root is None:
+        return rows, 0
+    nb_solutions = 0
+    for solution in root.iter(f'{{{SPARQL_RESULTS_NS}}}solution'):
+        nb_solutions += 1
+        row = {}
+        for binding in solution.iter(f'{{{SPARQL_RESULTS_NS}}}binding'):
+            variable = binding.findtext(f'{{{SPARQL_RESULTS_NS}}}variable')
+            value = binding.find(f'{{{SPARQL_RESULTS_NS}}}value')
+            if value is not None:
+                row[variable] = value.get(f'{{{RDF_NS}}}resource') or value.text
+        if 'sudoc.fr' in (row.get('doc') or '') and 'idref.fr' in (row.get('author') or ''):
+            try:
+                rows.append((row['author'].split('/')[3], row['doc'].split('/')[3]))
+            except IndexError:
+                logger.warning(f'Skipping malformed SPARQL resources {row["author"]} {row["doc"]}')
+    return rows, nb_solutions
+
+
+def query_sudoc_ids(idrefs: list) -> dict:
+    # a single batch of idrefs, paginated so that prolific authors are complete
+    sudoc_ids = {idref: [] for idref in idrefs}
+    session = get_session()
+    offset = 0
+    while True:
+        url = get_query_url(get_query(idrefs, IDREF_PAGE_SIZE, offset))
+        response = get(session, url, timeout=IDREF_TIMEOUT, stage='sparql')
+        response.raise_for_status()
+        rows, nb_solutions = parse_solutions(response.content)
+        for idref, sudoc_id in rows:
+            if idref in sudoc_ids:
+                sudoc_ids[idref].append(sudoc_id)
+        if nb_solutions < IDREF_PAGE_SIZE:
+            break
+        offset += IDREF_PAGE_SIZE
+    return {idref: sorted(set(ids)) for idref, ids in sudoc_ids.items()}
+
+
+def get_cached(idrefs: list) -> dict:
+    try:
+        values = get_redis().mget([get_cache_key(idref) for idref in idrefs])
+    except redis.RedisError as error:
+        logger.warning(f'idref cache unavailable: {error}')
+        return {}
+    return {idref: json.loads(value) for idref, value in zip(idrefs, values) if value is not None}
+
+
+def set_cached(sudoc_ids: dict) -> None:
+    try:
+        pipeline = get_redis().pipeline()
+        for idref, ids in sudoc_ids.items():
+            pipeline.setex(get_cache_key(idref), IDREF_CACHE_TTL, json.dumps(ids))
+        pipeline.execute()
+    except redis.RedisError as error:
+        logger.warning(f'idref cache unavailable: {error}')
+
+
+def resolve_idrefs(idrefs: list, use_cache: bool = True) -> dict:
+    # idref -> list of sudoc ids, raise when some idrefs could not be resolved
+    # the resolved batches are cached first, so that a retry of the job only queries the failed ones
+    idrefs = list(set(idrefs))
+    resolved = get_cached(idrefs) if use_cache else {}
+    missing = [idref for idref in idrefs if idref not in resolved]
+    logger.debug(f'{len(resolved)} idrefs resolved from cache, {len(missing)} to query')
+    batches = [missing[i:i + IDREF_BATCH_SIZE] for i in range(0, len(missing), IDREF_BATCH_SIZE)]
+
+    errors = []
+
+    def resolve_batch(batch):
+        try:
+            return query_sudoc_ids(batch)
+        except Exception as error:
+            logger.error(f'Error while resolving idrefs {batch}: {error}')
+            errors.append(error)
+            return {}
+
+    with ThreadPoolExecutor(max_workers=IDREF_MAX_CONCURRENCY) as executor:
+        for result in executor.map(resolve_batch, batches):
+            set_cached(result)
+            resolved.update(result)
+    unresolved = [idref for idref in idrefs if idref not in resolved]
+    if unresolved:
+        raise RuntimeError(f'{len(unresolved)} idrefs could not be resolved: {unresolved}') from errors[0]
+    return resolved
@@ -0,0 +1,128 @@
+import functools
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client import multiprocess
+
+from project.server.main.logger import get_logger
+
+logger = get_logger(__name__)
+
+# set in the worker so that the metrics of the forked job processes are merged
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+STAGE_DURATION = Histogram('harvest_stage_duration_seconds', 'Duration of each harvest stage call', ['stage'],
+                           buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+STAGE_ERRORS = Counter('harvest_stage_errors_total', 'Harvest stage calls that raised an error', ['stage'])
+STAGE_RETRIES = Counter('harvest_stage_retries_total', 'Harvest stage calls retried after an error', ['stage'])
+NOTICES_FILTERED = Counter('harvest_notices_filtered_total', 'Notices rejected before parsing, by filter rule', ['rule'])
+PARSE_CACHE = Counter('harvest_parse_cache_total', 'Lookups in the cache of the /parse endpoint', ['result'])
+RATE_LIMIT = Gauge('harvest_rate_limit', 'Requests per second allowed to each upstream host', ['host'],
+                   multiprocess_mode='max')
+
+# summary of the current job, written in the RQ job meta
+job_timings = {}
+job_timings_lock = threading.Lock()
+
+
+def observe(stage: str, duration: float) -> None:
+    STAGE_DURATION.labels(stage).observe(duration)
+    with job_timings_lock:
+        timing = job_timings.setdefault(stage, {'count': 0, 'seconds': 0, 'errors': 0, 'retries': 0})
+        timing['count'] += 1
+        timing['seconds'] += duration
+
+
+def count(stage: str, counter: str) -> None:
+    (STAGE_ERRORS if counter == 'errors' else STAGE_RETRIES).labels(stage).inc()
+    with job_timings_lock:
+        timing = job_timings.setdefault(stage, {'count': 0, 'seconds': 0, 'errors': 0, 'retries': 0})
+        timing[counter] += 1
+
+
+def count_filtered(rule: str) -> None:
+    NOTICES_FILTERED.labels(rule).inc()
+
+
+def count_parse_cache(result: str) -> None:
+    PARSE_CACHE.labels(result).inc()
+
+
+def set_rate_limit(host: str, rate: float) -> None:
+    RATE_LIMIT.labels(host).set(rate)
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count(stage, 'errors')
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def instrumented(stage: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RetryLogger:
+    """Logger given to the retry decorators, counting each retry of a stage."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def warning(self, msg, *args, **kwargs):
+        count(self.stage, 'retries')
+        logger.warning(f'[{self.stage}] {msg}', *args, **kwargs)
+
+
+def reset_job_timings() -> None:
+    with job_timings_lock:
+        job_timings.clear()
+
+
+def get_job_timings() -> dict:
+    with job_timings_lock:
+        return {stage: dict(timing) for stage, timing in job_timings.items()}
+
+
+def merge_timings(timings: list) -> dict:
+    merged = {}
+    for timing in timings:
+        for stage, values in (timing or {}).items():
+            merged_stage = merged.setdefault(stage, {'count': 0, 'seconds': 0, 'errors': 0, 'retries': 0})
+            for key in merged_stage:
+                merged_stage[key] += values.get(key, 0)
+    return merged
+
+
+def get_registry():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def mark_process_dead(pid: int) -> None:
+    # the live gauges of a job process that exited are removed from the merged metrics
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+def get_metrics() -> tuple:
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from project.server.main.fetcher import fetch_notices
+from project.server.main.logger import get_logger
+from project.server.main.metrics import count_parse_cache
+from project.server.main.parser import filter_and_parse_notice, get_notice_from_xml
+from project.server.main.utils import get_content_hash
+
+logger = get_logger(__name__)
+
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', 10000))
+PARSE_CACHE_TTL = float(os.getenv('PARSE_CACHE_TTL', 24 * 3600))
+# how long a sudoc id is trusted to still have the content last fetched, before asking sudoc.fr again
+PARSE_CACHE_ID_TTL = float(os.getenv('PARSE_CACHE_ID_TTL', 3600))
+PARSE_MAX_NOTICES = int(os.getenv('PARSE_MAX_NOTICES', 100))
+
+
+class ParseCache:
+    """Bounded LRU of parsing results keyed by (sudoc_id, content_hash), with the last hash seen for each sudoc_id."""
+
+    def __init__(self, max_size: int = PARSE_CACHE_SIZE, ttl: float = PARSE_CACHE_TTL,
+                 id_ttl: float = PARSE_CACHE_ID_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.id_ttl = id_ttl
+        self.results = OrderedDict()
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def get(self, sudoc_id: str, content_hash: str) -> dict:
+        key = (sudoc_id, content_hash)
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.results[key]
+                self.stats['expired'] += 1
+                entry = None
+            self.stats['hits' if entry else 'misses'] += 1
+            if entry is None:
+                count_parse_cache('miss')
+                return None
+            self.results.move_to_end(key)
+        count_parse_cache('hit')
+        return entry[1]
+
+    def put(self, sudoc_id: str, content_hash: str, result: dict) -> None:
+        with self.lock:
+            self.results[(sudoc_id, content_hash)] = (time.monotonic() + self.ttl, result)
+            self.results.move_to_end((sudoc_id, content_hash))
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def __contains__(self, key: tuple) -> bool:
+        with self.lock:
+            return key in self.results
+
+    def remember(self, sudoc_id: str, content_hash: str, validators: dict = None) -> None:
+        # the content last seen for a sudoc id, with the validators to ask sudoc.fr whether it changed
+        with self.lock:
+            self.ids[sudoc_id] = (time.monotonic() + self.id_ttl, content_hash, validators or {})
+            self.ids.move_to_end(sudoc_id)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def get_known(self, sudoc_id: str) -> tuple:
+        # (content_hash, validators, fresh), fresh while the content is trusted without asking sudoc.fr
+        with self.lock:
+            entry = self.ids.get(sudoc_id)
+        if entry is None:
+            return None, {}, False
+        expires_at, content_hash, validators = entry
+        return content_hash, validators, expires_at >= time.monotonic()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats, size=len(self.results), max_size=self.max_size)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+        return stats
+
+
+cache = ParseCache()
+
+
+def parse_content(sudoc_id: str, notice_xml: object, validators: dict = None) -> dict:
+    # a raw notice sent without its sudoc id is cached under its content only, the id is read from its 001
+    content_hash = get_content_hash(notice_xml if isinstance(notice_xml, bytes) else notice_xml.encode('utf-8'))
+    if sudoc_id is not None:
+        cache.remember(sudoc_id, content_hash, validators)
+    result = cache.get(sudoc_id, content_hash)
+    if result is not None:
+        return {**result, 'cached': True}
+    notice_id = sudoc_id or get_notice_from_xml(notice_xml)['controlfields'].get('001', '').strip()
+    reason, notice_json = filter_and_parse_notice(notice_id, notice_xml)
+    result = {'sudoc_id': notice_id, 'content_hash': content_hash, 'filtered': reason is not None,
+              'filter_reason': reason, 'notice': notice_json}
+    cache.put(sudoc_id, content_hash, result)
+    return {**result, 'cached': False}
+
+
+def get_response_result(sudoc_id: str, response) -> dict:
+    if response is None or response.status_code != 200:
+        status = response.status_code if response is not None else None
+        return {'sudoc_id': sudoc_id, 'error': f'notice could not be fetched (status {status})'}
+    validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    return parse_content(sudoc_id, response.content, validators)
+
+
+def parse_sudoc_ids(sudoc_ids: list, refresh: bool = False) -> list:
+    # results in the order of sudoc_ids, only the ids not seen recently are fetched from sudoc.fr
+    # a stale id is fetched with its validators, a 304 then serves the cached result
+    results, states = {}, {}
+    for sudoc_id in sudoc_ids:
+        content_hash, validators, fresh = cache.get_known(sudoc_id)
+        result = cache.get(sudoc_id, content_hash) if fresh and not refresh else None
+        if result is not None:
+            results[sudoc_id] = {**result, 'cached': True}
+        elif not refresh and (sudoc_id, content_hash) in cache:
+            states[sudoc_id] = validators
+        else:
+            states[sudoc_id] = {}
+    for sudoc_id, response in fetch_notices(list(states), states=states):
+        if response is not None and response.status_code == 304:
+            content_hash, validators, _ = cache.get_known(sudoc_id)
+            cache.remember(sudoc_id, content_hash, validators)
+            result = cache.get(sudoc_id, content_hash)
+            if result is not None:
+                results[sudoc_id] = {**result, 'cached': True}
+                continue
+            # evicted in the meantime
+            response = next(fetch_notices([sudoc_id]))[1]
+        results[sudoc_id] = get_response_result(sudoc_id, response)
+    return [results[sudoc_id] for sudoc_id in sudoc_ids]
+
+
+def parse_notices_xml(notices_xml: list) -> list:
+    return [parse_content(None, notice_xml) for notice_xml in notices_xml]
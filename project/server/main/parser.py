@@ -1,5 +1,9 @@
 import datetime
-import re
+import gzip
+import os
+
+from bs4 import BeautifulSoup
+from lxml import etree
 
 from project.server.main.logger import get_logger
 
@@ -7,59 +11,218 @@ logger = get_logger(__name__)
 
 #https://abes.fr/wp-content/uploads/2020/04/format-d-echange-des-donnees-bibliographiques.pdf
 
+PARSER_BACKENDS = ['lxml', 'bs4']
+PARSER_BACKEND = os.getenv('PARSER_BACKEND', 'lxml')
 
-def is_thesis(soup):
-    thesis_elt = soup.find('datafield', {'tag': '029'})
-    if thesis_elt:
-        thesis_sub_elt = thesis_elt.find('subfield', {'code': 'b'})
-        if thesis_sub_elt:
-            logger.debug(f'thesis {thesis_sub_elt}')
-            return True
+NOT_TEXT_DATAFIELDS = ['110', '115', '116', '117', '120', '121',
+                       '123', '124', '125', '126', '127', '128',
+                       '129']
+FIELD_TAGS = ['{*}controlfield', '{*}datafield']
+NOT_TEXT_GENRES = ['B', 'G', 'I', 'K', 'L', 'M', 'N', 'P', 'V', 'Z']
+FILTER_RULES = ['re_edition', 'not_text', 'thesis']
+# the fields each filter rule reads
+FILTER_RULE_TAGS = {'re_edition': ['205'], 'not_text': ['008'] + NOT_TEXT_DATAFIELDS, 'thesis': ['029']}
+FILTER_TAGS = {tag for tags in FILTER_RULE_TAGS.values() for tag in tags}
+
+
+def parse_xml(xml: object) -> object:
+    # bytes keep the encoding declared by the document, str is already decoded
+    if isinstance(xml, str):
+        parser = etree.XMLParser(recover=True, encoding='utf-8')
+        xml = xml.encode('utf-8')
+    else:
+        parser = etree.XMLParser(recover=True)
+    try:
+        return etree.fromstring(xml, parser)
+    except etree.XMLSyntaxError:
+        return None
+
+
+def index_soup(soup: object) -> dict:
+    notice = {'controlfields': {}, 'datafields': {}}
+    for rank, field in enumerate(soup.find_all(['controlfield', 'datafield'])):
+        tag = field.get('tag')
+        if field.name == 'controlfield':
+            notice['controlfields'].setdefault(tag, field.get_text())
+            continue
+        subfields = {}
+        for subfield in field.find_all('subfield'):
+            subfields.setdefault(subfield.get('code'), []).append(subfield.get_text())
+        notice['datafields'].setdefault(tag, []).append({'rank': rank, 'subfields': subfields})
+    return notice
+
+
+def index_field(notice: dict, rank: int, field: object) -> str:
+    tag = field.get('tag')
+    if etree.QName(field).localname == 'controlfield':
+        notice['controlfields'].setdefault(tag, ''.join(field.itertext()))
+        return tag
+    subfields = {}
+    for subfield in field.iter('{*}subfield'):
+        subfields.setdefault(subfield.get('code'), []).append(''.join(subfield.itertext()))
+    notice['datafields'].setdefault(tag, []).append({'rank': rank, 'subfields': subfields})
+    return tag
+
+
+def index_element(root: object) -> dict:
+    notice = {'controlfields': {}, 'datafields': {}}
+    if root is None:
+        return notice
+    for rank, field in enumerate(root.iter(*FIELD_TAGS)):
+        index_field(notice, rank, field)
+    return notice
+
+
+def iter_marcxml_records(path: str):
+    # stream a (possibly gzipped) MARCXML collection, one record element at a time
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    stream = gzip.open(path, 'rb') if is_gzip else open(path, 'rb')
+    with stream:
+        for _, record in etree.iterparse(stream, events=('end',), tag='{*}record', huge_tree=True):
+            yield record
+            # free the record and the already processed siblings to keep memory constant
+            record.clear()
+            while record.getprevious() is not None:
+                del record.getparent()[0]
+
+
+def get_notice_from_xml(notice_xml: object, backend: str = None) -> dict:
+    backend = backend or PARSER_BACKEND
+    if backend == 'lxml':
+        return index_element(parse_xml(notice_xml))
+    if backend == 'bs4':
+        return index_soup(BeautifulSoup(notice_xml, 'lxml'))
+    raise ValueError(f'Unknown parser backend {backend}, expected one of {PARSER_BACKENDS}')
+
+
+def get_notice(notice: object) -> dict:
+    # accept an already built index, an lxml element or a parsed soup
+    if isinstance(notice, dict):
+        return notice
+    if etree.iselement(notice):
+        return index_element(notice)
+    return index_soup(notice)
+
+
+def get_datafields(notice: dict, *tags: str) -> list:
+    if len(tags) == 1:
+        return notice['datafields'].get(tags[0], [])
+    datafields = [d for tag in tags for d in notice['datafields'].get(tag, [])]
+    return sorted(datafields, key=lambda d: d['rank'])
+
+
+def get_datafield(notice: dict, tag: str) -> dict:
+    datafields = notice['datafields'].get(tag)
+    return datafields[0] if datafields else None
+
+
+def get_subfields(datafield: dict, code: str) -> list:
+    return datafield['subfields'].get(code, []) if datafield else []
+
+
+def get_subfield(datafield: dict, code: str) -> str:
+    subfields = get_subfields(datafield, code)
+    return subfields[0] if subfields else None
+
+
+def is_thesis(notice: dict) -> bool:
+    thesis_sub_elt = get_subfield(get_datafield(notice, '029'), 'b')
+    if thesis_sub_elt is not None:
+        logger.debug(f'thesis {thesis_sub_elt}')
+        return True
     return False
 
-def is_not_text(soup):
+def is_not_text(notice: dict) -> bool:
 #https://documentation.abes.fr/sudoc/formats/unmb/DonneesCodees/Correspondance_008_UNM_USM.htm
-    genre_elt = soup.find('controlfield', {'tag': '008'})
-    if genre_elt:
-        genre = genre_elt.get_text()
-        if genre[0:1] in ['B', 'G', 'I', 'K', 'L', 'M', 'N', 'P', 'V', 'Z']:
+    genre = notice['controlfields'].get('008')
+    if genre is not None:
+        if genre[0:1] in NOT_TEXT_GENRES:
             logger.debug(f'controlfield 008 {genre}')
             return True
-    for f in ['110', '115', '116', '117', '120', '121',
-              '123', '124', '125', '126', '127', '128',
-              '129']:
-        if soup.find('datafield', {'tag': f}):
+    for f in NOT_TEXT_DATAFIELDS:
+        if f in notice['datafields']:
             logger.debug(f'datafield {f}')
             return True
     return False
 
-def is_re_edition(soup):
-    edition_elt = soup.find('datafield', {'tag': '205'})
-    if edition_elt and edition_elt.find('subfield', {'code': 'a'}):
-        edition_txt = edition_elt.find('subfield', {'code': 'a'}).get_text().lower()
-        if ('ed' in edition_txt) or ('éd' in edition_txt):
+def is_edition_text(edition_txt: str) -> bool:
+    edition_txt = edition_txt.lower()
+    return ('ed' in edition_txt) or ('éd' in edition_txt)
+
+def is_re_edition(notice: dict) -> bool:
+    edition_txt = get_subfield(get_datafield(notice, '205'), 'a')
+    if edition_txt is not None:
+        if is_edition_text(edition_txt):
             logger.debug(f're-edition: {edition_txt}')
             return True
     return False
 
-def filter_notice(soup):
-    if is_re_edition(soup):
-        return True
-    if is_not_text(soup):
-        return True
-    if is_thesis(soup):
-        return True
-    return False
+def get_filter_reason(notice: object) -> str:
+    # name of the first rule rejecting the notice, None when the notice is kept
+    notice = get_notice(notice)
+    if is_re_edition(notice):
+        return 're_edition'
+    if is_not_text(notice):
+        return 'not_text'
+    if is_thesis(notice):
+        return 'thesis'
+    return None
+
+def filter_notice(notice: object) -> bool:
+    return get_filter_reason(notice) is not None
+
+
+def get_field_filter_reason(notice: dict, tag: str) -> str:
+    # the rules that the field just added to the index can trigger, each rule is final once it fires
+    if tag == '205' and is_re_edition(notice):
+        return 're_edition'
+    if (tag == '008' or tag in NOT_TEXT_DATAFIELDS) and is_not_text(notice):
+        return 'not_text'
+    if tag == '029' and is_thesis(notice):
+        return 'thesis'
+    return None
+
 
-def set_doi(notice_json: str, soup: object, notice_id: str) -> str:
+def prefilter_element(root: object) -> tuple:
+    # index the fields of the notice until a rule rejects it, the same decision as get_filter_reason
+    # the rest of a rejected notice is only read for the fields of the rules before that one in FILTER_RULES
+    # return (reason, None) for a filtered notice, (None, notice index) otherwise
+    notice = {'controlfields': {}, 'datafields': {}}
+    if root is None:
+        return None, notice
+    fields = enumerate(root.iter(*FIELD_TAGS))
+    for rank, field in fields:
+        tag = index_field(notice, rank, field)
+        if tag in FILTER_TAGS:
+            reason = get_field_filter_reason(notice, tag)
+            if reason:
+                break
+    else:
+        return None, notice
+    tags = {tag for rule in FILTER_RULES[:FILTER_RULES.index(reason)] for tag in FILTER_RULE_TAGS[rule]}
+    for rank, field in fields:
+        if reason == FILTER_RULES[0]:
+            break
+        if field.get('tag') in tags:
+            field_reason = get_field_filter_reason(notice, index_field(notice, rank, field))
+            if field_reason and FILTER_RULES.index(field_reason) < FILTER_RULES.index(reason):
+                reason = field_reason
+    return reason, None
+
+
+def prefilter_xml(notice_xml: object) -> tuple:
+    return prefilter_element(parse_xml(notice_xml))
+
+
+def set_doi(notice_json: dict, notice: dict, notice_id: str) -> dict:
     doi = None
-    try:
-        for e in soup.find_all('datafield', {'tag': '017'}):
-            identifier = e.find('subfield', {'code': 'a'}).text
-            if identifier.startswith('10.'):
-                doi = identifier.strip().lower()
-    except:
-        pass
+    for d in get_datafields(notice, '017'):
+        identifier = get_subfield(d, 'a')
+        if identifier is None:
+            break
+        if identifier.startswith('10.'):
+            doi = identifier.strip().lower()
     if doi:
         notice_json['id'] = f'doi{doi}'
         notice_json['doi'] = doi
@@ -68,15 +231,15 @@ def set_doi(notice_json: str, soup: object, notice_id: str) -> str:
     return notice_json
 
 
-def set_genre(notice_json: str, soup: object) -> str:
-    #genre_elt = soup.find('controlfield', {'tag': '008'})
+def set_genre(notice_json: dict, notice: dict) -> dict:
+    #genre = notice['controlfields'].get('008')
     notice_json['genre'] = 'book'
     return notice_json
 
 
-def set_publication_date(notice_json: str, soup: object) -> str:
+def set_publication_date(notice_json: dict, notice: dict) -> dict:
     try:
-        publication_date = soup.find('datafield', {'tag': '100'}).find('subfield', {'code': 'a'}).text
+        publication_date = get_subfield(get_datafield(notice, '100'), 'a')
         #publication_date = publication_date[:8]
         #publication_date = datetime.datetime.strptime(publication_date, '%Y%m%d').isoformat()
         publication_year = publication_date[9:13]
@@ -88,13 +251,10 @@ def set_publication_date(notice_json: str, soup: object) -> str:
     return notice_json
 
 
-def set_title(notice_json: str, soup: object) -> str:
-    title, sub_title = '', ''
-    d = soup.find('datafield', {'tag': '200'})
-    if d and d.find('subfield', {'code': 'a'}):
-        title = d.find('subfield', {'code': 'a'}).text
-    if d and d.find('subfield', {'code': 'e'}):
-        sub_title = d.find('subfield', {'code': 'e'}).text
+def set_title(notice_json: dict, notice: dict) -> dict:
+    d = get_datafield(notice, '200')
+    title = get_subfield(d, 'a') or ''
+    sub_title = get_subfield(d, 'e') or ''
     if len(sub_title) > 0:
         title += f' : {sub_title}'
     title = title.strip()
@@ -102,119 +262,130 @@ def set_title(notice_json: str, soup: object) -> str:
     return notice_json
 
 
-def set_authors(notice_json: str, soup: object) -> str:
+def set_authors(notice_json: dict, notice: dict) -> dict:
     authors = []
-    for d in soup.find_all('datafield', {'tag': re.compile(r'(700|701|702)')}):
+    for d in get_datafields(notice, '700', '701', '702'):
         author = {'role': 'author'}
-        idref, last_name, first_name = None, None, None
-        idref = d.find('subfield', {'code': '3'})
-        if idref:
-            author['id'] = f'idref{idref.text}'
+        idref = get_subfield(d, '3')
+        if idref is not None:
+            author['id'] = f'idref{idref}'
             notice_json['persons_identified'] = True
-        last_name = d.find('subfield', {'code': 'a'})
-        if last_name:
-            author['last_name'] = last_name.text
-        first_name = d.find('subfield', {'code': 'b'})
-        if first_name:
-            author['first_name'] = first_name.text
+        last_name = get_subfield(d, 'a')
+        if last_name is not None:
+            author['last_name'] = last_name
+        first_name = get_subfield(d, 'b')
+        if first_name is not None:
+            author['first_name'] = first_name
         full_name = f'{author.get("first_name", "")} {author.get("last_name", "")}'
         author['full_name'] = full_name.strip()
-        if idref or last_name:
+        if idref is not None or last_name is not None:
             authors.append(author)
     notice_json['authors'] = authors
     return notice_json
 
 
-def set_id_external(notice_json: str, soup: object, sudoc_id: str) -> str:
+def set_id_external(notice_json: dict, notice: dict, sudoc_id: str) -> dict:
     ids_external = [{'id_type': 'sudoc', 'id_value': sudoc_id}]
-    d = soup.find('datafield', {'tag': '010'})
-    isbn = d.find('subfield', {'code': 'a'}) if d else None
-    if isbn:
-        id_external = {'id_type': 'isbn', 'id_value': isbn.text}
+    isbn = get_subfield(get_datafield(notice, '010'), 'a')
+    if isbn is not None:
+        id_external = {'id_type': 'isbn', 'id_value': isbn}
         ids_external.append(id_external)
-    d = soup.find('datafield', {'tag': '073'})
-    ean = d.find('subfield', {'code': 'a'}) if d else None
-    if ean:
-        id_external = {'id_type': 'ean', 'id_value': ean.text}
+    ean = get_subfield(get_datafield(notice, '073'), 'a')
+    if ean is not None:
+        id_external = {'id_type': 'ean', 'id_value': ean}
         ids_external.append(id_external)
-    for d in soup.find_all('datafield', {'tag': '035'}):
-        worldcat = d.find('subfield', {'code': 'a'})
-        if worldcat and '(OCoLC)' in worldcat.text:
-            id_external = {'id_type': 'worldcat', 'id_value': worldcat.text.replace('(OCoLC)', '').strip()}
+    for d in get_datafields(notice, '035'):
+        worldcat = get_subfield(d, 'a')
+        if worldcat is not None and '(OCoLC)' in worldcat:
+            id_external = {'id_type': 'worldcat', 'id_value': worldcat.replace('(OCoLC)', '').strip()}
             ids_external.append(id_external)
     notice_json['id_external'] = ids_external
     return notice_json
 
 
-def set_thematics(notice_json: str, soup: object) -> str:
+def set_thematics(notice_json: dict, notice: dict) -> dict:
     thematics = []
-    for d in soup.find_all('datafield', {'tag': '606'}):
+    for d in get_datafields(notice, '606'):
         thematic = {}
-        code = d.find('subfield', {'code': '3'})
-        if code:
-            thematic['code'] = code.text
-        reference = d.find('subfield', {'code': '2'})
-        if reference:
-            thematic['reference'] = reference.text
-        label = d.find('subfield', {'code': 'a'})
-        if label:
-            thematic['fr_label'] = label.text
+        code = get_subfield(d, '3')
+        if code is not None:
+            thematic['code'] = code
+        reference = get_subfield(d, '2')
+        if reference is not None:
+            thematic['reference'] = reference
+        label = get_subfield(d, 'a')
+        if label is not None:
+            thematic['fr_label'] = label
             thematics.append(thematic)
     notice_json['thematics'] = thematics
     return notice_json
 
 
-def set_summary(notice_json: str, soup: object) -> str:
-    d = soup.find('datafield', {'tag': '330'})
-    summary = d.find('subfield', {'code': 'a'}) if d else None
-    if summary:
-        notice_json['summary'] = summary.text
+def set_summary(notice_json: dict, notice: dict) -> dict:
+    summary = get_subfield(get_datafield(notice, '330'), 'a')
+    if summary is not None:
+        notice_json['summary'] = summary
     return notice_json
 
-def set_publisher(notice_json: str, soup: object) -> str:
-    d = soup.find('datafield', {'tag': '214'})
-    publisher = d.find('subfield', {'code': 'c'}) if d else None
-    if publisher:
-        notice_json['publisher'] = publisher.text
+def set_publisher(notice_json: dict, notice: dict) -> dict:
+    publisher = get_subfield(get_datafield(notice, '214'), 'c')
+    if publisher is not None:
+        notice_json['publisher'] = publisher
     return notice_json
 
 
-def set_source(notice_json: str, soup: object) -> str:
+def set_source(notice_json: dict, notice: dict) -> dict:
     notice_json['source'] = {}
-    datafield = soup.find('datafield', {'tag': '210'})
+    datafield = get_datafield(notice, '210')
     if datafield:
-        publishers = []
-        for subfield in datafield.find_all('subfield', {'code': 'c'}):
-            publishers.append(subfield.text)
-        publisher = ';'.join(publishers)
+        publisher = ';'.join(get_subfields(datafield, 'c'))
         if len(publisher) > 1:
             notice_json['source']['publisher'] = publisher
-        issn_parent = soup.find('datafield', {'tag': '461'})
-        issn = issn_parent.find('subfield', {'code': 'x'}) if issn_parent else None
-        if issn:
-            notice_json['source']['journal_issns'] = [issn.text]
-        source_field_parent = soup.find('datafield', {'tag': '461'})
-        source_title = source_field_parent.find('subfield', {'code': 't'}) if source_field_parent else None
-        if source_title:
-            notice_json['source']['source_title'] = source_title.text
+        issn_parent = get_datafield(notice, '461')
+        issn = get_subfield(issn_parent, 'x')
+        if issn is not None:
+            notice_json['source']['journal_issns'] = [issn]
+        source_title = get_subfield(issn_parent, 't')
+        if source_title is not None:
+            notice_json['source']['source_title'] = source_title
     return notice_json
 
 
-def parse(notice_id: str, soup: object) -> str:
+def parse(notice_id: str, notice: object) -> dict:
     logger.debug(f'Parsing sudoc notice id : {notice_id}')
+    notice = get_notice(notice)
     notice_json = {
         'sudoc_id': notice_id,
         'detected_countries': ['fr'],
         'data_sources': ['sudoc']
     }
-    notice_json = set_doi(notice_json, soup, notice_id)
-    notice_json = set_genre(notice_json, soup)
-    notice_json = set_publication_date(notice_json, soup)
-    notice_json = set_title(notice_json, soup)
-    notice_json = set_publisher(notice_json, soup)
-    notice_json = set_authors(notice_json, soup)
-    notice_json = set_id_external(notice_json, soup, notice_id)
-    notice_json = set_thematics(notice_json, soup)
-    notice_json = set_summary(notice_json, soup)
-    notice_json = set_source(notice_json, soup)
+    notice_json = set_doi(notice_json, notice, notice_id)
+    notice_json = set_genre(notice_json, notice)
+    notice_json = set_publication_date(notice_json, notice)
+    notice_json = set_title(notice_json, notice)
+    notice_json = set_publisher(notice_json, notice)
+    notice_json = set_authors(notice_json, notice)
+    notice_json = set_id_external(notice_json, notice, notice_id)
+    notice_json = set_thematics(notice_json, notice)
+    notice_json = set_summary(notice_json, notice)
+    notice_json = set_source(notice_json, notice)
     return notice_json
+
+
+def filter_and_parse_notice(notice_id: str, notice_xml: object, backend: str = None) -> tuple:
+    # return (reason, None) when the notice is filtered out, (None, notice_json) otherwise
+    backend = backend or PARSER_BACKEND
+    if backend == 'lxml':
+        reason, notice = prefilter_xml(notice_xml)
+    else:
+        notice = get_notice_from_xml(notice_xml, backend=backend)
+        reason = get_filter_reason(notice)
+    if reason:
+        logger.debug(f'Notice {notice_id} filtered: {reason}')
+        return reason, None
+    return None, parse(notice_id, notice)
+
+
+def parse_notice(notice_id: str, notice_xml: object, backend: str = None) -> dict:
+    # filter then parse a raw notice, None when the notice is filtered out
+    return filter_and_parse_notice(notice_id, notice_xml, backend)[1]
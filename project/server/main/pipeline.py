@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from project.server.main.logger import get_logger
+from project.server.main.metrics import count_filtered, observe
+from project.server.main.parser import FILTER_RULES, filter_and_parse_notice
+
+logger = get_logger(__name__)
+
+# 0 parses in a thread of the job process instead of a process pool
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1))
+# the parsing processes are not forked from the job process, whose download threads may hold locks
+PARSE_START_METHOD = os.getenv('PARSE_START_METHOD', 'forkserver')
+STORE_WORKERS = int(os.getenv('STORE_WORKERS', 16))
+# maximum number of notices waiting in front of the parse and store stages
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 64))
+STAGES = ['fetch', 'parse', 'store']
+
+executor = {'executor': None}
+
+
+@contextmanager
+def parse_executor():
+    # the parsing processes of a job, started once for all its chunks and shut down with it
+    # a pipeline run outside of this context starts its own
+    if executor['executor'] is not None:
+        yield executor['executor']
+        return
+    if PARSE_WORKERS > 0:
+        context = multiprocessing.get_context(PARSE_START_METHOD)
+        if PARSE_START_METHOD == 'forkserver':
+            context.set_forkserver_preload([__name__])
+        pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=context)
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    with pool:
+        executor['executor'] = pool
+        try:
+            yield pool
+        finally:
+            executor['executor'] = None
+
+
+def get_pipeline_stats() -> dict:
+    # the parse stage counts wall-clock seconds, its cpu_seconds sum the time spent in each parsing process
+    stats = {stage: {'count': 0, 'seconds': 0} for stage in STAGES}
+    stats['parse']['cpu_seconds'] = 0
+    # notices rejected by each filter rule, and the parsing time they still cost
+    stats['filters'] = {rule: {'count': 0, 'seconds': 0} for rule in FILTER_RULES}
+    return stats
+
+
+def add_throughput(stats: dict) -> dict:
+    for stage in STAGES:
+        seconds = stats[stage]['seconds']
+        stats[stage]['per_second'] = stats[stage]['count'] / seconds if seconds else 0
+    return stats
+
+
+def timed_parse(sudoc_id: str, notice_xml: bytes) -> tuple:
+    start = time.perf_counter()
+    reason, notice_json = filter_and_parse_notice(sudoc_id, notice_xml)
+    return reason, notice_json, time.perf_counter() - start
+
+
+def run_pipeline(items, store, stats: dict) -> list:
+    # items yields (sudoc_id, notice_xml, context), typically from downloads still running in threads
+    # notices are filtered and parsed in a process pool, then store(sudoc_id, notice_json, context) runs in threads
+    # notice_json is None for filtered notices, the store results are returned in input order
+    parse_futures, store_futures, results = deque(), deque(), []
+    parse_span = {'started': None, 'ended': None}
+
+    def timed_store(*args):
+        start = time.perf_counter()
+        result = store(*args)
+        return result, time.perf_counter() - start
+
+    def drain_store(limit):
+        while len(store_futures) > limit:
+            result, duration = store_futures.popleft().result()
+            stats['store']['count'] += 1
+            stats['store']['seconds'] += duration
+            results.append(result)
+
+    def drain_parse(limit):
+        while len(parse_futures) > limit:
+            sudoc_id, future, context = parse_futures.popleft()
+            reason, notice_json, duration = future.result()
+            parse_span['ended'] = time.perf_counter()
+            # measured in the parsing process, recorded here where the job summary lives
+            observe('parse', duration)
+            stats['parse']['count'] += 1
+            stats['parse']['cpu_seconds'] += duration
+            if reason:
+                count_filtered(reason)
+                stats['filters'][reason]['count'] += 1
+                stats['filters'][reason]['seconds'] += duration
+            store_futures.append(store_executor.submit(timed_store, sudoc_id, notice_json, context))
+            drain_store(PIPELINE_QUEUE_SIZE)
+
+    with parse_executor() as parse_pool, ThreadPoolExecutor(max_workers=STORE_WORKERS) as store_executor:
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            item = next(items, None)
+            stats['fetch']['seconds'] += time.perf_counter() - start
+            if item is None:
+                break
+            stats['fetch']['count'] += 1
+            sudoc_id, notice_xml, context = item
+            if parse_span['started'] is None:
+                parse_span['started'] = time.perf_counter()
+            parse_futures.append((sudoc_id, parse_pool.submit(timed_parse, sudoc_id, notice_xml), context))
+            # backpressure, the fetch stage waits while the parse queue is full
+            drain_parse(PIPELINE_QUEUE_SIZE)
+        drain_parse(0)
+        drain_store(0)
+    if parse_span['started'] is not None:
+        # from the first notice sent to the parsing processes to the last one parsed
+        stats['parse']['seconds'] += parse_span['ended'] - parse_span['started']
+    return results
@@ -0,0 +1,47 @@
+from project.server.main.utils import get_ppn_check_digit
+
+# a PPN is 8 digits followed by their check character, the bitmap has one bit per possible 8 digits
+PPN_BITMAP_SIZE = 10 ** 8
+
+
+def is_valid_ppn(ppn: str) -> bool:
+    return len(ppn) == 9 and ppn.isascii() and ppn[:8].isdigit() and get_ppn_check_digit(ppn[:8]) == ppn[8]
+
+
+class PpnSet:
+    """Set of PPNs kept as a 12.5 MB bitmap, whatever their number.
+
+    The check character of a valid PPN is implied by its 8 first digits, so one bit per base is exact.
+    Anything that is not a valid PPN goes to a regular set.
+    """
+
+    def __init__(self, ppns=None):
+        self.bitmap = bytearray(PPN_BITMAP_SIZE // 8)
+        self.others = set()
+        self.size = 0
+        for ppn in ppns or []:
+            self.add(ppn)
+
+    def add(self, ppn: str) -> bool:
+        # return True when the PPN was not in the set yet
+        if is_valid_ppn(ppn):
+            base = int(ppn[:8])
+            byte, bit = base >> 3, 1 << (base & 7)
+            if self.bitmap[byte] & bit:
+                return False
+            self.bitmap[byte] |= bit
+        elif ppn in self.others:
+            return False
+        else:
+            self.others.add(ppn)
+        self.size += 1
+        return True
+
+    def __contains__(self, ppn: str) -> bool:
+        if is_valid_ppn(ppn):
+            base = int(ppn[:8])
+            return bool(self.bitmap[base >> 3] & (1 << (base & 7)))
+        return ppn in self.others
+
+    def __len__(self) -> int:
+        return self.size
@@ -0,0 +1,151 @@
+import os
+import random
+import redis
+import time
+
+from project.server.main.logger import get_logger
+from project.server.main.metrics import observe, set_rate_limit
+from project.server.main.utils_redis import get_redis
+
+logger = get_logger(__name__)
+
+# requests per second allowed to each upstream host, shared by every worker through Redis
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_INITIAL = float(os.getenv('RATE_LIMIT_INITIAL', 10))
+RATE_LIMIT_MIN = float(os.getenv('RATE_LIMIT_MIN', 0.5))
+RATE_LIMIT_MAX = float(os.getenv('RATE_LIMIT_MAX', 50))
+# additive increase, in requests per second gained per second of healthy responses at full rate
+RATE_LIMIT_INCREASE = float(os.getenv('RATE_LIMIT_INCREASE', 2))
+# multiplicative decrease on throttling, server errors and timeouts, at most once per cooldown
+RATE_LIMIT_DECREASE = float(os.getenv('RATE_LIMIT_DECREASE', 0.7))
+RATE_LIMIT_COOLDOWN = float(os.getenv('RATE_LIMIT_COOLDOWN', 1))
+# bucket capacity, in seconds of the current rate
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 1))
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 60))
+RATE_LIMIT_TTL = int(os.getenv('RATE_LIMIT_TTL', 24 * 3600))
+# without Redis the requests go through unthrottled, Redis is tried again after this delay
+RATE_LIMIT_RETRY_REDIS = float(os.getenv('RATE_LIMIT_RETRY_REDIS', 60))
+
+# take a token from the bucket, return the milliseconds to wait before trying again, 0 once a token is taken
+ACQUIRE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'rate', 'blocked_until')
+local rate = tonumber(state[3]) or tonumber(ARGV[2])
+local burst = math.max(1, rate * tonumber(ARGV[3]))
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+local blocked_until = tonumber(state[4]) or 0
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate / 1000)
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+elseif tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now, 'rate', rate)
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return wait
+'''
+
+# adapt the rate of the bucket to the outcome of a request, return the new rate
+REPORT_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[2])
+if ARGV[8] == '1' then
+    rate = math.min(tonumber(ARGV[4]), rate + tonumber(ARGV[5]) / rate)
+else
+    local decreased_at = tonumber(redis.call('HGET', KEYS[1], 'decreased_at')) or 0
+    if now - decreased_at >= tonumber(ARGV[7]) then
+        rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[6]))
+        redis.call('HSET', KEYS[1], 'decreased_at', now)
+    end
+    local blocked_until = now + tonumber(ARGV[9])
+    if blocked_until > (tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0) then
+        redis.call('HSET', KEYS[1], 'blocked_until', blocked_until)
+    end
+end
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('PEXPIRE', KEYS[1], ARGV[10])
+return tostring(rate)
+'''
+
+unavailable = {'until': 0}
+# the scripts registered on the current Redis client, registered again when the client changes
+scripts = {'client': None}
+
+
+def get_bucket_key(host: str) -> str:
+    return f'ratelimit:{host}'
+
+
+def get_now() -> int:
+    return int(time.time() * 1000)
+
+
+def is_enabled() -> bool:
+    return RATE_LIMIT_ENABLED and time.time() >= unavailable['until']
+
+
+def set_unavailable(error: Exception) -> None:
+    logger.warning(f'rate limiter unavailable for {RATE_LIMIT_RETRY_REDIS}s: {error}')
+    unavailable['until'] = time.time() + RATE_LIMIT_RETRY_REDIS
+
+
+def get_script(name: str):
+    connection = get_redis()
+    if scripts['client'] is not connection:
+        scripts.update({'client': connection, 'acquire': connection.register_script(ACQUIRE_SCRIPT),
+                        'report': connection.register_script(REPORT_SCRIPT)})
+    return scripts[name]
+
+
+def get_retry_after(value: str) -> float:
+    # only the delay-seconds form, an HTTP date falls back to the cooldown
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def acquire(host: str) -> float:
+    # block until the bucket of the host gives a token, return the seconds waited
+    waited = 0
+    while is_enabled():
+        try:
+            wait = get_script('acquire')(
+                keys=[get_bucket_key(host)],
+                args=[get_now(), RATE_LIMIT_INITIAL, RATE_LIMIT_BURST, RATE_LIMIT_TTL * 1000]) / 1000
+        except redis.RedisError as error:
+            set_unavailable(error)
+            break
+        if wait <= 0:
+            break
+        # a little jitter so that the waiting threads do not all wake up together
+        wait = min(wait, RATE_LIMIT_MAX_WAIT) * random.uniform(1, 1.1)
+        time.sleep(wait)
+        waited += wait
+    if waited:
+        observe('rate_limit_wait', waited)
+    return waited
+
+
+def report(host: str, healthy: bool, retry_after: str = None) -> float:
+    # grow the rate of the host while it answers, back off on throttling, server errors and timeouts
+    if not is_enabled():
+        return None
+    penalty = get_retry_after(retry_after) if not healthy else 0
+    try:
+        rate = float(get_script('report')(
+            keys=[get_bucket_key(host)],
+            args=[get_now(), RATE_LIMIT_INITIAL, RATE_LIMIT_MIN, RATE_LIMIT_MAX, RATE_LIMIT_INCREASE,
+                  RATE_LIMIT_DECREASE, RATE_LIMIT_COOLDOWN * 1000, int(healthy), int(penalty * 1000),
+                  RATE_LIMIT_TTL * 1000]))
+    except redis.RedisError as error:
+        set_unavailable(error)
+        return None
+    if not healthy:
+        logger.debug(f'rate limit of {host} lowered to {rate:.2f} requests/s')
+    set_rate_limit(host, rate)
+    return rate
@@ -0,0 +1,130 @@
+import fcntl
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+from project.server.main.logger import get_logger
+from project.server.main.utils import get_content_hash, get_raw_path
+
+logger = get_logger(__name__)
+
+RAW_CACHE_DIR = os.getenv('RAW_CACHE_DIR', '/tmp/harvest-sudoc-cache')
+RAW_CACHE_MAX_BYTES = int(os.getenv('RAW_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+# after an eviction the cache is brought back under this share of its budget
+RAW_CACHE_EVICTION_RATIO = 0.9
+
+
+class RawCache:
+    """Worker-local copy of raw/ notices, shared by the processes of a host and evicted by LRU."""
+
+    def __init__(self, directory: str = RAW_CACHE_DIR, max_bytes: int = RAW_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get_path(self, sudoc_id: str) -> str:
+        return os.path.join(self.directory, get_raw_path(sudoc_id))
+
+    @contextmanager
+    def lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_usage(self) -> int:
+        try:
+            with open(os.path.join(self.directory, '.usage'), 'r') as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_usage(self, usage: int) -> None:
+        with open(os.path.join(self.directory, '.usage'), 'w') as f:
+            f.write(str(max(usage, 0)))
+
+    def get(self, sudoc_id: str, content_hash: str = None) -> bytes:
+        if not self.enabled:
+            return None
+        path = self.get_path(sudoc_id)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self.stats['misses'] += 1
+            return None
+        if content_hash and get_content_hash(content) != content_hash:
+            # stale or corrupted copy, the object storage is the reference
+            self.remove(sudoc_id)
+            self.stats['misses'] += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.stats['hits'] += 1
+        return content
+
+    def put(self, sudoc_id: str, content: bytes) -> None:
+        if not self.enabled:
+            return
+        path = self.get_path(sudoc_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            previous_size = os.path.getsize(path)
+        except FileNotFoundError:
+            previous_size = 0
+        # write then rename so that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self.stats['puts'] += 1
+        with self.lock():
+            usage = self.read_usage() + len(content) - previous_size
+            self.write_usage(usage)
+            if usage > self.max_bytes:
+                self.evict()
+
+    def remove(self, sudoc_id: str) -> None:
+        path = self.get_path(sudoc_id)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock():
+            self.write_usage(self.read_usage() - size)
+
+    def evict(self) -> None:
+        # called with the lock held, usage is recomputed from the files actually on disk
+        files = []
+        for root, _, filenames in os.walk(os.path.join(self.directory, 'raw')):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        usage = sum(f[1] for f in files)
+        target = self.max_bytes * RAW_CACHE_EVICTION_RATIO
+        for _, size, path in sorted(files):
+            if usage <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            usage -= size
+            self.stats['evictions'] += 1
+        self.write_usage(usage)
+        logger.debug(f'Raw cache evicted down to {usage} bytes')
@@ -0,0 +1,187 @@
+import json
+import os
+import time
+
+from collections import Counter
+from rq import get_current_job
+
+from project.server.main.logger import get_logger
+from project.server.main.pipeline import add_throughput, get_pipeline_stats, parse_executor, run_pipeline
+from project.server.main.ppn import PpnSet
+from project.server.main.raw_cache import RawCache
+from project.server.main.storage_manifest import get_object_info
+from project.server.main.tasks import delete_previous_object, dump_notice, get_previous_parsed_key, iter_chunks, \
+    iter_file_sudoc_ids
+from project.server.main.utils import get_content_hash, get_parsed_hash, get_parsed_path, get_raw_path
+from project.server.main.utils_mongo import get_collection, upsert_notices
+from project.server.main.utils_swift import download_bytes, download_bytes_batch, get_object_etag, iter_listing_pages, \
+    upload_bytes
+
+logger = get_logger(__name__)
+
+# the fields that changed are compared on the previous parsed objects of about that many changed notices
+REPARSE_DIFF_SAMPLE = int(os.getenv('REPARSE_DIFF_SAMPLE', 1000))
+# legacy: parsed by an older harvest that did not record its outcome, or in another format than PARSED_FORMAT
+REPARSE_CHANGES = ['unchanged', 'changed', 'newly_parsed', 'newly_filtered', 'still_filtered', 'legacy']
+REPARSE_SAMPLE_IDS = 20
+REPARSE_PROJECTION = {'_id': 0, 'sudoc_id': 1, 'content_hash': 1, 'parsed': 1, 'parsed_key': 1, 'parsed_hash': 1}
+
+
+def iter_raw_sudoc_ids():
+    # every notice downloaded so far, from the listing of raw/
+    for page in iter_listing_pages('sudoc', 'raw/'):
+        for obj in page:
+            yield obj['name'].rsplit('/', 1)[-1].rsplit('.', 1)[0]
+
+
+def get_previous_hash(known_state: dict, previous_key: str) -> str:
+    # hash of the parsed output of the previous run, the etag of its object for older notices
+    if known_state.get('parsed_hash'):
+        return known_state['parsed_hash']
+    if previous_key and previous_key.startswith('parsed/'):
+        info = get_object_info('sudoc', previous_key)
+        if info and info['etag']:
+            return info['etag']
+        return get_object_etag('sudoc', previous_key)
+    return None
+
+
+def is_legacy(known_state: dict, previous_key: str, parsed_key: str) -> bool:
+    if not known_state:
+        return False
+    if 'parsed' not in known_state:
+        return True
+    return known_state['parsed'] and previous_key is not None and previous_key.startswith('parsed/') \
+        and previous_key != parsed_key
+
+
+def get_changed_fields(known_state: dict, notice_json: dict) -> list:
+    parsed_key = known_state.get('parsed_key')
+    # shard outputs are not compared
+    contents = download_bytes('sudoc', parsed_key) if parsed_key and parsed_key.startswith('parsed/') else None
+    if contents is None:
+        return None
+    previous = json.loads(contents)
+    return sorted(key for key in set(previous) | set(notice_json) if previous.get(key) != notice_json.get(key))
+
+
+def get_notice_context(sudoc_id: str, notice_xml: bytes, known_states: dict, context: dict) -> dict:
+    known_state = known_states.get(sudoc_id)
+    notice_context = {**context, 'known_state': known_state or {},
+                      'previous_key': get_previous_parsed_key(sudoc_id, known_state)}
+    if known_state is None:
+        # a raw notice without its Mongo document, e.g. from an interrupted harvest
+        notice_context['harvest_state'] = {'content_hash': get_content_hash(notice_xml),
+                                           'raw_key': get_raw_path(sudoc_id)}
+    return notice_context
+
+
+def iter_raw_notices(sudoc_ids: list, known_states: dict, raw_cache: RawCache, stats: dict, context: dict):
+    # yield the raw notices of the chunk, from the local cache first, then as they are downloaded
+    ids_missing = []
+    for sudoc_id in sudoc_ids:
+        notice_xml = raw_cache.get(sudoc_id, known_states.get(sudoc_id, {}).get('content_hash'))
+        if notice_xml is None:
+            ids_missing.append(sudoc_id)
+            continue
+        yield sudoc_id, notice_xml, get_notice_context(sudoc_id, notice_xml, known_states, context)
+    raw_paths = [get_raw_path(sudoc_id) for sudoc_id in ids_missing]
+    for sudoc_id, (_, notice_xml) in zip(ids_missing, download_bytes_batch('sudoc', raw_paths)):
+        if notice_xml is None:
+            logger.error(f'Notice {sudoc_id} is missing from object storage')
+            stats['missing'] += 1
+            continue
+        raw_cache.put(sudoc_id, notice_xml)
+        yield sudoc_id, notice_xml, get_notice_context(sudoc_id, notice_xml, known_states, context)
+
+
+def store_reparsed(sudoc_id: str, notice_json: dict, context: dict) -> dict:
+    # write the parsed output only when it changed, return the change and the Mongo state to set, if any
+    known_state = context['known_state']
+    was_parsed = known_state.get('parsed', False)
+    parsed_key = get_parsed_path(sudoc_id)
+    legacy = is_legacy(known_state, context['previous_key'], parsed_key)
+    result = {'sudoc_id': sudoc_id, 'state': None, 'fields': None}
+    harvest_state = {'sudoc_id': sudoc_id, **context.get('harvest_state', {})}
+    if notice_json is None:
+        result['change'] = 'legacy' if legacy else 'newly_filtered' if was_parsed else 'still_filtered'
+        if was_parsed or legacy or not known_state:
+            result['state'] = {**harvest_state, 'filtered': True, 'parsed': False, 'parsed_key': None,
+                               'parsed_hash': None}
+            if not context['dry_run']:
+                delete_previous_object(context)
+        return result
+    contents = dump_notice(notice_json)
+    parsed_hash = get_parsed_hash(contents)
+    previous_hash = get_previous_hash(known_state, context['previous_key']) if was_parsed or legacy else None
+    if previous_hash == parsed_hash:
+        result['change'] = 'unchanged'
+        if legacy:
+            result['state'] = {'sudoc_id': sudoc_id, 'filtered': False, 'parsed': True, 'parsed_key': parsed_key,
+                               'parsed_hash': parsed_hash}
+        elif known_state.get('parsed_hash') != parsed_hash:
+            result['state'] = {'sudoc_id': sudoc_id, 'parsed_hash': parsed_hash}
+        return result
+    result['change'] = 'legacy' if legacy else 'changed' if was_parsed else 'newly_parsed'
+    if result['change'] == 'changed' and context['diff_sample'] > 0:
+        result['fields'] = get_changed_fields(known_state, notice_json)
+    result['state'] = {**harvest_state, 'filtered': False, 'parsed': True, 'parsed_key': parsed_key,
+                       'parsed_hash': parsed_hash}
+    if not context['dry_run']:
+        upload_bytes('sudoc', parsed_key, contents)
+        delete_previous_object(context, parsed_key)
+    return result
+
+
+def reparse_chunk(chunk: list, raw_cache: RawCache, stats: dict, dry_run: bool) -> None:
+    mongo_collection = get_collection()
+    known_states = {k['sudoc_id']: k for k in mongo_collection.find({'sudoc_id': {'$in': chunk}},
+                                                                     REPARSE_PROJECTION)}
+    context = {'dry_run': dry_run, 'diff_sample': REPARSE_DIFF_SAMPLE - stats['diff']['compared']}
+    notices = iter_raw_notices(chunk, known_states, raw_cache, stats, context)
+    states = []
+    for result in run_pipeline(notices, store_reparsed, stats['stages']):
+        stats[result['change']] += 1
+        if result['change'] != 'unchanged' and len(stats['samples'][result['change']]) < REPARSE_SAMPLE_IDS:
+            stats['samples'][result['change']].append(result['sudoc_id'])
+        if result['fields'] is not None:
+            stats['diff']['compared'] += 1
+            stats['diff']['fields'].update(result['fields'])
+        if result['state'] is not None:
+            states.append(result['state'])
+    if not dry_run:
+        upsert_notices(states, mongo_collection)
+
+
+def create_task_reparse(sudoc_ids: list = None, sudoc_ids_path: str = None, dry_run: bool = False) -> dict:
+    # parse again the raw notices of the object storage, all of them or the given ones, without asking sudoc.fr
+    # only the parsed outputs that changed are written, the summary tells what changed
+    logger.debug(f'Task reparse for {sudoc_ids_path or ("the given sudoc ids" if sudoc_ids else "every notice")}')
+    if sudoc_ids:
+        sudoc_ids = sudoc_ids if isinstance(sudoc_ids, list) else [sudoc_ids]
+    elif sudoc_ids_path:
+        sudoc_ids = iter_file_sudoc_ids(sudoc_ids_path)
+    else:
+        sudoc_ids = iter_raw_sudoc_ids()
+    stats = {change: 0 for change in REPARSE_CHANGES}
+    stats.update({'missing': 0, 'dry_run': dry_run, 'stages': get_pipeline_stats(),
+                  'samples': {change: [] for change in REPARSE_CHANGES if change != 'unchanged'},
+                  'diff': {'compared': 0, 'fields': Counter()}})
+    raw_cache = RawCache()
+    job = get_current_job()
+    start = time.time()
+    with parse_executor():
+        for chunk in iter_chunks(sudoc_ids, None if isinstance(sudoc_ids, list) else PpnSet()):
+            reparse_chunk(chunk, raw_cache, stats, dry_run)
+            if job:
+                job.meta['progress'] = {change: stats[change] for change in REPARSE_CHANGES}
+                job.save_meta()
+    duration = time.time() - start
+    stats['notices'] = sum(stats[change] for change in REPARSE_CHANGES)
+    stats['seconds'] = round(duration, 3)
+    stats['per_second'] = stats['notices'] / duration if duration else 0
+    stats['diff']['fields'] = dict(stats['diff']['fields'].most_common())
+    stats['raw_cache'] = raw_cache.stats
+    stats['stages'] = add_throughput(stats['stages'])
+    logger.debug(f'Reparse done: {stats}')
+    return stats
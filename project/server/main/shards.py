@@ -0,0 +1,69 @@
+import datetime
+import gzip
+import json
+
+from project.server.main.logger import get_logger
+from project.server.main.utils_swift import download_bytes, iter_jsonl_records, upload_bytes
+
+logger = get_logger(__name__)
+
+OUTPUT_MODES = ['objects', 'shards']
+SHARDS_CONTAINER = 'sudoc'
+SHARDS_PREFIX = 'parsed_shards'
+
+
+def get_shard_path(run_id: str, name: str) -> str:
+    return f'{SHARDS_PREFIX}/{run_id}/{name}.jsonl.gz'
+
+
+def get_manifest_path(run_id: str, name: str = 'manifest') -> str:
+    return f'{SHARDS_PREFIX}/{run_id}/{name}.json'
+
+
+def dump_shard(notices: list) -> bytes:
+    lines = [json.dumps(notice, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+             for notice in notices]
+    return gzip.compress(b''.join(lines))
+
+
+def write_shard(path: str, notices: list) -> dict:
+    contents = dump_shard(notices)
+    upload_bytes(SHARDS_CONTAINER, path, contents)
+    return {'path': path, 'records': len(notices), 'bytes': len(contents)}
+
+
+def write_manifest(run_id: str, shards: list, name: str = 'manifest') -> dict:
+    manifest = {
+        'run_id': run_id,
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'records': sum(shard['records'] for shard in shards),
+        'shards': sorted(shards, key=lambda shard: shard['path'])
+    }
+    upload_bytes(SHARDS_CONTAINER, get_manifest_path(run_id, name), json.dumps(manifest, indent=4).encode('utf-8'))
+    return manifest
+
+
+def read_manifest(run_id: str, name: str = 'manifest') -> dict:
+    contents = download_bytes(SHARDS_CONTAINER, get_manifest_path(run_id, name))
+    return json.loads(contents) if contents is not None else None
+
+
+def merge_manifests(run_id: str, names: list) -> dict:
+    # combine the manifests written by each chunk job of a harvest into the manifest of the run
+    shards = []
+    for name in names:
+        manifest = read_manifest(run_id, name)
+        if manifest is None:
+            logger.error(f'Missing manifest {name} for run {run_id}')
+            continue
+        shards += manifest['shards']
+    return write_manifest(run_id, shards)
+
+
+def iter_shard_records(run_id: str):
+    manifest = read_manifest(run_id)
+    if manifest is None:
+        logger.error(f'Missing manifest for run {run_id}')
+        return
+    for shard in manifest['shards']:
+        yield from iter_jsonl_records(SHARDS_CONTAINER, shard['path'])
@@ -0,0 +1,161 @@
+import os
+import redis
+import time
+
+from project.server.main.logger import get_logger
+from project.server.main.utils_redis import get_redis
+
+logger = get_logger(__name__)
+
+# objects of the object storage, per directory, as a Redis hash of basename -> size:etag
+# a prefix is only trusted for missing objects once it has been fully listed, our own writes keep it up to date
+# each directory listed holds a marker field, a directory lost to an eviction or a flush is no longer trusted
+STORAGE_MANIFEST_ENABLED = os.getenv('STORAGE_MANIFEST_ENABLED', '1') == '1'
+STORAGE_MANIFEST_PREFIXES = ['raw/', 'parsed/']
+# how long the listed prefixes are kept in memory before asking Redis again
+STORAGE_MANIFEST_LISTED_TTL = 60
+STORAGE_MANIFEST_RETRY_REDIS = 60
+LISTED_FIELD = '.listed'
+
+listed = {'prefixes': {}, 'expires_at': 0}
+unavailable = {'until': 0}
+# uploads that could not be recorded, nothing is reported missing by this process until they are
+pending = []
+
+
+def get_prefix(filename: str) -> str:
+    for prefix in STORAGE_MANIFEST_PREFIXES:
+        if filename.startswith(prefix):
+            return prefix
+    return None
+
+
+def get_manifest_key(container: str, filename: str) -> str:
+    directory = filename.rsplit('/', 1)[0] if '/' in filename else ''
+    return f'storage:{container}:{directory}'
+
+
+def get_listed_key(container: str) -> str:
+    return f'storage:{container}:listed'
+
+
+def is_enabled(filename: str) -> bool:
+    return STORAGE_MANIFEST_ENABLED and time.time() >= unavailable['until'] and get_prefix(filename) is not None
+
+
+def set_unavailable(error: Exception) -> None:
+    logger.warning(f'storage manifest unavailable for {STORAGE_MANIFEST_RETRY_REDIS}s: {error}')
+    unavailable['until'] = time.time() + STORAGE_MANIFEST_RETRY_REDIS
+
+
+def record_pending() -> bool:
+    # True once the manifest holds every upload of this process
+    if not pending:
+        return True
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        for key, field, value in pending:
+            pipeline.hset(key, field, value)
+        pipeline.execute()
+    except redis.RedisError as error:
+        set_unavailable(error)
+        return False
+    logger.debug(f'{len(pending)} pending uploads recorded in the storage manifest')
+    pending.clear()
+    return True
+
+
+def get_listed_prefixes(container: str) -> set:
+    if listed['expires_at'] < time.time():
+        listed['prefixes'] = {}
+        listed['expires_at'] = time.time() + STORAGE_MANIFEST_LISTED_TTL
+    if container not in listed['prefixes']:
+        prefixes = get_redis().smembers(get_listed_key(container))
+        listed['prefixes'][container] = {prefix.decode('utf-8') for prefix in prefixes}
+    return listed['prefixes'][container]
+
+
+def get_object_info(container: str, filename: str) -> dict:
+    # {'size', 'etag'} of a known object, None when it is missing or when the manifest does not know
+    if not is_enabled(filename):
+        return None
+    try:
+        value = get_redis().hget(get_manifest_key(container, filename), filename.rsplit('/', 1)[-1])
+    except redis.RedisError as error:
+        set_unavailable(error)
+        return None
+    if value is None:
+        return None
+    size, etag = value.decode('utf-8').split(':', 1)
+    return {'size': int(size) if size else None, 'etag': etag or None}
+
+
+def is_missing(container: str, filename: str) -> bool:
+    # True only when the manifest knows the object does not exist, so that the request can be skipped
+    if not is_enabled(filename) or not record_pending():
+        return False
+    try:
+        if get_prefix(filename) not in get_listed_prefixes(container):
+            return False
+        listed_marker, value = get_redis().hmget(get_manifest_key(container, filename),
+                                                 [LISTED_FIELD, filename.rsplit('/', 1)[-1]])
+        return listed_marker is not None and value is None
+    except redis.RedisError as error:
+        set_unavailable(error)
+        return False
+
+
+def record_upload(container: str, filename: str, size: int = None, etag: str = None) -> None:
+    if not STORAGE_MANIFEST_ENABLED or get_prefix(filename) is None:
+        return
+    entry = (get_manifest_key(container, filename), filename.rsplit('/', 1)[-1],
+             f'{size if size is not None else ""}:{etag or ""}')
+    if time.time() < unavailable['until']:
+        pending.append(entry)
+        return
+    try:
+        get_redis().hset(*entry)
+    except redis.RedisError as error:
+        set_unavailable(error)
+        pending.append(entry)
+
+
+def record_delete(container: str, filename: str) -> None:
+    if not is_enabled(filename):
+        return
+    try:
+        get_redis().hdel(get_manifest_key(container, filename), filename.rsplit('/', 1)[-1])
+    except redis.RedisError as error:
+        set_unavailable(error)
+
+
+def build_manifest(container: str, prefix: str, pages) -> dict:
+    # pages is an iterator over the listing of the prefix, as lists of {'name', 'bytes', 'hash'}
+    # entries are only added: one left by an object deleted by someone else costs a request that forgets it,
+    # while dropping one written during the listing would hide an existing object
+    if prefix not in STORAGE_MANIFEST_PREFIXES:
+        raise ValueError(f'Unknown prefix {prefix}, expected one of {STORAGE_MANIFEST_PREFIXES}')
+    start = time.time()
+    connection = get_redis()
+    stats = {'container': container, 'prefix': prefix, 'objects': 0, 'bytes': 0, 'pages': 0}
+    directories = set()
+    for page in pages:
+        pipeline = connection.pipeline(transaction=False)
+        for obj in page:
+            key = get_manifest_key(container, obj['name'])
+            pipeline.hset(key, obj['name'].rsplit('/', 1)[-1], f'{obj["bytes"]}:{obj["hash"]}')
+            directories.add(key)
+            stats['bytes'] += obj['bytes']
+        pipeline.execute()
+        stats['objects'] += len(page)
+        stats['pages'] += 1
+    pipeline = connection.pipeline(transaction=False)
+    for key in directories:
+        pipeline.hset(key, LISTED_FIELD, '')
+    pipeline.execute()
+    stats['directories'] = len(directories)
+    connection.sadd(get_listed_key(container), prefix)
+    listed['expires_at'] = 0
+    stats['seconds'] = round(time.time() - start, 3)
+    logger.debug(f'Storage manifest built: {stats}')
+    return stats
@@ -1,18 +1,50 @@
-from bs4 import BeautifulSoup
+import datetime
 import json
-import os
-import pymongo
 import requests
+import swiftclient
+import time
+import uuid
 
-from project.server.main.parser import parse, filter_notice
+from itertools import chain
+
+from lxml import etree
+from rq import Queue, get_current_job
+from rq.command import send_stop_job_command
+from rq.exceptions import InvalidJobOperation
+from rq.job import Job, JobStatus
+from rq.registry import DeferredJobRegistry
+
+from project.server.main.checkpoint import complete_chunk, get_chunk_key, get_completed_chunk, get_notice_stages, \
+    set_notice_stage
+from project.server.main.fetcher import fetch_notices, get, get_session
+from project.server.main.harvested_index import HARVESTED_INDEX_MIN_IDS, HarvestedIndex, delete_shared, \
+    get_shared_key
+from project.server.main.idref import resolve_idrefs
+from project.server.main.parser import FILTER_RULES, parse, get_filter_reason, index_element, iter_marcxml_records
 from project.server.main.logger import get_logger
-from project.server.main.utils_swift import upload_object, download_object, delete_object
+from project.server.main.metrics import get_job_timings, merge_timings, reset_job_timings
+from project.server.main.pipeline import add_throughput, get_pipeline_stats, parse_executor, run_pipeline
+from project.server.main.ppn import PpnSet
+from project.server.main.raw_cache import RawCache
+from project.server.main.shards import OUTPUT_MODES, get_shard_path, merge_manifests, write_manifest, write_shard
+from project.server.main.utils import PARSED_FORMAT, get_content_hash, get_legacy_parsed_path, get_parsed_hash, \
+    get_parsed_path, get_raw_path
+from project.server.main.utils_mongo import get_collection, upsert_notices
+from project.server.main.utils_swift import delete_object, delete_objects, download_bytes_batch, iter_object_lines, \
+    upload_bytes, upload_bytes_batch, upload_stream
 
 logger = get_logger(__name__)
 
-MONGO_HOST = 'mongodb://mongo:27017/'
-MONGO_DB = 'harvest'
-MONGO_COLLECTION = 'sudoc'
+CHUNK_SIZE = 500
+CHUNK_TIMEOUT = 21600
+DUMP_BATCH_SIZE = 1000
+HARVEST_COUNTERS = ['fetched', 'new', 'changed', 'unchanged', 'reparsed', 'parsed', 'filtered', 'failed', 'resumed',
+                    'resumed_chunks']
+RESULT_TTL = 7 * 24 * 3600
+AGGREGATE_WAIT = 60
+ENDED_STATUSES = [JobStatus.FINISHED, JobStatus.FAILED, JobStatus.STOPPED]
+CHUNK_FILES_BATCH_SIZE = 100
+SUDOC_IDS_PREFIX = 'sudoc_ids'
 
 
 #def is_thesis(soup: object) -> bool:
@@ -24,26 +56,7 @@ MONGO_COLLECTION = 'sudoc'
 
 def get_sudoc_ids(idref):
     logger.debug(f'Get all sudoc ids for idref {idref}')
-    sudoc_ids = []
-    #url = f'https://www.sudoc.fr/services/generic/?servicekey=qualinca_nbs_cache&ppn={idref}&format=application/xml'
-    url = f'https://www.idref.fr/Proxy?https://data.idref.fr/sparql?default-graph-uri=&query=select+distinct%28%3Fdoc%29%2C+%3Fcitation%0D%0Awhere%0D%0A%7B%3Fdoc+%3Frel+%3Chttp%3A%2F%2Fwww.idref.fr%2F{idref}%2Fid%3E.%0D%0A%3Fdoc+a+%3Ftype+%3B+dcterms%3AbibliographicCitation+%3Fcitation.%0D%0AFILTER%28regex%28%3Fdoc%2C%27http%3A%2F%2Fwww.sudoc%27%29%29%0D%0AOPTIONAL+%7B%3Fdoc+dc%3Adate+%3FdatePub%7D.%0D%0A%0D%0A%7D%0D%0AORDER+by+desc%28%3FdatePub%29+&format=application%2Frdf%2Bxml&timeout=0&debug=on&run=+Run+Query+'
-    try:
-        xml = requests.get(url).text
-    except:
-        logger.debug(f'erreur avec la requete {url}')
-        return []
-    soup = BeautifulSoup(xml, 'lxml')
-    #for n in soup.find_all('o_noticebiblio'):
-    #    ppn = n.find('ppn')
-    #    if ppn:
-    #        sudoc_ids.append(ppn.text)
-    for res in soup.find_all('res:value'):
-        try:
-            if 'sudoc.fr' in res.attrs['rdf:resource']:
-                sudoc_ids.append(res.attrs['rdf:resource'].split('/')[3])
-        except:
-            pass
-    return sudoc_ids
+    return resolve_idrefs([idref]).get(idref, [])
 
 
 def get_sudoc_ids_old(idref: str) -> list:
@@ -51,10 +64,11 @@ def get_sudoc_ids_old(idref: str) -> list:
     sudoc_ids = []
     url = f'https://www.idref.fr/services/biblio/{idref}.json'
     try:
-        response = requests.get(url).json()
-    except:
-        logger.debug(f'erreur avec la requete {url}')
-        return []
+        response = get(get_session(), url, stage='idref_biblio').json()
+    except (requests.RequestException, ValueError) as error:
+        # an empty list would silently drop the notices of this idref
+        logger.error(f'erreur avec la requete {url}: {error}')
+        raise
     roles = response.get('sudoc', {}).get('result', {}).get('role', [])
     roles = roles if isinstance(roles, list) else [roles]
     for role in roles:
@@ -66,69 +80,552 @@ def get_sudoc_ids_old(idref: str) -> list:
     return list(set(sudoc_ids))
 
 
-def create_task_harvest_notices(sudoc_ids: list, force_download: bool = False, force_parsing: bool = True) -> None:
+def get_previous_parsed_key(sudoc_id: str, known_state: dict) -> str:
+    if known_state is None:
+        return None
+    if 'parsed_key' not in known_state:
+        # harvested before the parsed key was recorded
+        return get_legacy_parsed_path(sudoc_id)
+    return known_state['parsed_key']
+
+
+def get_store_context(state: dict, notice_xml: bytes, known_state: dict, chunk_context: dict) -> dict:
+    # chunk_context holds the shard path and the checkpoint of the chunk, both None when not used
+    return {
+        'state': state,
+        'notice_xml': notice_xml,
+        'previous_key': get_previous_parsed_key(state['sudoc_id'], known_state),
+        **chunk_context
+    }
+
+
+def delete_previous_object(context: dict, parsed_key: str = None) -> None:
+    # drop the per-notice parsed object of a previous harvest, shards are never rewritten
+    previous_key = context['previous_key']
+    if previous_key is None or previous_key == parsed_key or not previous_key.startswith('parsed/'):
+        return
+    try:
+        delete_object('sudoc', previous_key)
+    except swiftclient.ClientException as error:
+        if error.http_status != 404:
+            logger.error(f'Error while deleting {previous_key}: {error}')
+
+
+def store_notice(sudoc_id: str, notice_json: dict, context: dict) -> dict:
+    # upload a freshly downloaded raw notice and the parsing output, return the state to store in Mongo
+    state = context['state']
+    checkpoint = context['checkpoint']
+    if context['notice_xml'] is not None:
+        upload_bytes('sudoc', get_raw_path(sudoc_id), context['notice_xml'])
+        if checkpoint:
+            set_notice_stage(*checkpoint, sudoc_id, 'raw', state)
+    if context['shard_path'] and notice_json is not None:
+        # written with the rest of the chunk once the pipeline is done, so only checkpointed with the chunk
+        delete_previous_object(context)
+        return {**state, 'filtered': False, 'parsed': True, 'parsed_key': context['shard_path'],
+                'parsed_hash': get_parsed_hash(dump_notice(notice_json)), 'notice_json': notice_json}
+    if notice_json is None:
+        # make sure notice not stored on object storage
+        delete_previous_object(context)
+        state = {**state, 'filtered': True, 'parsed': False, 'parsed_key': None, 'parsed_hash': None}
+    else:
+        # we keep and parse
+        parsed_key = get_parsed_path(sudoc_id)
+        contents = dump_notice(notice_json)
+        upload_bytes('sudoc', parsed_key, contents)
+        delete_previous_object(context, parsed_key)
+        state = {**state, 'filtered': False, 'parsed': True, 'parsed_key': parsed_key,
+                 'parsed_hash': get_parsed_hash(contents)}
+    if checkpoint:
+        set_notice_stage(*checkpoint, sudoc_id, 'stored', state)
+    return state
+
+
+def dump_notice(notice_json: dict) -> bytes:
+    if PARSED_FORMAT == 'json':
+        return json.dumps(notice_json, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return json.dumps(notice_json, indent=4, ensure_ascii=False).encode('utf-8')
+
+
+def get_harvest_state(sudoc_id: str, notice_xml: bytes, response=None) -> dict:
+    state = {
+        'sudoc_id': sudoc_id,
+        'harvested_at': datetime.datetime.utcnow(),
+        'content_hash': get_content_hash(notice_xml),
+        'raw_key': get_raw_path(sudoc_id)
+    }
+    if response is not None:
+        state['etag'] = response.headers.get('ETag')
+        state['last_modified'] = response.headers.get('Last-Modified')
+    return state
+
+
+def count_notice(stats: dict, notice_state: dict) -> dict:
+    stats['parsed' if notice_state['parsed'] else 'filtered'] += 1
+    return notice_state
+
+
+def iter_downloaded_notices(ids_to_download: list, known_states: dict, raw_cache: RawCache, notices_state: list,
+                            stats: dict, chunk_context: dict):
+    # yield the new or changed notices as soon as they are downloaded
+    for sudoc_id, response in fetch_notices(ids_to_download, states=known_states):
+        known_state = known_states.get(sudoc_id)
+        if response is not None and response.status_code == 304:
+            stats['unchanged'] += 1
+            continue
+        if response is None or response.status_code != 200:
+            logger.error(f'Notice {sudoc_id} could not be downloaded')
+            stats['failed'] += 1
+            continue
+        stats['fetched'] += 1
+        notice_xml = response.content
+        state = get_harvest_state(sudoc_id, notice_xml, response)
+        if known_state and known_state.get('content_hash') == state['content_hash']:
+            # same bytes as the stored notice, only refresh the validators
+            stats['unchanged'] += 1
+            notices_state.append({k: state[k] for k in ['sudoc_id', 'etag', 'last_modified']})
+            continue
+        stats['changed' if known_state else 'new'] += 1
+        raw_cache.put(sudoc_id, notice_xml)
+        yield sudoc_id, notice_xml, get_store_context(state, notice_xml, known_state, chunk_context)
+
+
+def iter_stored_notices(ids_to_parse: list, known_states: dict, raw_cache: RawCache, stats: dict,
+                        chunk_context: dict, raw_states: dict = None):
+    # yield the already harvested notices, from the local cache or the object storage
+    # raw_states are the states of notices downloaded by an interrupted run, not in Mongo yet
+    raw_states = raw_states or {}
+    notices_xml = {}
+    for sudoc_id in ids_to_parse:
+        notices_xml[sudoc_id] = raw_cache.get(sudoc_id, known_states[sudoc_id].get('content_hash'))
+    ids_missing = [sudoc_id for sudoc_id in ids_to_parse if notices_xml[sudoc_id] is None]
+    raw_paths = [get_raw_path(sudoc_id) for sudoc_id in ids_missing]
+    for sudoc_id, (_, notice_xml) in zip(ids_missing, download_bytes_batch('sudoc', raw_paths)):
+        if notice_xml is not None:
+            raw_cache.put(sudoc_id, notice_xml)
+        notices_xml[sudoc_id] = notice_xml
+    for sudoc_id in ids_to_parse:
+        if notices_xml[sudoc_id] is None:
+            logger.error(f'Notice {sudoc_id} is missing from object storage')
+            stats['failed'] += 1
+            continue
+        stats['reparsed'] += 1
+        state = raw_states.get(sudoc_id, {'sudoc_id': sudoc_id})
+        context = get_store_context(state, None, known_states[sudoc_id], chunk_context)
+        yield sudoc_id, notices_xml[sudoc_id], context
+
+
+def harvest_chunk(chunk: list, force_download: bool, force_parsing: bool, harvested: HarvestedIndex,
+                  raw_cache: RawCache, stats: dict, shard_path: str = None, checkpoint: tuple = None) -> dict:
+    # with a shard path the parsed notices of the chunk are written as one gzipped JSONL shard, return its entry
+    # with a (run_id, chunk_key) checkpoint, the notices an interrupted run already went through are not redone
+    notices_state = []
+    shard = []
+    chunk_context = {'shard_path': shard_path, 'checkpoint': checkpoint}
+    stages = get_notice_stages(*checkpoint) if checkpoint else {}
+    stored_states = {sudoc_id: state for sudoc_id, (stage, state) in stages.items() if stage == 'stored'}
+    raw_states = {sudoc_id: state for sudoc_id, (stage, state) in stages.items() if stage == 'raw'}
+    stats['resumed'] += len(stored_states) + len(raw_states)
+    notices_state += stored_states.values()
+    chunk = [sudoc_id for sudoc_id in chunk if sudoc_id not in stored_states]
+    # the known states are only needed for notices downloaded or parsed again
+    known_states = harvested.get_known_states(chunk, force_download or force_parsing or bool(raw_states))
+    for sudoc_id, state in raw_states.items():
+        known_states[sudoc_id] = {**known_states.get(sudoc_id, {'parsed_key': None}), **state}
+    ids_to_download = [sudoc_id for sudoc_id in chunk
+                       if sudoc_id not in raw_states and (force_download or sudoc_id not in known_states)]
+    notices = iter_downloaded_notices(ids_to_download, known_states, raw_cache, notices_state, stats, chunk_context)
+    ids_downloaded = set(ids_to_download)
+    # already downloaded by the interrupted run, only to be parsed and stored
+    ids_to_parse = [sudoc_id for sudoc_id in chunk if sudoc_id in raw_states]
+    if force_parsing:
+        ids_to_parse = [sudoc_id for sudoc_id in chunk if sudoc_id not in ids_downloaded]
+    notices = chain(notices, iter_stored_notices(ids_to_parse, known_states, raw_cache, stats, chunk_context,
+                                                 raw_states))
+    for notice_state in run_pipeline(notices, store_notice, stats['stages']):
+        notice_json = notice_state.pop('notice_json', None)
+        if notice_json is not None:
+            shard.append(notice_json)
+        notices_state.append(count_notice(stats, notice_state))
+    shard_entry = write_shard(shard_path, shard) if shard else None
+    # the Mongo states point to the shard, only once it is written
+    upsert_notices(notices_state, harvested.collection)
+    harvested.update(notice_state['sudoc_id'] for notice_state in notices_state)
+    return shard_entry
+
+
+def get_chunks(sudoc_ids: list) -> list:
+    return [sudoc_ids[i:i + CHUNK_SIZE] for i in range(0, len(sudoc_ids), CHUNK_SIZE)]
+
+
+def get_run_id(job) -> str:
+    # the chunk jobs of a harvest write their shards next to each other, under the id of the parent job
+    if job is None:
+        return datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    return job.meta.get('parent_id', job.id)
+
+
+def iter_chunks(sudoc_ids, seen: PpnSet = None):
+    # chunks of the sudoc ids not seen yet, in the order they are read, without holding every id in a list
+    # a plain set is enough for a list of ids, a large stream of ids is deduplicated with a PpnSet given by the caller
+    seen = set() if seen is None else seen
+    chunk = []
+    for sudoc_id in sudoc_ids:
+        if sudoc_id and sudoc_id not in seen:
+            seen.add(sudoc_id)
+            chunk.append(sudoc_id)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_harvested_index(job) -> HarvestedIndex:
+    # a chunk job uses the index loaded once by its parent, when the harvest is large enough
+    if job is not None and job.meta.get('harvested_index'):
+        harvested = HarvestedIndex.open_shared(get_collection(), job.connection, job.meta['harvested_index'])
+        if harvested is not None:
+            return harvested
+        logger.warning(f'Shared harvested index {job.meta["harvested_index"]} expired, querying Mongo instead')
+    return HarvestedIndex(get_collection())
+
+
+def harvest_notices(chunks, force_download: bool, force_parsing: bool, output_mode: str) -> dict:
+    job = get_current_job()
+    harvested = get_harvested_index(job)
+    stats = {counter: 0 for counter in HARVEST_COUNTERS}
+    stats['stages'] = get_pipeline_stats()
+    raw_cache = RawCache()
+    run_id = get_run_id(job)
+    job_id = job.id if job else run_id
+    shards = []
+    reset_job_timings()
+    with parse_executor():
+        for index, chunk in enumerate(chunks):
+            # checkpoints are kept under the id of the harvest, a job enqueued again with the same id resumes
+            checkpoint = (run_id, get_chunk_key(chunk)) if job else None
+            completed = get_completed_chunk(*checkpoint) if checkpoint else None
+            if completed is not None:
+                stats['resumed_chunks'] += 1
+                if completed['shard']:
+                    shards.append(completed['shard'])
+                continue
+            shard_path = get_shard_path(run_id, f'{job_id}-{index:05d}') if output_mode == 'shards' else None
+            shard_entry = harvest_chunk(chunk, force_download, force_parsing, harvested, raw_cache, stats, shard_path,
+                                        checkpoint)
+            if checkpoint:
+                complete_chunk(*checkpoint, {'shard': shard_entry})
+            if shard_entry:
+                shards.append(shard_entry)
+            if job:
+                job.meta['progress'] = stats
+                job.meta['timings'] = get_job_timings()
+                job.save_meta()
+    if output_mode == 'shards':
+        # a chunk job of a larger harvest leaves its own manifest, merged once every chunk is done
+        is_child = job is not None and 'parent_id' in job.meta
+        manifest = write_manifest(run_id, shards, f'manifest-{job_id}' if is_child else 'manifest')
+        stats['shards'] = {'run_id': run_id, 'nb_shards': len(shards), 'records': manifest['records']}
+    stats['raw_cache'] = raw_cache.stats
+    stats['harvested_index'] = harvested.stats
+    stats['stages'] = add_throughput(stats['stages'])
+    logger.debug(f'Harvest notices done: {stats}')
+    return stats
+
+
+def create_task_harvest_notices(sudoc_ids: list, force_download: bool = False, force_parsing: bool = True,
+                                output_mode: str = 'objects') -> dict:
     logger.debug(f'Task harvest notices for sudoc_ids {sudoc_ids}')
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f'Unknown output mode {output_mode}, expected one of {OUTPUT_MODES}')
     sudoc_ids = sudoc_ids if isinstance(sudoc_ids, list) else [sudoc_ids]
-    sudoc_ids = list(set(sudoc_ids))
-    mongo_client = pymongo.MongoClient(MONGO_HOST)
-    mongo_db = mongo_client[MONGO_DB]
-    mongo_collection = mongo_db[MONGO_COLLECTION]
-    mongo_collection.create_index('sudoc_id')
-    json_file = 'data_output.json'
-    chunk_size = 500
-    chunks = [sudoc_ids[i:i+chunk_size] for i in range(0, len(sudoc_ids), chunk_size)]
-    for chunk in chunks:
-        notices_json = []
-        ids_already_harvested = [k.get('sudoc_id') for k in list(mongo_collection.find({'sudoc_id': {'$in': chunk}}))]
-        for sudoc_id in chunk:
-            notice_xml = None
-            if force_download or sudoc_id not in ids_already_harvested:
-                notice_url = f'https://www.sudoc.fr/{sudoc_id}.xml'
-                notice_xml = requests.get(url=notice_url).text
-                current_file = open(f'{sudoc_id}.xml', 'w')
-                current_file.write(notice_xml)
-                current_file.close()
-                upload_object('sudoc', f'{sudoc_id}.xml', f'raw/{sudoc_id[-2:]}/{sudoc_id}.xml') 
-                notices_json.append({'sudoc_id': sudoc_id})
-                #set_objects(all_objects=notice_xml.encode('utf8'), container='sudoc', path=f'raw/{sudoc_id[-2:]}/{sudoc_id}.xml')
-            else:
-                download_object('sudoc', f'raw/{sudoc_id[-2:]}/{sudoc_id}.xml', f'{sudoc_id}.xml')
-            if (force_parsing or force_download) or sudoc_id not in ids_already_harvested:
-                if notice_xml is None:
-                    current_file = open(f'{sudoc_id}.xml', 'r')
-                    notice_xml = current_file.read()
-                    current_file.close()
-                soup = BeautifulSoup(notice_xml, 'lxml')
-                os.system(f'rm -rf {sudoc_id}.xml')
-                if filter_notice(soup=soup):
-                    # make sure notice not stored on object storage
-                    try:
-                        delete_object('sudoc', f'parsed/{sudoc_id[-2:]}/{sudoc_id}.json')
-                    except:
-                        pass
-                else:
-                    # we keep and parse
-                    notice_json = parse(sudoc_id, soup)
-                    out_file = open(f"{sudoc_id}.json", "w")
-                    json.dump(notice_json, out_file, indent = 4, ensure_ascii=False)
-                    out_file.close()
-                    upload_object('sudoc', f'{sudoc_id}.json', f'parsed/{sudoc_id[-2:]}/{sudoc_id}.xml')
-                    os.system(f'rm -rf {sudoc_id}.json')
-                    #json_content = json.dump(notice_json, indent=4, ensure_ascii=False)
-                    #set_objects(all_objects=json_content, container='sudoc', path=f'parsed/{sudoc_id[-2:]}/{sudoc_id}.json')
-        if notices_json:
-            with open(json_file, 'w') as file:
-                json.dump([{'sudoc_id': n['sudoc_id']} for n in notices_json], file)
-            mongoimport = f'mongoimport --numInsertionWorkers 2 --uri {MONGO_HOST}{MONGO_DB} -c {MONGO_COLLECTION} --file {json_file} --jsonArray'
-            os.system(mongoimport)
-            os.remove(json_file)
-
-
-def create_task_harvest(idrefs: list, force_download: bool = False, force_parsing: bool = True) -> None:
+    return harvest_notices(iter_chunks(sudoc_ids), force_download, force_parsing, output_mode)
+
+
+def get_sudoc_ids_path(name: str) -> str:
+    return f'{SUDOC_IDS_PREFIX}/{name}.txt'
+
+
+def upload_sudoc_ids(stream) -> str:
+    # a newline-delimited, possibly gzipped, file of sudoc ids, kept as uploaded
+    path = get_sudoc_ids_path(uuid.uuid4().hex)
+    upload_stream('sudoc', path, stream)
+    return path
+
+
+def iter_file_sudoc_ids(path: str):
+    for line in iter_object_lines('sudoc', path):
+        sudoc_id = line.decode('utf-8').strip()
+        if sudoc_id:
+            yield sudoc_id
+
+
+def write_chunk_files(job_id: str, chunks) -> list:
+    # each chunk of a large file is written back as a small file that its chunk job reads
+    paths, batch = [], []
+    for index, chunk in enumerate(chunks):
+        path = get_sudoc_ids_path(f'{job_id}/{index:05d}')
+        batch.append((path, '\n'.join(chunk).encode('utf-8')))
+        paths.append(path)
+        if len(batch) == CHUNK_FILES_BATCH_SIZE:
+            upload_bytes_batch('sudoc', batch)
+            batch = []
+    upload_bytes_batch('sudoc', batch)
+    return paths
+
+
+def create_task_harvest_notices_file(path: str, force_download: bool = False, force_parsing: bool = True,
+                                     output_mode: str = 'objects', fan_out: bool = True) -> dict:
+    # the sudoc ids are streamed from the object storage, neither the request nor the job carries them
+    logger.debug(f'Task harvest notices for sudoc_ids in {path}')
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f'Unknown output mode {output_mode}, expected one of {OUTPUT_MODES}')
+    seen = PpnSet()
+    chunks = iter_chunks(iter_file_sudoc_ids(path), seen)
+    job = get_current_job()
+    if job is None or not fan_out:
+        stats = harvest_notices(chunks, force_download, force_parsing, output_mode)
+        stats['nb_sudoc_ids'] = len(seen)
+        return stats
+    reset_job_timings()
+    chunk_paths = write_chunk_files(job.id, chunks)
+    children_args = [(chunk_path, force_download, force_parsing, output_mode, False) for chunk_path in chunk_paths]
+    result = fan_out_chunks(job, create_task_harvest_notices_file, children_args, output_mode, len(seen))
+    logger.debug(f'{len(seen)} sudoc ids from {path} split in {len(chunk_paths)} jobs')
+    return {'nb_sudoc_ids': len(seen), **result}
+
+
+def get_harvest_progress(job) -> dict:
+    # combine the results, or the progress while running, of the chunk jobs of a harvest
+    child_ids = job.meta.get('child_ids', [])
+    progress = {'chunks_total': len(child_ids), 'chunks_done': 0, 'chunks_failed': 0}
+    progress.update({counter: 0 for counter in HARVEST_COUNTERS})
+    progress['filters'] = {rule: 0 for rule in FILTER_RULES}
+    timings = [job.meta.get('timings')]
+    for child in Job.fetch_many(child_ids, connection=job.connection):
+        if child is None:
+            continue
+        timings.append(child.meta.get('timings'))
+        status = child.get_status()
+        if status == 'finished':
+            progress['chunks_done'] += 1
+        elif status == 'failed':
+            progress['chunks_failed'] += 1
+        child_stats = child.result if status == 'finished' else child.meta.get('progress')
+        for counter in HARVEST_COUNTERS:
+            progress[counter] += (child_stats or {}).get(counter, 0)
+        for rule, rule_stats in (child_stats or {}).get('stages', {}).get('filters', {}).items():
+            progress['filters'][rule] += rule_stats['count']
+    progress['timings'] = merge_timings(timings)
+    return progress
+
+
+def wait_children(parent) -> None:
+    # the aggregate released by the callback of the last chunk job may start before that job is marked as ended
+    deadline = time.time() + AGGREGATE_WAIT
+    while time.time() < deadline:
+        children = Job.fetch_many(parent.meta.get('child_ids', []), connection=parent.connection)
+        if all(child is None or child.get_status() in ENDED_STATUSES for child in children):
+            return
+        time.sleep(1)
+
+
+def create_task_aggregate(job_id: str) -> dict:
+    job = get_current_job()
+    parent = Job.fetch(job_id, connection=job.connection)
+    wait_children(parent)
+    summary = get_harvest_progress(parent)
+    if parent.meta.get('output_mode') == 'shards':
+        manifest = merge_manifests(parent.id, [f'manifest-{child_id}' for child_id in parent.meta['child_ids']])
+        summary['shards'] = {'run_id': parent.id, 'nb_shards': len(manifest['shards']), 'records': manifest['records']}
+    parent.meta['summary'] = summary
+    parent.save_meta()
+    if parent.meta.get('harvested_index'):
+        delete_shared(job.connection, parent.meta['harvested_index'])
+    logger.debug(f'Harvest {job_id} done: {summary}')
+    return summary
+
+
+def get_chunks_keys(parent_id: str) -> tuple:
+    # the chunk jobs and the aggregate of the last fan-out of a harvest, and the chunk jobs that ended or failed
+    key = f'rq:job:{parent_id}:chunks'
+    return key, f'{key}:ended', f'{key}:failed'
+
+
+def end_chunk(job, connection, failed: bool) -> None:
+    # the aggregate only depends on chunk jobs that succeed, the last chunk job to end releases it after a failure
+    # a chunk job whose success callback raised ends a second time as failed, each job is only counted once
+    parent_id = job.meta['parent_id']
+    parent = Job.fetch(parent_id, connection=connection)
+    if job.id not in parent.meta.get('child_ids', []):
+        # left by an interrupted run of the harvest
+        return
+    _, ended_key, failed_key = get_chunks_keys(parent_id)
+    pipeline = connection.pipeline()
+    pipeline.sadd(ended_key, job.id)
+    if failed:
+        pipeline.sadd(failed_key, job.id)
+    pipeline.scard(ended_key)
+    pipeline.scard(failed_key)
+    pipeline.expire(ended_key, RESULT_TTL)
+    pipeline.expire(failed_key, RESULT_TTL)
+    results = pipeline.execute()
+    ended, nb_failed = results[-4:-2]
+    if not any(results[:-4]):
+        return
+    if ended < len(parent.meta['child_ids']) or nb_failed == 0:
+        return
+    aggregate = Job.fetch(parent.meta['aggregate_id'], connection=connection)
+    if aggregate.get_status() == JobStatus.DEFERRED:
+        logger.debug(f'{nb_failed} chunk jobs of {parent_id} failed, releasing its aggregate')
+        DeferredJobRegistry(aggregate.origin, connection=connection).remove(aggregate)
+        Queue(aggregate.origin, connection=connection).enqueue_job(aggregate)
+
+
+def on_chunk_success(job, connection, result) -> None:
+    end_chunk(job, connection, False)
+
+
+def on_chunk_failure(job, connection, exc_type, exc_value, exc_traceback) -> None:
+    end_chunk(job, connection, True)
+
+
+def share_harvested_index(job, nb_sudoc_ids: int) -> str:
+    # the chunk jobs each see a few hundred ids, the size of the whole harvest decides whether to load the index
+    if nb_sudoc_ids <= HARVESTED_INDEX_MIN_IDS:
+        return None
+    harvested = HarvestedIndex(get_collection())
+    harvested.load()
+    key = get_shared_key(job.id)
+    harvested.save(job.connection, key, RESULT_TTL)
+    return key
+
+
+def cancel_previous_fan_out(job) -> None:
+    # a harvest enqueued again under the same id replaces the chunk jobs and the aggregate of the interrupted run
+    # RQ gave the job a new meta, the previous fan-out is read from its chunks key
+    fan_out_key, ended_key, failed_key = get_chunks_keys(job.id)
+    previous = {key.decode('utf-8'): value.decode('utf-8')
+                for key, value in job.connection.hgetall(fan_out_key).items()}
+    if previous:
+        job_ids = json.loads(previous['child_ids']) + [previous['aggregate_id']]
+        cancelled = 0
+        for previous_job in Job.fetch_many(job_ids, connection=job.connection):
+            if previous_job is None or previous_job.get_status() in ENDED_STATUSES:
+                continue
+            if previous_job.get_status() == JobStatus.STARTED:
+                try:
+                    send_stop_job_command(job.connection, previous_job.id)
+                except InvalidJobOperation:
+                    # its worker is gone
+                    pass
+            previous_job.delete()
+            cancelled += 1
+        if previous.get('harvested_index'):
+            delete_shared(job.connection, previous['harvested_index'])
+        logger.debug(f'{cancelled} jobs of the previous run of {job.id} cancelled')
+    job.connection.delete(fan_out_key, ended_key, failed_key)
+
+
+def fan_out_chunks(job, function, children_args: list, output_mode: str, nb_sudoc_ids: int) -> dict:
+    # one job per chunk so that every worker of the queue takes part in a large harvest
+    # the parent knows its chunk jobs and its aggregate before the first chunk job can end
+    cancel_previous_fan_out(job)
+    queue = Queue(job.origin, connection=job.connection)
+    meta = {'parent_id': job.id, 'harvested_index': share_harvested_index(job, nb_sudoc_ids)}
+    children = [queue.create_job(function, args=args, timeout=CHUNK_TIMEOUT, result_ttl=RESULT_TTL, meta=meta,
+                                 on_success=on_chunk_success, on_failure=on_chunk_failure)
+                for args in children_args]
+    pipeline = job.connection.pipeline()
+    for child in children:
+        child.save(pipeline=pipeline)
+    pipeline.execute()
+    aggregate = queue.create_job(create_task_aggregate, args=(job.id,), depends_on=children, result_ttl=RESULT_TTL)
+    queue.setup_dependencies(aggregate)
+    job.meta['child_ids'] = [child.id for child in children]
+    job.meta['aggregate_id'] = aggregate.id
+    job.meta['harvested_index'] = meta['harvested_index']
+    job.meta['timings'] = get_job_timings()
+    job.meta['output_mode'] = output_mode
+    job.save_meta()
+    fan_out_key, _, _ = get_chunks_keys(job.id)
+    pipeline = job.connection.pipeline()
+    pipeline.hset(fan_out_key, mapping={'child_ids': json.dumps(job.meta['child_ids']), 'aggregate_id': aggregate.id,
+                                        'harvested_index': meta['harvested_index'] or ''})
+    pipeline.expire(fan_out_key, RESULT_TTL)
+    for child in children:
+        queue.enqueue_job(child, pipeline=pipeline)
+    pipeline.execute()
+    return {'child_ids': job.meta['child_ids'], 'aggregate_id': aggregate.id}
+
+
+def create_task_harvest(idrefs: list, force_download: bool = False, force_parsing: bool = True,
+                        output_mode: str = 'objects') -> dict:
     logger.debug(f'Task harvest for idrefs {idrefs}')
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f'Unknown output mode {output_mode}, expected one of {OUTPUT_MODES}')
     idrefs = idrefs if isinstance(idrefs, list) else [idrefs]
     idrefs = list(set(idrefs))
-    sudoc_ids = []
-    for idref in idrefs:
-        sudoc_ids += get_sudoc_ids(idref=idref)
-    create_task_harvest_notices(sudoc_ids, force_download, force_parsing)
+    reset_job_timings()
+    sudoc_ids = set()
+    for ids in resolve_idrefs(idrefs).values():
+        sudoc_ids.update(ids)
+    sudoc_ids = sorted(sudoc_ids)
+    job = get_current_job()
+    if job is None:
+        return create_task_harvest_notices(sudoc_ids, force_download, force_parsing, output_mode)
+    children_args = [(chunk, force_download, force_parsing, output_mode) for chunk in get_chunks(sudoc_ids)]
+    result = fan_out_chunks(job, create_task_harvest_notices, children_args, output_mode, len(sudoc_ids))
+    logger.debug(f'{len(sudoc_ids)} sudoc ids split in {len(children_args)} jobs')
+    return {'nb_sudoc_ids': len(sudoc_ids), **result}
+
+
+def save_dump_batch(batch: list) -> None:
+    parsed = {sudoc_id: dump_notice(notice_json) for sudoc_id, _, notice_json in batch if notice_json is not None}
+    objects = [(get_raw_path(sudoc_id), notice_xml) for sudoc_id, notice_xml, _ in batch]
+    objects += [(get_parsed_path(sudoc_id), contents) for sudoc_id, contents in parsed.items()]
+    upload_bytes_batch('sudoc', objects)
+    # make sure filtered notices are not stored on object storage
+    delete_objects('sudoc', [get_parsed_path(sudoc_id) for sudoc_id, _, notice_json in batch if notice_json is None])
+    upsert_notices([{
+        **get_harvest_state(sudoc_id, notice_xml),
+        'filtered': notice_json is None,
+        'parsed': notice_json is not None,
+        'parsed_key': get_parsed_path(sudoc_id) if notice_json is not None else None,
+        'parsed_hash': get_parsed_hash(parsed[sudoc_id]) if notice_json is not None else None
+    } for sudoc_id, notice_xml, notice_json in batch])
+
+
+def create_task_harvest_dump(path: str, batch_size: int = DUMP_BATCH_SIZE) -> dict:
+    logger.debug(f'Task harvest dump {path}')
+    stats = {'records': 0, 'parsed': 0, 'filtered': 0, 'skipped': 0, 'filters': {rule: 0 for rule in FILTER_RULES}}
+    start = time.time()
+    batch = []
+    for record in iter_marcxml_records(path):
+        stats['records'] += 1
+        notice = index_element(record)
+        sudoc_id = notice['controlfields'].get('001', '').strip()
+        if not sudoc_id:
+            stats['skipped'] += 1
+            continue
+        notice_xml = etree.tostring(record, encoding='utf-8', xml_declaration=True)
+        reason = get_filter_reason(notice)
+        if reason:
+            stats['filtered'] += 1
+            stats['filters'][reason] += 1
+            batch.append((sudoc_id, notice_xml, None))
+        else:
+            stats['parsed'] += 1
+            batch.append((sudoc_id, notice_xml, parse(sudoc_id, notice)))
+        if len(batch) >= batch_size:
+            save_dump_batch(batch)
+            batch = []
+            logger.debug(f'{stats["records"]} records read from {path}, '
+                         f'{stats["records"] / (time.time() - start):.1f} records/sec')
+    if batch:
+        save_dump_batch(batch)
+    stats['duration'] = time.time() - start
+    stats['records_per_second'] = stats['records'] / stats['duration'] if stats['duration'] else 0
+    logger.debug(f'Dump {path} harvested: {stats}')
+    return stats
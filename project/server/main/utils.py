@@ -0,0 +1,39 @@
+import hashlib
+import os
+
+from operator import mul
+
+PPN_WEIGHTS = (9, 8, 7, 6, 5, 4, 3, 2)
+# per-notice parsed objects are indented JSON under a .xml key, as read downstream, unless PARSED_FORMAT is json:
+# compact JSON under a .json key, every notice being rewritten once by a reparse after the switch
+PARSED_FORMAT = os.getenv('PARSED_FORMAT', 'legacy')
+PARSED_EXTENSIONS = {'legacy': 'xml', 'json': 'json'}
+
+
+def get_raw_path(sudoc_id: str) -> str:
+    return f'raw/{sudoc_id[-2:]}/{sudoc_id}.xml'
+
+
+def get_parsed_path(sudoc_id: str) -> str:
+    return f'parsed/{sudoc_id[-2:]}/{sudoc_id}.{PARSED_EXTENSIONS[PARSED_FORMAT]}'
+
+
+def get_legacy_parsed_path(sudoc_id: str) -> str:
+    return f'parsed/{sudoc_id[-2:]}/{sudoc_id}.xml'
+
+
+def get_content_hash(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_parsed_hash(content: bytes) -> str:
+    # md5, as the etag of the object storage, so that both can be compared
+    return hashlib.md5(content).hexdigest()
+
+
+def get_ppn_check_digit(ppn_base: str) -> str:
+    # modulo 11 check character of the 8 first digits of a PPN
+    # weighting the ASCII codes gives the same remainder, as 48 * sum(PPN_WEIGHTS) = 2112 = 11 * 192
+    remainder = sum(map(mul, ppn_base.encode(), PPN_WEIGHTS)) % 11
+    check = (11 - remainder) % 11
+    return 'X' if check == 10 else str(check)
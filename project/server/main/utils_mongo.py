@@ -0,0 +1,79 @@
+import os
+import pymongo
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from project.server.main.logger import get_logger
+from project.server.main.metrics import instrumented
+
+logger = get_logger(__name__)
+
+MONGO_HOST = os.getenv('MONGO_HOST', 'mongodb://mongo:27017/')
+MONGO_DB = 'harvest'
+MONGO_COLLECTION = 'sudoc'
+
+client = {'pid': None, 'client': None}
+collections_indexed = set()
+
+
+def get_client() -> pymongo.MongoClient:
+    # MongoClient is not fork safe, a forked worker opens its own
+    if client['pid'] != os.getpid():
+        client['client'] = pymongo.MongoClient(MONGO_HOST)
+        client['pid'] = os.getpid()
+        collections_indexed.clear()
+    return client['client']
+
+
+def reset_client() -> None:
+    if client['client'] is not None and client['pid'] == os.getpid():
+        client['client'].close()
+    client['pid'] = None
+    client['client'] = None
+
+
+def remove_duplicates(collection) -> None:
+    # older mongoimport runs inserted one document per harvest, keep the first one only
+    pipeline = [{'$group': {'_id': '$sudoc_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}}]
+    for duplicate in collection.aggregate(pipeline, allowDiskUse=True):
+        collection.delete_many({'_id': {'$in': duplicate['ids'][1:]}})
+
+
+def create_indexes(collection) -> None:
+    try:
+        collection.create_index('sudoc_id', unique=True)
+    except OperationFailure as error:
+        raise RuntimeError(f'The sudoc_id index of {collection.name} cannot be made unique, '
+                           f'run python manage.py migrate_indexes: {error}') from error
+
+
+def migrate_indexes(collection) -> None:
+    # collections from before the unique sudoc_id index may hold duplicates and a non-unique index
+    remove_duplicates(collection)
+    if not collection.index_information().get('sudoc_id_1', {'unique': True}).get('unique'):
+        logger.debug(f'Rebuilding sudoc_id index as unique on {collection.name}')
+        collection.drop_index('sudoc_id_1')
+    collection.create_index('sudoc_id', unique=True)
+
+
+def get_collection(name: str = MONGO_COLLECTION):
+    collection = get_client()[MONGO_DB][name]
+    if name not in collections_indexed:
+        create_indexes(collection)
+        collections_indexed.add(name)
+    return collection
+
+
+@instrumented('mongo_write')
+def upsert_notices(notices: list, collection=None) -> None:
+    # each notice is a dict of fields to set, keyed on its sudoc_id
+    if not notices:
+        return
+    collection = collection if collection is not None else get_collection()
+    operations = [UpdateOne({'sudoc_id': notice['sudoc_id']}, {'$set': notice}, upsert=True) for notice in notices]
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as error:
+        logger.error(f'Error while upserting {len(notices)} notices: {error.details.get("writeErrors", [])[:10]}')
@@ -0,0 +1,19 @@
+import os
+import redis
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
+client = {'pid': None, 'client': None}
+
+
+def get_redis() -> redis.Redis:
+    # connections are not shared with forked processes
+    if client['pid'] != os.getpid():
+        client['client'] = redis.from_url(REDIS_URL)
+        client['pid'] = os.getpid()
+    return client['client']
+
+
+def reset_redis() -> None:
+    client['pid'] = None
+    client['client'] = None
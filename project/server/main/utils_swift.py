@@ -1,13 +1,18 @@
+import codecs
 import hashlib
+import json
 import os
-import pandas as pd
 import swiftclient
+import threading
+import zlib
 from retry import retry
-import subprocess
 
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 from project.server.main.logger import get_logger
+from project.server.main.metrics import RetryLogger, instrumented
+from project.server.main.storage_manifest import get_object_info, is_missing, record_delete, record_upload
 
 logger = get_logger(__name__)
 
@@ -16,38 +21,102 @@ key = os.getenv('OS_PASSWORD')
 project_id = os.getenv('OS_TENANT_ID')
 project_name = os.getenv('OS_PROJECT_NAME')
 
-init_cmd = f"swift --os-auth-url https://auth.cloud.ovh.net/v3 --auth-version 3 \
-      --key {key}\
-      --user {user} \
-      --os-user-domain-name Default \
-      --os-project-domain-name Default \
-      --os-project-id {project_id} \
-      --os-project-name {project_name} \
-      --os-region-name GRA"
-
-conn = swiftclient.Connection(
-    authurl='https://auth.cloud.ovh.net/v3',
-    user=user,
-    key=key,
-    os_options={
-            'user_domain_name': 'Default',
-            'project_domain_name': 'Default',
-            'project_id': project_id,
-            'project_name': project_name,
-            'region_name': 'GRA'},
-    auth_version='3'
-)
-
-
-@retry(delay=2, tries=50)
+auth_url = os.getenv('OS_AUTH_URL', 'https://auth.cloud.ovh.net/v3')
+region_name = os.getenv('OS_REGION_NAME', 'GRA')
+# a pre-authenticated storage url and token skip Keystone, e.g. against a local Swift stub
+storage_url = os.getenv('OS_STORAGE_URL')
+auth_token = os.getenv('OS_AUTH_TOKEN')
+SWIFT_MAX_WORKERS = int(os.getenv('SWIFT_MAX_WORKERS', 16))
+SWIFT_CHUNK_SIZE = int(os.getenv('SWIFT_CHUNK_SIZE', 1024 * 1024))
+SWIFT_LISTING_LIMIT = 10000
+
+# token shared by the connections of every thread, refreshed by swiftclient on expiry
+auth = {'url': storage_url, 'token': auth_token}
+local = threading.local()
+
+
+def create_connection() -> swiftclient.Connection:
+    return swiftclient.Connection(
+        authurl=auth_url,
+        user=user,
+        key=key,
+        os_options={
+                'user_domain_name': 'Default',
+                'project_domain_name': 'Default',
+                'project_id': project_id,
+                'project_name': project_name,
+                'region_name': region_name},
+        auth_version='3',
+        preauthurl=auth['url'],
+        preauthtoken=auth['token']
+    )
+
+
+def get_connection() -> swiftclient.Connection:
+    # swiftclient connections are not thread safe, each thread keeps its own
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = create_connection()
+        local.connection = connection
+    if connection.token is None:
+        if auth['token']:
+            connection.url, connection.token = auth['url'], auth['token']
+        else:
+            auth['url'], auth['token'] = connection.get_auth()
+    return connection
+
+
+def reset_connection() -> None:
+    # drop the connection of the thread and a pre-authenticated token that may have expired
+    connection = getattr(local, 'connection', None)
+    if connection is not None:
+        connection.close()
+        local.connection = None
+    if not storage_url:
+        auth['url'], auth['token'] = None, None
+
+
+def run_in_threads(function, items: list, max_workers: int = SWIFT_MAX_WORKERS):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(function, items)
+
+
 def exists_in_storage(container, filename):
+    if is_missing(container, filename):
+        return False
+    if get_object_info(container, filename) is not None:
+        return True
+    return head_object(container, filename)
+
+
+@retry(delay=2, tries=50, logger=RetryLogger('swift_head'))
+@instrumented('swift_head')
+def head_object(container, filename):
     try:
-        conn.head_object(container, filename)
+        get_connection().head_object(container, filename)
         return True
     except:
         return False
 
 
+@retry(delay=2, tries=50, logger=RetryLogger('swift_head'))
+@instrumented('swift_head')
+def get_object_etag(container: str, filename: str) -> str:
+    # None for a missing object, the etag found is kept in the storage manifest
+    if is_missing(container, filename):
+        return None
+    try:
+        headers = get_connection().head_object(container, filename)
+    except swiftclient.ClientException as error:
+        if error.http_status == 404:
+            record_delete(container, filename)
+            return None
+        raise
+    size = headers.get('content-length')
+    record_upload(container, filename, int(size) if size else None, headers.get('etag'))
+    return headers.get('etag')
+
+
 def get_hash(x):
     return hashlib.md5(x.encode('utf-8')).hexdigest()
 
@@ -60,65 +129,285 @@ def get_filename(doi):
     return filename
 
 
-@retry(delay=2, tries=50)
+@retry(delay=2, tries=50, logger=RetryLogger('swift_download'))
 def get_data_from_ovh(doi=None, filename=None, container='landing-page-html'):
     if doi:
         filename = get_filename(doi)
-    if exists_in_storage(container, filename) is False:
-        logger.debug("ERROR : missing file")
-        return {}
     if filename is None:
         logger.debug("ERROR : missing file")
         return {}
-    df_notice = pd.read_json(BytesIO(conn.get_object(container, filename)[1]), compression='gzip')
-    return df_notice.to_dict(orient='records')[0]
+    # only the first record is kept, the rest of the object is not downloaded
+    records = iter_object_records(container, filename)
+    try:
+        return next(records, {})
+    finally:
+        records.close()
 
 
-@retry(delay=2, tries=50)
+@retry(delay=2, tries=50, logger=RetryLogger('swift_download'))
+@instrumented('swift_download')
 def get_objects(container, path):
+    # as before, a missing or unreadable object gives no records
     try:
-        df = pd.read_json(BytesIO(conn.get_object(container, path)[1]), compression='gzip')
-    except:
-        df = pd.DataFrame([])
-    return df.to_dict('records')
+        return list(iter_object_records(container, path))
+    except Exception as error:
+        logger.error(f'Error while reading {path} from {container}: {error}')
+        return []
+
 
+def get_objects_batch(container: str, paths: list, max_workers: int = SWIFT_MAX_WORKERS):
+    # yield (path, records) in the order of paths
+    yield from zip(paths, run_in_threads(lambda p: get_objects(container, p), paths, max_workers))
 
-@retry(delay=2, tries=50)
+
+@retry(delay=2, tries=50, logger=RetryLogger('swift_upload'))
+@instrumented('swift_upload')
 def set_objects(all_objects, container, path):
     logger.debug(f'Setting object {container} {path}')
-    conn.put_object(container, path, contents=all_objects, headers={})
+    etag = get_connection().put_object(container, path, contents=all_objects, headers={})
+    record_upload(container, path, len(all_objects) if isinstance(all_objects, (bytes, str)) else None, etag)
     logger.debug('Done')
     return
 
 
-@retry(delay=2, tries=50)
+@retry(delay=2, tries=50, logger=RetryLogger('swift_delete'))
 def delete_folder(cont_name, folder):
-    cont = conn.get_container(cont_name)
+    cont = get_connection().get_container(cont_name)
     for n in [e['name'] for e in cont[1] if folder in e['name']]:
         print(n)
-        conn.delete_object(cont_name, n)
+        get_connection().delete_object(cont_name, n)
+
+@retry(delay=3, tries=50, backoff=2, logger=RetryLogger('swift_upload'))
+@instrumented('swift_upload')
+def upload_bytes(container: str, destination: str, contents: bytes) -> str:
+    logger.debug(f'Uploading {len(contents)} bytes in {container} as {destination}')
+    etag = get_connection().put_object(container, destination, contents=contents)
+    record_upload(container, destination, len(contents), etag)
+    return f'{auth["url"]}/{container}/{destination}'
+
+
+def download_bytes(container: str, filename: str) -> bytes:
+    if is_missing(container, filename):
+        return None
+    return get_object_bytes(container, filename)
+
+
+@retry(delay=3, tries=50, backoff=2, logger=RetryLogger('swift_download'))
+@instrumented('swift_download')
+def get_object_bytes(container: str, filename: str) -> bytes:
+    logger.debug(f'Downloading {filename} from {container}')
+    try:
+        return get_connection().get_object(container, filename)[1]
+    except swiftclient.ClientException as error:
+        if error.http_status == 404:
+            logger.debug(f'Missing {filename} in {container}')
+            record_delete(container, filename)
+            return None
+        raise
+
+
+def delete_object(container: str, filename: str) -> bool:
+    # return False when the object is known to be missing, a missing object otherwise raises a 404 ClientException
+    if is_missing(container, filename):
+        return False
+    try:
+        delete_storage_object(container, filename)
+    except swiftclient.ClientException as error:
+        if error.http_status == 404:
+            record_delete(container, filename)
+        raise
+    record_delete(container, filename)
+    return True
+
+
+@instrumented('swift_delete')
+def delete_storage_object(container: str, filename: str) -> None:
+    logger.debug(f'Deleting {filename} from {container}')
+    get_connection().delete_object(container, filename)
+
+
+def upload_bytes_batch(container: str, objects: list, max_workers: int = SWIFT_MAX_WORKERS) -> list:
+    # objects is a list of (destination, contents)
+    return list(run_in_threads(lambda o: upload_bytes(container, o[0], o[1]), objects, max_workers))
+
+
+def download_bytes_batch(container: str, filenames: list, max_workers: int = SWIFT_MAX_WORKERS):
+    # yield (filename, contents) in the order of filenames, contents is None for missing objects
+    yield from zip(filenames, run_in_threads(lambda f: download_bytes(container, f), filenames, max_workers))
+
+
+def delete_objects(container: str, filenames: list, max_workers: int = SWIFT_MAX_WORKERS) -> list:
+    # return the filenames that were actually deleted
+    def _delete(filename):
+        try:
+            return filename if delete_object(container, filename) else None
+        except swiftclient.ClientException as error:
+            if error.http_status != 404:
+                logger.error(f'Error while deleting {filename} from {container}: {error}')
+            return None
+    filenames = [filename for filename in filenames if not is_missing(container, filename)]
+    return list(filter(None, run_in_threads(_delete, filenames, max_workers)))
+
+
+@retry(delay=3, tries=50, backoff=2, logger=RetryLogger('swift_download'))
+@instrumented('swift_download')
+def open_object(container: str, filename: str, chunk_size: int = SWIFT_CHUNK_SIZE):
+    # return an iterator over the chunks of the object body, None for a missing object
+    if is_missing(container, filename):
+        return None
+    try:
+        return get_connection().get_object(container, filename, resp_chunk_size=chunk_size)[1]
+    except swiftclient.ClientException as error:
+        if error.http_status == 404:
+            logger.debug(f'Missing {filename} in {container}')
+            return None
+        raise
+
+
+def iter_gunzipped(chunks):
+    # a gzip file may hold several members one after the other, e.g. when files were concatenated,
+    # and be padded with zeros, as gzip allows
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    started = False
+    for chunk in chunks:
+        while chunk:
+            if not started:
+                chunk = chunk.lstrip(b'\x00')
+                started = bool(chunk)
+                if not started:
+                    break
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            yield decompressor.flush()
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            started = False
+    if started:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def iter_decompressed(chunks):
+    # gzip is detected from the magic bytes at the start of the object
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 2:
+            break
+    if head[:2] == b'\x1f\x8b':
+        yield from iter_gunzipped(chain([head], chunks))
+    else:
+        yield head
+        yield from chunks
+
+
+def iter_lines(chunks):
+    buffer = b''
+    for chunk in iter_decompressed(chunks):
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        yield from lines
+    yield from buffer.split(b'\n')
+
+
+def iter_json_records(chunks):
+    # records of a JSON array, of JSON lines or of a single JSON document, decoded as the chunks arrive
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer, position, in_array = '', 0, None
+    chunks = iter_decompressed(chunks)
+    done = False
+    while not done:
+        chunk = next(chunks, None)
+        done = chunk is None
+        buffer = buffer[position:] + text_decoder.decode(chunk or b'', final=done)
+        position = 0
+        while True:
+            # skip the separators between the records
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[position] == '['
+                if in_array:
+                    position += 1
+                    continue
+            if in_array and buffer[position] == ']':
+                position += 1
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if done:
+                    raise
+                break
+            if not done and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                # a number may go on in the next chunk
+                break
+            position = end
+            yield record
+
+
+def iter_object_lines(container: str, filename: str, chunk_size: int = SWIFT_CHUNK_SIZE):
+    # stream the lines of a (gzipped) object without holding the whole object in memory
+    chunks = open_object(container, filename, chunk_size)
+    if chunks is None:
+        raise FileNotFoundError(f'{filename} not found in {container}')
+    yield from iter_lines(chunks)
+
+
+def iter_object_records(container: str, filename: str, chunk_size: int = SWIFT_CHUNK_SIZE):
+    # stream the records of a (gzipped) JSON or JSONL object, nothing for a missing object
+    chunks = open_object(container, filename, chunk_size)
+    if chunks is None:
+        return
+    yield from iter_json_records(chunks)
+
+
+def iter_jsonl_records(container: str, filename: str, chunk_size: int = SWIFT_CHUNK_SIZE):
+    for line in iter_object_lines(container, filename, chunk_size):
+        if line.strip():
+            yield json.loads(line)
+
+
+@instrumented('swift_upload')
+def upload_stream(container: str, destination: str, stream, chunk_size: int = SWIFT_CHUNK_SIZE) -> str:
+    # sent with a chunked transfer encoding as it is read, not retried as the stream cannot be read again
+    logger.debug(f'Uploading stream in {container} as {destination}')
+    etag = get_connection().put_object(container, destination, contents=stream, chunk_size=chunk_size)
+    record_upload(container, destination, None, etag)
+    return f'{auth["url"]}/{container}/{destination}'
+
+
+@retry(delay=3, tries=50, backoff=2, logger=RetryLogger('swift_list'))
+@instrumented('swift_list')
+def list_objects(container: str, prefix: str, marker: str = '', limit: int = SWIFT_LISTING_LIMIT) -> list:
+    return get_connection().get_container(container, prefix=prefix, marker=marker, limit=limit)[1]
+
+
+def iter_listing_pages(container: str, prefix: str, limit: int = SWIFT_LISTING_LIMIT):
+    # pages of {'name', 'bytes', 'hash', ...}, each one starting after the last name of the previous one
+    marker = ''
+    while True:
+        page = list_objects(container, prefix, marker, limit)
+        if not page:
+            return
+        yield page
+        marker = page[-1]['name']
+
 
-@retry(delay=3, tries=50, backoff=2)
 def upload_object(container: str, filename: str, destination: str) -> str:
     if destination is None:
         destination = filename.split('/')[-1]
-    logger.debug(f'Uploading {filename} in {container} as {destination}')
-    cmd = init_cmd + f' upload {container} {filename} --object-name {destination}' \
-                     f' --segment-size 1048576000 --segment-threads 100'
-    #os.system(cmd)
-    r = subprocess.check_output(cmd, shell=True)
-    return f'https://storage.gra.cloud.ovh.net/v1/AUTH_{project_id}/{container}/{destination}'
+    with open(filename, 'rb') as f:
+        return upload_bytes(container, destination, f.read())
 
 
-@retry(delay=3, tries=50, backoff=2)
 def download_object(container: str, filename: str, out: str) -> None:
-    logger.debug(f'Downloading {filename} from {container} to {out}')
-    cmd = init_cmd + f' download {container} {filename} -o {out}'
-    #os.system(cmd)
-    r = subprocess.check_output(cmd, shell=True)
-
-def delete_object(container: str, filename: str) -> None:
-    logger.debug(f'Deleting {filename} from {container}')
-    cmd = init_cmd + f' delete {container} {filename}'
-    #os.system(cmd)
-    r = subprocess.check_output(cmd, shell=True)
+    contents = download_bytes(container, filename)
+    if contents is None:
+        raise FileNotFoundError(f'{filename} not found in {container}')
+    with open(out, 'wb') as f:
+        f.write(contents)
@@ -1,10 +1,14 @@
 import redis
 
-from flask import Blueprint, current_app, jsonify, render_template, request
+from flask import Blueprint, Response, current_app, jsonify, render_template, request
 from rq import Connection, Queue
 
 from project.server.main.logger import get_logger
-from project.server.main.tasks import create_task_harvest, create_task_harvest_notices
+from project.server.main.metrics import get_metrics
+from project.server.main.parse_cache import PARSE_MAX_NOTICES, cache, parse_notices_xml, parse_sudoc_ids
+from project.server.main.reparse import create_task_reparse
+from project.server.main.tasks import RESULT_TTL, create_task_harvest, create_task_harvest_notices, \
+    create_task_harvest_notices_file, get_harvest_progress, upload_sudoc_ids
 
 
 main_blueprint = Blueprint('main', __name__,)
@@ -24,10 +28,13 @@ def run_task_harvest():
     idrefs = args.get('idrefs')
     force_download = args.get('force_download', False)
     force_parsing = args.get('force_parsing', True)
+    output_mode = args.get('output_mode', 'objects')
+    job_id = args.get('job_id')
     if idrefs:
         with Connection(redis.from_url(current_app.config['REDIS_URL'])):
             q = Queue(REDIS_QUEUE, default_timeout=2160000)
-            task = q.enqueue(create_task_harvest, idrefs, force_download, force_parsing)
+            task = q.enqueue(create_task_harvest, idrefs, force_download, force_parsing, output_mode, job_id=job_id,
+                             result_ttl=RESULT_TTL)
         response_object = {
             'status': 'success',
             'data': {
@@ -48,12 +55,20 @@ def run_task_harvest_notices():
     args = request.get_json(force=False)
     logger.debug(args)
     sudoc_ids = args.get('sudoc_ids')
+    sudoc_ids_path = args.get('sudoc_ids_path')
     force_download = args.get('force_download', False)
     force_parsing = args.get('force_parsing', True)
-    if sudoc_ids:
+    output_mode = args.get('output_mode', 'objects')
+    job_id = args.get('job_id')
+    if sudoc_ids or sudoc_ids_path:
         with Connection(redis.from_url(current_app.config['REDIS_URL'])):
             q = Queue(REDIS_QUEUE, default_timeout=21600)
-            task = q.enqueue(create_task_harvest_notices, sudoc_ids, force_download, force_parsing)
+            if sudoc_ids_path:
+                task = q.enqueue(create_task_harvest_notices_file, sudoc_ids_path, force_download, force_parsing,
+                                 output_mode, job_id=job_id, result_ttl=RESULT_TTL)
+            else:
+                task = q.enqueue(create_task_harvest_notices, sudoc_ids, force_download, force_parsing, output_mode,
+                                 job_id=job_id)
         response_object = {
             'status': 'success',
             'data': {
@@ -69,6 +84,77 @@ def run_task_harvest_notices():
     return jsonify(response_object)
 
 
+@main_blueprint.route('/harvest_notices/upload', methods=['POST'])
+def run_task_harvest_notices_upload():
+    # the body, or the "file" field of a form, is a newline-delimited and possibly gzipped list of sudoc ids
+    # it is streamed to the object storage and the job only references it
+    args = request.args
+    force_download = args.get('force_download', 'false').lower() == 'true'
+    force_parsing = args.get('force_parsing', 'true').lower() == 'true'
+    output_mode = args.get('output_mode', 'objects')
+    job_id = args.get('job_id')
+    stream = request.files['file'].stream if 'file' in request.files else request.stream
+    sudoc_ids_path = upload_sudoc_ids(stream)
+    with Connection(redis.from_url(current_app.config['REDIS_URL'])):
+        q = Queue(REDIS_QUEUE, default_timeout=21600)
+        task = q.enqueue(create_task_harvest_notices_file, sudoc_ids_path, force_download, force_parsing,
+                         output_mode, job_id=job_id, result_ttl=RESULT_TTL)
+    response_object = {
+        'status': 'success',
+        'data': {
+            'task_id': task.get_id(),
+            'sudoc_ids_path': sudoc_ids_path
+        }
+    }
+    return jsonify(response_object)
+
+
+@main_blueprint.route('/reparse', methods=['POST'])
+def run_task_reparse():
+    # every raw notice when neither sudoc_ids nor sudoc_ids_path is given
+    args = request.get_json(force=True, silent=True) or {}
+    logger.debug(args)
+    with Connection(redis.from_url(current_app.config['REDIS_URL'])):
+        q = Queue(REDIS_QUEUE, default_timeout=2160000)
+        task = q.enqueue(create_task_reparse, args.get('sudoc_ids'), args.get('sudoc_ids_path'),
+                         args.get('dry_run', False))
+    response_object = {
+        'status': 'success',
+        'data': {
+            'task_id': task.get_id()
+        }
+    }
+    return jsonify(response_object)
+
+
+@main_blueprint.route('/parse', methods=['POST'])
+def run_parse():
+    # synchronous parsing of a few notices, by sudoc id or as raw MARCXML, for interactive use
+    if request.mimetype in ['application/xml', 'text/xml']:
+        args = {'notices': [request.get_data()]}
+    else:
+        args = request.get_json(force=True)
+    sudoc_ids = args.get('sudoc_ids', [])
+    sudoc_ids = sudoc_ids if isinstance(sudoc_ids, list) else [sudoc_ids]
+    notices = args.get('notices', [])
+    notices = notices if isinstance(notices, list) else [notices]
+    if not sudoc_ids and not notices:
+        logger.error('Missing "sudoc_ids" or "notices" argument in the "/parse" request')
+        return jsonify({'status': 'error', 'message': 'Missing "sudoc_ids" or "notices" argument'})
+    if len(sudoc_ids) + len(notices) > PARSE_MAX_NOTICES:
+        message = f'At most {PARSE_MAX_NOTICES} notices per request, use "/harvest_notices" for more'
+        return jsonify({'status': 'error', 'message': message})
+    results = parse_sudoc_ids(sudoc_ids, refresh=args.get('refresh', False)) + parse_notices_xml(notices)
+    response_object = {
+        'status': 'success',
+        'data': {
+            'results': results,
+            'cache': cache.get_stats()
+        }
+    }
+    return jsonify(response_object)
+
+
 @main_blueprint.route('/tasks/<task_id>', methods=['GET'])
 def get_status(task_id):
     with Connection(redis.from_url(current_app.config['REDIS_URL'])):
@@ -83,6 +169,18 @@ def get_status(task_id):
                 'task_result': task.result,
             },
         }
+        if task.meta.get('child_ids'):
+            response_object['data']['task_progress'] = get_harvest_progress(task)
+        elif task.meta.get('progress'):
+            response_object['data']['task_progress'] = task.meta['progress']
+        if task.meta.get('timings'):
+            response_object['data']['task_timings'] = task.meta['timings']
     else:
         response_object = {'status': 'error'}
     return jsonify(response_object)
+
+
+@main_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    data, content_type = get_metrics()
+    return Response(data, mimetype=content_type)
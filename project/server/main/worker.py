@@ -0,0 +1,118 @@
+import os
+import time
+
+from rq import SimpleWorker, Worker
+from rq.job import JobStatus
+
+from project.server.main.fetcher import get_session, reset_sessions
+from project.server.main.logger import get_logger
+from project.server.main.metrics import mark_process_dead, observe, timed
+from project.server.main.utils_mongo import get_client, get_collection, reset_client
+from project.server.main.utils_redis import get_redis, reset_redis
+from project.server.main.utils_swift import get_connection, reset_connection
+
+logger = get_logger(__name__)
+
+# the long-lived clients of a persistent worker are checked before a job when the worker was idle for that long
+WORKER_HEALTH_CHECK_INTERVAL = float(os.getenv('WORKER_HEALTH_CHECK_INTERVAL', 30))
+
+
+def check_mongo() -> None:
+    get_client().admin.command('ping')
+
+
+def check_swift() -> None:
+    get_connection().head_account()
+
+
+def check_redis() -> None:
+    get_redis().ping()
+
+
+HEALTH_CHECKS = {
+    'mongo': (check_mongo, reset_client),
+    'swift': (check_swift, reset_connection),
+    'redis': (check_redis, reset_redis)
+}
+
+
+def check_connections() -> dict:
+    # a client failing its check is dropped, the next call opens a new one
+    status = {}
+    for name, (check, reset) in HEALTH_CHECKS.items():
+        try:
+            with timed(f'health_{name}'):
+                check()
+            status[name] = True
+        except Exception as error:
+            logger.warning(f'{name} health check failed, reconnecting: {error}')
+            reset()
+            status[name] = False
+    return status
+
+
+def preload(connect: bool = True) -> float:
+    # import the tasks, and everything they import, before the first job, return the seconds it took
+    # a forking worker only imports, its work horses cannot share the clients of the parent
+    start = time.perf_counter()
+    import project.server.main.tasks  # noqa: F401
+    if connect:
+        get_collection()
+        get_session()
+        check_connections()
+    duration = time.perf_counter() - start
+    observe('worker_startup', duration)
+    logger.info(f'Worker preloaded in {duration:.3f}s')
+    return duration
+
+
+class JobOverheadMixin:
+    """Reports, for each job, the time the worker spent around the task itself."""
+
+    def execute_job(self, job, queue):
+        start = time.perf_counter()
+        result = super().execute_job(job, queue)
+        total = time.perf_counter() - start
+        if job.ended_at is None:
+            # performed by a work horse, the timestamps are in Redis
+            job.refresh()
+        if job.started_at and job.ended_at:
+            overhead = max(0, total - (job.ended_at - job.started_at).total_seconds())
+            observe('worker_job_overhead', overhead)
+            logger.info(f'Job {job.id} done in {total:.3f}s, {overhead:.3f}s of it outside the task')
+        return result
+
+
+class ForkingWorker(JobOverheadMixin, Worker):
+    """Default RQ worker, each job in a forked work horse."""
+
+    last_horse_pid = 0
+
+    def fork_work_horse(self, job, queue):
+        super().fork_work_horse(job, queue)
+        # RQ forgets the pid once the work horse is done
+        self.last_horse_pid = self.horse_pid
+
+    def execute_job(self, job, queue):
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            if self.last_horse_pid:
+                mark_process_dead(self.last_horse_pid)
+
+
+class PersistentWorker(JobOverheadMixin, SimpleWorker):
+    """Runs the jobs in the worker process, keeping the imports and the Mongo, Swift, Redis and HTTP clients."""
+
+    last_check = 0
+
+    def execute_job(self, job, queue):
+        if time.monotonic() - self.last_check >= WORKER_HEALTH_CHECK_INTERVAL:
+            check_connections()
+        result = super().execute_job(job, queue)
+        self.last_check = time.monotonic()
+        if job.get_status(refresh=False) == JobStatus.FAILED:
+            # do not keep the keep-alive connections of a job that failed
+            reset_sessions()
+            self.last_check = 0
+        return result
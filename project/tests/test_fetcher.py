@@ -0,0 +1,121 @@
+import threading
+import unittest
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from project.server.main import fetcher, rate_limiter
+
+NOTICE = b'<record><controlfield tag="001">123456789</controlfield></record>'
+
+
+class SudocHandler(BaseHTTPRequestHandler):
+    # /flaky-N.xml answers 503 to its first N requests, /known.xml answers 304 to its etag
+    requests = Counter()
+    headers_seen = {}
+
+    def do_GET(self):
+        name = self.path.strip('/').rsplit('.', 1)[0]
+        self.requests[name] += 1
+        self.headers_seen[name] = dict(self.headers)
+        if name.startswith('flaky-') and self.requests[name] <= int(name.split('-')[1]):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif name == 'missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif name == 'known' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Last-Modified', 'Mon, 01 Mar 2021 00:00:00 GMT')
+            self.send_header('Content-Length', str(len(NOTICE)))
+            self.end_headers()
+            self.wfile.write(NOTICE)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SudocHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        SudocHandler.requests.clear()
+        SudocHandler.headers_seen.clear()
+        patches = [
+            mock.patch.object(fetcher, 'SUDOC_URL', f'http://127.0.0.1:{self.server.server_port}'),
+            mock.patch.object(rate_limiter, 'RATE_LIMIT_ENABLED', False)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(fetcher.reset_sessions)
+
+    def fetch(self, sudoc_ids, **kwargs):
+        return dict(fetcher.fetch_notices(sudoc_ids, max_concurrency=4, delay=0, **kwargs))
+
+    def test_fetch(self):
+        responses = self.fetch(['123456789', '987654321'])
+        self.assertEqual({sudoc_id: response.content for sudoc_id, response in responses.items()},
+                         {'123456789': NOTICE, '987654321': NOTICE})
+
+    def test_server_errors_are_retried(self):
+        responses = self.fetch(['flaky-2'], tries=3)
+        self.assertEqual(responses['flaky-2'].status_code, 200)
+        self.assertEqual(SudocHandler.requests['flaky-2'], 3)
+
+    def test_failure_after_last_try(self):
+        responses = self.fetch(['flaky-5', '123456789'], tries=2)
+        self.assertIsNone(responses['flaky-5'])
+        self.assertEqual(responses['123456789'].status_code, 200)
+        self.assertEqual(SudocHandler.requests['flaky-5'], 2)
+
+    def test_client_errors_are_final(self):
+        responses = self.fetch(['missing'], tries=3)
+        self.assertEqual(responses['missing'].status_code, 404)
+        self.assertEqual(SudocHandler.requests['missing'], 1)
+
+    def test_connection_errors(self):
+        with mock.patch.object(fetcher, 'SUDOC_URL', 'http://127.0.0.1:1'):
+            responses = self.fetch(['123456789'], tries=2)
+        self.assertIsNone(responses['123456789'])
+
+    def test_conditional_request(self):
+        states = {'known': {'etag': '"v1"', 'last_modified': 'Mon, 01 Mar 2021 00:00:00 GMT'}}
+        responses = self.fetch(['known', '123456789'], states=states)
+        self.assertEqual(responses['known'].status_code, 304)
+        self.assertEqual(responses['known'].content, b'')
+        self.assertEqual(SudocHandler.headers_seen['known']['If-Modified-Since'], 'Mon, 01 Mar 2021 00:00:00 GMT')
+        self.assertNotIn('If-None-Match', SudocHandler.headers_seen['123456789'])
+        self.assertEqual(responses['123456789'].headers['ETag'], '"v1"')
+
+    def test_changed_notice(self):
+        responses = self.fetch(['known'], states={'known': {'etag': '"v0"'}})
+        self.assertEqual(responses['known'].status_code, 200)
+        self.assertEqual(SudocHandler.headers_seen['known']['If-None-Match'], '"v0"')
+
+    def test_conditional_headers(self):
+        self.assertEqual(fetcher.get_conditional_headers({}), {})
+        self.assertEqual(fetcher.get_conditional_headers({'etag': None, 'last_modified': 'x'}),
+                         {'If-Modified-Since': 'x'})
+
+    def test_rate_limiter_reports(self):
+        with mock.patch.object(fetcher, 'acquire') as acquire, mock.patch.object(fetcher, 'report') as report:
+            self.fetch(['flaky-1'], tries=2)
+        self.assertEqual(acquire.call_count, 2)
+        self.assertEqual([call.kwargs['healthy'] for call in report.call_args_list], [False, True])
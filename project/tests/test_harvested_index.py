@@ -0,0 +1,56 @@
+import fakeredis
+import unittest
+
+from project.server.main.harvested_index import HarvestedIndex, delete_shared, get_shared_key
+from project.server.main.ppn import PpnSet
+
+# valid PPNs, their base spread over the bits of a byte, and ids that are not PPNs
+HARVESTED = ['000000019', '000000027', '000000086', '123456789', 'not-a-ppn']
+NOT_HARVESTED = ['000000035', '000000108', '987654322', 'other']
+
+
+class Cursor(list):
+
+    def hint(self, index):
+        return self
+
+
+class Collection:
+
+    def __init__(self, sudoc_ids):
+        self.documents = {sudoc_id: {'sudoc_id': sudoc_id, 'content_hash': f'hash-{sudoc_id}'}
+                          for sudoc_id in sudoc_ids}
+
+    def find(self, query, projection=None, **kwargs):
+        sudoc_ids = query.get('sudoc_id', {}).get('$in', list(self.documents))
+        return Cursor(dict(self.documents[sudoc_id]) for sudoc_id in sudoc_ids if sudoc_id in self.documents)
+
+
+class SharedHarvestedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.collection = Collection(HARVESTED)
+        self.key = get_shared_key('harvest')
+        harvested = HarvestedIndex(self.collection)
+        harvested.load()
+        harvested.save(self.redis, self.key, 60)
+
+    def test_bits_match_the_loaded_index(self):
+        ppns = PpnSet(HARVESTED)
+        shared = HarvestedIndex.open_shared(self.collection, self.redis, self.key)
+        chunk = HARVESTED + NOT_HARVESTED
+        self.assertEqual(shared.filter_shared(chunk), [sudoc_id for sudoc_id in chunk if sudoc_id in ppns])
+
+    def test_known_states(self):
+        shared = HarvestedIndex.open_shared(self.collection, self.redis, self.key)
+        chunk = ['000000019', '000000035', 'not-a-ppn']
+        self.assertEqual(shared.get_known_states(chunk, False), {'000000019': {'sudoc_id': '000000019'},
+                                                                 'not-a-ppn': {'sudoc_id': 'not-a-ppn'}})
+        self.assertEqual(set(shared.get_known_states(chunk, True)), {'000000019', 'not-a-ppn'})
+        self.assertEqual(shared.stats['queries'], 1)
+
+    def test_expired_index(self):
+        delete_shared(self.redis, self.key)
+        self.assertEqual(self.redis.keys('harvested_index:*'), [])
+        self.assertIsNone(HarvestedIndex.open_shared(self.collection, self.redis, self.key))
@@ -0,0 +1,93 @@
+import re
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from project.server.main import fetcher, idref, rate_limiter
+from project.server.main.idref import RDF_NS, SPARQL_RESULTS_NS, parse_solutions, query_sudoc_ids
+
+
+def get_solution(author: str = None, doc: str = None) -> str:
+    bindings = ''.join(f'<res:binding><res:variable>{variable}</res:variable><res:value rdf:resource="{value}"/>'
+                       f'</res:binding>' for variable, value in [('author', author), ('doc', doc)] if value)
+    return f'<res:solution>{bindings}</res:solution>'
+
+
+def get_results(solutions: list) -> bytes:
+    return (f'<rdf:RDF xmlns:rdf="{RDF_NS}" xmlns:res="{SPARQL_RESULTS_NS}"><res:ResultSet>{"".join(solutions)}'
+            f'</res:ResultSet></rdf:RDF>').encode('utf-8')
+
+
+AUTHOR = 'http://www.idref.fr/026745402/id'
+# pages of two: the third solution is not a sudoc.fr document and the fifth is malformed, both keep a page full
+SOLUTIONS = [get_solution(AUTHOR, 'http://www.sudoc.fr/000000019/id'),
+             get_solution(AUTHOR, 'http://www.sudoc.fr/000000027/id'),
+             get_solution(AUTHOR, 'http://www.theses.fr/2020PA01'),
+             get_solution(AUTHOR, 'http://www.sudoc.fr/000000035/id'),
+             get_solution(AUTHOR, 'sudoc.fr'),
+             get_solution(AUTHOR, 'http://www.sudoc.fr/000000043/id')]
+
+
+class SparqlHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['query'][0]
+        limit, offset = map(int, re.search(r'LIMIT (\d+) OFFSET (\d+)', query).groups())
+        self.requests.append(offset)
+        body = get_results(SOLUTIONS[offset:offset + limit])
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ParseSolutionsTest(unittest.TestCase):
+
+    def test_rows(self):
+        self.assertEqual(parse_solutions(get_results(SOLUTIONS[:2])),
+                         ([('026745402', '000000019'), ('026745402', '000000027')], 2))
+
+    def test_skipped_solutions_are_counted(self):
+        solutions = [get_solution(AUTHOR), get_solution(doc='http://www.sudoc.fr/000000019/id'),
+                     get_solution(AUTHOR, 'http://www.theses.fr/2020PA01'), get_solution(AUTHOR, 'sudoc.fr')]
+        self.assertEqual(parse_solutions(get_results(solutions)), ([], 4))
+
+    def test_not_xml(self):
+        self.assertEqual(parse_solutions(b''), ([], 0))
+
+
+class QuerySudocIdsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SparqlHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        SparqlHandler.requests.clear()
+        patches = [
+            mock.patch.object(idref, 'IDREF_SPARQL_URL', f'http://127.0.0.1:{self.server.server_port}/sparql'),
+            mock.patch.object(idref, 'IDREF_PAGE_SIZE', 2),
+            mock.patch.object(rate_limiter, 'RATE_LIMIT_ENABLED', False)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(fetcher.reset_sessions)
+
+    def test_pages_with_skipped_solutions(self):
+        self.assertEqual(query_sudoc_ids(['026745402']), {'026745402': ['000000019', '000000027', '000000035',
+                                                                         '000000043']})
+        self.assertEqual(SparqlHandler.requests, [0, 2, 4, 6])
@@ -0,0 +1,45 @@
+import itertools
+import unittest
+
+from unittest import mock
+
+from project.server.main import parser
+from project.server.main.parser import get_filter_reason, get_notice_from_xml, prefilter_xml
+
+FIELDS = {
+    '008': '<controlfield tag="008">Kax</controlfield>',
+    '029': '<datafield tag="029"><subfield code="b">thesis</subfield></datafield>',
+    '205': '<datafield tag="205"><subfield code="a">2e éd.</subfield></datafield>',
+    '110': '<datafield tag="110"><subfield code="a">x</subfield></datafield>',
+    '200': '<datafield tag="200"><subfield code="a">Titre</subfield></datafield>'
+}
+
+
+def get_notice_xml(tags) -> bytes:
+    fields = ''.join(FIELDS[tag] for tag in tags)
+    return f'<record xmlns="http://www.loc.gov/MARC21/slim">{fields}</record>'.encode('utf-8')
+
+
+class PrefilterTest(unittest.TestCase):
+
+    def test_same_reason_as_filter_notice(self):
+        # whatever the order of the fields, the reason is the first rule of FILTER_RULES that rejects the notice
+        for size in range(len(FIELDS) + 1):
+            for tags in itertools.permutations(FIELDS, size):
+                notice_xml = get_notice_xml(tags)
+                with self.subTest(tags=tags):
+                    self.assertEqual(prefilter_xml(notice_xml)[0], get_filter_reason(get_notice_from_xml(notice_xml)))
+
+    def test_re_edition_before_thesis(self):
+        self.assertEqual(prefilter_xml(get_notice_xml(['029', '200', '205'])), ('re_edition', None))
+
+    def test_kept_notice_is_indexed(self):
+        reason, notice = prefilter_xml(get_notice_xml(['200']))
+        self.assertIsNone(reason)
+        self.assertIn('200', notice['datafields'])
+
+    def test_rejected_notice_stops_indexing(self):
+        # once 008 rejects the notice, only the 205 fields that could make it a re-edition are still indexed
+        with mock.patch.object(parser, 'index_field', wraps=parser.index_field) as index_field:
+            self.assertEqual(prefilter_xml(get_notice_xml(['008', '110', '200', '029', '205'])), ('re_edition', None))
+        self.assertEqual([call.args[2].get('tag') for call in index_field.call_args_list], ['008', '205'])
@@ -0,0 +1,103 @@
+import fakeredis
+import redis
+import unittest
+
+from unittest import mock
+
+from project.server.main import rate_limiter
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        # the buckets are timed in milliseconds by get_now, waiting moves that clock forward
+        self.now = 1000000
+        self.waits = []
+        patches = [
+            mock.patch.object(rate_limiter, 'get_redis', lambda: self.redis),
+            mock.patch.object(rate_limiter, 'get_now', lambda: self.now),
+            mock.patch.object(rate_limiter.time, 'sleep', self.sleep),
+            mock.patch.object(rate_limiter.random, 'uniform', lambda a, b: 1),
+            mock.patch.dict(rate_limiter.unavailable, {'until': 0}),
+            mock.patch.dict(rate_limiter.scripts, {'client': None}),
+            mock.patch.multiple(rate_limiter, RATE_LIMIT_ENABLED=True, RATE_LIMIT_INITIAL=10, RATE_LIMIT_MIN=0.5,
+                                RATE_LIMIT_MAX=50, RATE_LIMIT_INCREASE=2, RATE_LIMIT_DECREASE=0.7,
+                                RATE_LIMIT_COOLDOWN=1, RATE_LIMIT_BURST=1, RATE_LIMIT_MAX_WAIT=60)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += int(seconds * 1000)
+
+    def get_rate(self):
+        return float(self.redis.hget(rate_limiter.get_bucket_key('sudoc'), 'rate'))
+
+    def test_burst_then_rate(self):
+        for _ in range(10):
+            self.assertEqual(rate_limiter.acquire('sudoc'), 0)
+        self.assertAlmostEqual(rate_limiter.acquire('sudoc'), 0.1)
+        self.assertAlmostEqual(rate_limiter.acquire('sudoc'), 0.1)
+
+    def test_tokens_refill(self):
+        for _ in range(10):
+            rate_limiter.acquire('sudoc')
+        self.now += 500
+        for _ in range(5):
+            self.assertEqual(rate_limiter.acquire('sudoc'), 0)
+        self.assertGreater(rate_limiter.acquire('sudoc'), 0)
+
+    def test_hosts_have_their_own_bucket(self):
+        for _ in range(10):
+            rate_limiter.acquire('sudoc')
+        self.assertEqual(rate_limiter.acquire('idref'), 0)
+
+    def test_additive_increase(self):
+        self.assertAlmostEqual(rate_limiter.report('sudoc', healthy=True), 10.2)
+        self.assertAlmostEqual(rate_limiter.report('sudoc', healthy=True), 10.2 + 2 / 10.2)
+        for _ in range(5000):
+            rate_limiter.report('sudoc', healthy=True)
+        self.assertEqual(self.get_rate(), 50)
+
+    def test_multiplicative_decrease_once_per_cooldown(self):
+        self.assertAlmostEqual(rate_limiter.report('sudoc', healthy=False), 7)
+        self.assertAlmostEqual(rate_limiter.report('sudoc', healthy=False), 7)
+        self.now += 1000
+        self.assertAlmostEqual(rate_limiter.report('sudoc', healthy=False), 4.9)
+        for _ in range(20):
+            self.now += 1000
+            rate_limiter.report('sudoc', healthy=False)
+        self.assertEqual(self.get_rate(), 0.5)
+
+    def test_retry_after_blocks_the_host(self):
+        rate_limiter.report('sudoc', healthy=False, retry_after='5')
+        self.assertAlmostEqual(rate_limiter.acquire('sudoc'), 5)
+        self.assertEqual(rate_limiter.acquire('sudoc'), 0)
+
+    def test_retry_after_date_is_ignored(self):
+        self.assertEqual(rate_limiter.get_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertEqual(rate_limiter.get_retry_after(None), 0)
+        self.assertEqual(rate_limiter.get_retry_after('2.5'), 2.5)
+
+    def test_wait_is_capped(self):
+        rate_limiter.report('sudoc', healthy=False, retry_after='3600')
+        with mock.patch.object(rate_limiter, 'RATE_LIMIT_MAX_WAIT', 10):
+            rate_limiter.acquire('sudoc')
+        self.assertTrue(all(wait <= 10 for wait in self.waits))
+
+    def test_scripts_registered_once(self):
+        with mock.patch.object(self.redis, 'register_script', wraps=self.redis.register_script) as register_script:
+            for _ in range(3):
+                rate_limiter.acquire('sudoc')
+                rate_limiter.report('sudoc', healthy=True)
+        self.assertEqual(register_script.call_count, 2)
+
+    def test_redis_unavailable(self):
+        with mock.patch.object(self.redis, 'evalsha', side_effect=redis.ConnectionError('down')):
+            self.assertEqual(rate_limiter.acquire('sudoc'), 0)
+        self.assertFalse(rate_limiter.is_enabled())
+        self.assertIsNone(rate_limiter.report('sudoc', healthy=False))
+        self.assertEqual(self.redis.keys(), [])
@@ -0,0 +1,153 @@
+import functools
+import hashlib
+import tempfile
+import unittest
+
+from contextlib import contextmanager
+from unittest import mock
+
+from project.benchmarks.stubs import MemoryCollection
+from project.server.main import pipeline, reparse, storage_manifest, tasks, utils, utils_swift
+from project.server.main.parser import get_notice_from_xml, parse
+from project.server.main.raw_cache import RawCache
+from project.server.main.tasks import dump_notice
+from project.server.main.utils import get_content_hash, get_legacy_parsed_path, get_parsed_hash, get_parsed_path, \
+    get_raw_path
+from project.tests.test_utils_swift import FakeConnection
+
+
+def get_notice_xml(sudoc_id: str, genre: str = 'A') -> bytes:
+    # genre K is not a text, the notice is filtered
+    return (f'<record><controlfield tag="001">{sudoc_id}</controlfield>'
+            f'<controlfield tag="008">{genre}ax3</controlfield>'
+            f'<datafield tag="200"><subfield code="a">Titre {sudoc_id}</subfield></datafield></record>').encode('utf-8')
+
+
+def get_parsed(sudoc_id: str) -> bytes:
+    return dump_notice(parse(sudoc_id, get_notice_from_xml(get_notice_xml(sudoc_id))))
+
+
+class ReparseTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeConnection.objects = {}
+        self.collection = MemoryCollection()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patches = [
+            mock.patch.object(utils_swift, 'create_connection', FakeConnection),
+            mock.patch.object(utils_swift, 'storage_url', None),
+            mock.patch.dict(utils_swift.auth, {'url': None, 'token': None}),
+            mock.patch.object(storage_manifest, 'STORAGE_MANIFEST_ENABLED', False),
+            mock.patch.object(reparse, 'get_collection', return_value=self.collection),
+            mock.patch.object(reparse, 'RawCache', functools.partial(RawCache, directory=cache_dir.name)),
+            mock.patch.object(pipeline, 'PARSE_WORKERS', 0)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        utils_swift.local.connection = None
+        self.addCleanup(setattr, utils_swift.local, 'connection', None)
+
+    def add_notice(self, sudoc_id: str, state: dict, genre: str = 'A', parsed: bytes = None,
+                   parsed_key: str = None) -> None:
+        notice_xml = get_notice_xml(sudoc_id, genre)
+        FakeConnection.objects[('sudoc', get_raw_path(sudoc_id))] = notice_xml
+        if parsed is not None:
+            FakeConnection.objects[('sudoc', parsed_key or get_parsed_path(sudoc_id))] = parsed
+        self.collection.documents[sudoc_id] = {'sudoc_id': sudoc_id, 'content_hash': get_content_hash(notice_xml),
+                                               **state}
+
+    def reparse(self, sudoc_id: str, **kwargs) -> str:
+        stats = reparse.create_task_reparse([sudoc_id], **kwargs)
+        return next(change for change in reparse.REPARSE_CHANGES if stats[change])
+
+    @staticmethod
+    @contextmanager
+    def parsed_format(parsed_format: str):
+        with mock.patch.object(utils, 'PARSED_FORMAT', parsed_format), \
+                mock.patch.object(tasks, 'PARSED_FORMAT', parsed_format):
+            yield
+
+    def get_parsed_object(self, sudoc_id: str, parsed_key: str = None) -> bytes:
+        return FakeConnection.objects.get(('sudoc', parsed_key or get_parsed_path(sudoc_id)))
+
+    def test_unchanged(self):
+        parsed = get_parsed('000000019')
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': get_parsed_path('000000019'),
+                                      'parsed_hash': get_parsed_hash(parsed)}, parsed=b'not rewritten')
+        self.assertEqual(self.reparse('000000019'), 'unchanged')
+        self.assertEqual(self.get_parsed_object('000000019'), b'not rewritten')
+
+    def test_changed(self):
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': get_parsed_path('000000019'),
+                                      'parsed_hash': 'previous'}, parsed=b'{"title": "previous"}')
+        stats = reparse.create_task_reparse(['000000019'])
+        self.assertEqual(stats['changed'], 1)
+        self.assertIn('title', stats['diff']['fields'])
+        self.assertEqual(self.get_parsed_object('000000019'), get_parsed('000000019'))
+        self.assertEqual(self.collection.documents['000000019']['parsed_hash'],
+                         get_parsed_hash(get_parsed('000000019')))
+
+    def test_newly_parsed(self):
+        self.add_notice('000000019', {'parsed': False, 'filtered': True, 'parsed_key': None})
+        self.assertEqual(self.reparse('000000019'), 'newly_parsed')
+        self.assertEqual(self.get_parsed_object('000000019'), get_parsed('000000019'))
+        self.assertTrue(self.collection.documents['000000019']['parsed'])
+
+    def test_newly_filtered(self):
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': get_parsed_path('000000019'),
+                                      'parsed_hash': 'previous'}, genre='K', parsed=b'{}')
+        self.assertEqual(self.reparse('000000019'), 'newly_filtered')
+        self.assertIsNone(self.get_parsed_object('000000019'))
+        self.assertEqual({key: self.collection.documents['000000019'][key] for key in ['filtered', 'parsed_key']},
+                         {'filtered': True, 'parsed_key': None})
+
+    def test_still_filtered(self):
+        self.add_notice('000000019', {'parsed': False, 'filtered': True, 'parsed_key': None}, genre='K')
+        self.assertEqual(self.reparse('000000019'), 'still_filtered')
+
+    def test_etag_of_older_notice(self):
+        # harvested before the parsed hash was recorded, the etag of its object is compared instead
+        parsed = get_parsed('000000019')
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': get_parsed_path('000000019')}, parsed=parsed)
+        self.assertEqual(self.reparse('000000019'), 'unchanged')
+        self.assertEqual(self.collection.documents['000000019']['parsed_hash'], hashlib.md5(parsed).hexdigest())
+
+    def test_legacy_notice(self):
+        # harvested before the outcome of the parsing was recorded
+        legacy_key = get_legacy_parsed_path('000000019')
+        self.add_notice('000000019', {}, parsed=b'{"title": "previous"}', parsed_key=legacy_key)
+        self.assertEqual(self.reparse('000000019'), 'legacy')
+        self.assertEqual(self.get_parsed_object('000000019'), get_parsed('000000019'))
+        self.assertTrue(self.collection.documents['000000019']['parsed'])
+
+    def test_legacy_notice_filtered(self):
+        legacy_key = get_legacy_parsed_path('000000019')
+        self.add_notice('000000019', {}, genre='K', parsed=b'{}', parsed_key=legacy_key)
+        self.assertEqual(self.reparse('000000019'), 'legacy')
+        self.assertIsNone(self.get_parsed_object('000000019', legacy_key))
+        self.assertFalse(self.collection.documents['000000019']['parsed'])
+
+    def test_other_format(self):
+        # parsed under the key of the other format, rewritten under the key of PARSED_FORMAT
+        parsed = get_parsed('000000019')
+        legacy_key = get_legacy_parsed_path('000000019')
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': legacy_key, 'parsed_hash': get_parsed_hash(parsed)},
+                        parsed=parsed, parsed_key=legacy_key)
+        with self.parsed_format('json'):
+            self.assertEqual(self.reparse('000000019'), 'legacy')
+            self.assertIsNotNone(self.get_parsed_object('000000019'))
+            self.assertEqual(self.collection.documents['000000019']['parsed_key'], get_parsed_path('000000019'))
+        self.assertIsNone(self.get_parsed_object('000000019', legacy_key))
+
+    def test_dry_run(self):
+        self.add_notice('000000019', {'parsed': True, 'parsed_key': get_parsed_path('000000019'),
+                                      'parsed_hash': 'previous'}, genre='K', parsed=b'{}')
+        self.assertEqual(self.reparse('000000019', dry_run=True), 'newly_filtered')
+        self.assertEqual(self.get_parsed_object('000000019'), b'{}')
+        self.assertTrue(self.collection.documents['000000019']['parsed'])
+
+    def test_missing_raw_notice(self):
+        stats = reparse.create_task_reparse(['000000019'])
+        self.assertEqual((stats['missing'], stats['notices']), (1, 0))
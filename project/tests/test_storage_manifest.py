@@ -0,0 +1,91 @@
+import fakeredis
+import unittest
+
+from unittest import mock
+
+from project.server.main import storage_manifest
+from project.server.main.storage_manifest import build_manifest, get_object_info, is_missing, record_delete, \
+    record_upload
+
+LISTING = [[{'name': 'raw/89/123456789.xml', 'bytes': 10, 'hash': 'etag1'},
+            {'name': 'raw/21/987654321.xml', 'bytes': 20, 'hash': 'etag2'}]]
+
+
+class StorageManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeStrictRedis(server=self.server)
+        self.now = 1000
+        patches = [
+            mock.patch.object(storage_manifest, 'get_redis', lambda: self.redis),
+            mock.patch.object(storage_manifest.time, 'time', lambda: self.now),
+            mock.patch.object(storage_manifest, 'STORAGE_MANIFEST_ENABLED', True),
+            mock.patch.dict(storage_manifest.listed, {'prefixes': {}, 'expires_at': 0}),
+            mock.patch.dict(storage_manifest.unavailable, {'until': 0}),
+            mock.patch.object(storage_manifest, 'pending', [])
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_unlisted_prefix_is_not_trusted(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.assertFalse(is_missing('sudoc', 'parsed/89/123456789.json'))
+        self.assertFalse(is_missing('sudoc', 'sudoc_ids/ids.txt'))
+
+    def test_listed_prefix(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.assertFalse(is_missing('sudoc', 'raw/89/123456789.xml'))
+        self.assertTrue(is_missing('sudoc', 'raw/89/000000089.xml'))
+        self.assertEqual(get_object_info('sudoc', 'raw/21/987654321.xml'), {'size': 20, 'etag': 'etag2'})
+
+    def test_directory_not_in_listing_is_not_trusted(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.assertFalse(is_missing('sudoc', 'raw/00/000000000.xml'))
+
+    def test_uploads_and_deletes(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        record_upload('sudoc', 'raw/89/000000089.xml', 5, 'etag3')
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000089.xml'))
+        record_delete('sudoc', 'raw/89/123456789.xml')
+        self.assertTrue(is_missing('sudoc', 'raw/89/123456789.xml'))
+
+    def test_directory_lost_to_eviction(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.redis.delete(storage_manifest.get_manifest_key('sudoc', 'raw/89/123456789.xml'))
+        # an upload recreates the hash of the directory, without its marker
+        record_upload('sudoc', 'raw/89/000000089.xml', 5, 'etag3')
+        self.assertFalse(is_missing('sudoc', 'raw/89/123456789.xml'))
+        self.assertTrue(is_missing('sudoc', 'raw/21/000000021.xml'))
+
+    def test_listed_prefixes_flushed(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.redis.flushall()
+        self.now += storage_manifest.STORAGE_MANIFEST_LISTED_TTL + 1
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000089.xml'))
+
+    def test_pending_uploads_while_redis_is_down(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        self.server.connected = False
+        record_upload('sudoc', 'raw/89/000000089.xml', 5, 'etag3')
+        self.assertEqual(len(storage_manifest.pending), 1)
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000097.xml'))
+        # back after the retry delay, nothing is reported missing before the pending upload is recorded
+        self.now += storage_manifest.STORAGE_MANIFEST_RETRY_REDIS
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000089.xml'))
+        self.server.connected = True
+        self.now += storage_manifest.STORAGE_MANIFEST_RETRY_REDIS
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000089.xml'))
+        self.assertEqual(storage_manifest.pending, [])
+        self.assertTrue(is_missing('sudoc', 'raw/89/000000097.xml'))
+
+    def test_uploads_while_unavailable_are_pending(self):
+        build_manifest('sudoc', 'raw/', iter(LISTING))
+        storage_manifest.unavailable['until'] = self.now + 10
+        record_upload('sudoc', 'raw/89/000000089.xml', 5, 'etag3')
+        self.assertIsNone(self.redis.hget(storage_manifest.get_manifest_key('sudoc', 'raw/89/000000089.xml'),
+                                          '000000089.xml'))
+        self.now += 10
+        self.assertFalse(is_missing('sudoc', 'raw/89/000000089.xml'))
+        self.assertEqual(get_object_info('sudoc', 'raw/89/000000089.xml'), {'size': 5, 'etag': 'etag3'})
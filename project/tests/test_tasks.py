@@ -0,0 +1,90 @@
+import fakeredis
+import unittest
+
+from unittest import mock
+
+from rq import Queue, SimpleWorker
+from rq.job import Job, JobStatus
+
+from project.server.main import tasks
+
+
+def harvest_chunk(sudoc_ids, force_download, force_parsing, output_mode):
+    if 'failing' in sudoc_ids:
+        raise RuntimeError('chunk failed')
+    return {**{counter: 0 for counter in tasks.HARVEST_COUNTERS}, 'fetched': len(sudoc_ids)}
+
+
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.queue = Queue('harvest', connection=self.redis)
+        patches = [
+            mock.patch.object(tasks, 'create_task_harvest_notices', harvest_chunk),
+            mock.patch.object(tasks, 'AGGREGATE_WAIT', 0),
+            mock.patch.object(tasks, 'CHUNK_SIZE', 2)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fan_out(self, chunks) -> Job:
+        parent = self.queue.create_job(tasks.create_task_harvest, args=(['idref'],), result_ttl=tasks.RESULT_TTL)
+        parent.save()
+        tasks.fan_out_chunks(parent, tasks.create_task_harvest_notices, [(chunk, False, True, 'objects')
+                                                                          for chunk in chunks], 'objects', 0)
+        return parent
+
+    def run_harvest(self, sudoc_ids) -> dict:
+        with mock.patch.object(tasks, 'resolve_idrefs', lambda idrefs: {'idref': sudoc_ids}):
+            parent = self.queue.enqueue(tasks.create_task_harvest, ['idref'], result_ttl=tasks.RESULT_TTL)
+            SimpleWorker([self.queue], connection=self.redis).work(burst=True)
+        parent.refresh()
+        return parent.meta.get('summary')
+
+    def test_aggregate_after_chunks(self):
+        summary = self.run_harvest(['1', '2', '3'])
+        self.assertEqual((summary['chunks_total'], summary['chunks_done'], summary['fetched']), (2, 2, 3))
+
+    def test_aggregate_after_failed_chunk(self):
+        summary = self.run_harvest(['1', '2', 'failing'])
+        self.assertEqual((summary['chunks_done'], summary['chunks_failed'], summary['fetched']), (1, 1, 2))
+
+    def test_parent_knows_chunks_before_they_run(self):
+        parent = self.fan_out([['1'], ['2']])
+        meta = Job.fetch(parent.id, connection=self.redis).meta
+        self.assertEqual(meta['child_ids'], self.queue.job_ids)
+        self.assertEqual(Job.fetch(meta['aggregate_id'], connection=self.redis).get_status(), JobStatus.DEFERRED)
+
+    def test_chunk_ending_twice_is_counted_once(self):
+        # a success callback that raises is followed by the failure callback of the same job
+        parent = self.fan_out([['1'], ['2']])
+        child = Job.fetch(parent.meta['child_ids'][0], connection=self.redis)
+        tasks.end_chunk(child, self.redis, False)
+        tasks.end_chunk(child, self.redis, True)
+        aggregate = Job.fetch(parent.meta['aggregate_id'], connection=self.redis)
+        self.assertEqual(aggregate.get_status(), JobStatus.DEFERRED)
+        tasks.end_chunk(Job.fetch(parent.meta['child_ids'][1], connection=self.redis), self.redis, False)
+        self.assertEqual(aggregate.get_status(), JobStatus.QUEUED)
+
+    def test_resumed_harvest_replaces_previous_fan_out(self):
+        # the first run was interrupted after one chunk job failed, the others still queued
+        previous = self.fan_out([['1'], ['2'], ['3']])
+        previous_children = [Job.fetch(child_id, connection=self.redis) for child_id in previous.meta['child_ids']]
+        tasks.end_chunk(previous_children[0], self.redis, True)
+        parent = self.queue.create_job(tasks.create_task_harvest, args=(['idref'],), job_id=previous.id,
+                                       result_ttl=tasks.RESULT_TTL)
+        parent.save()
+        children_args = [(['1'], False, True, 'objects'), (['2'], False, True, 'objects')]
+        tasks.fan_out_chunks(parent, tasks.create_task_harvest_notices, children_args, 'objects', 0)
+        self.assertEqual(self.queue.job_ids, parent.meta['child_ids'])
+        for previous_job_id in previous.meta['child_ids'] + [previous.meta['aggregate_id']]:
+            self.assertFalse(Job.exists(previous_job_id, connection=self.redis))
+        # a chunk job of the previous run still running is not counted
+        tasks.end_chunk(previous_children[1], self.redis, False)
+        tasks.end_chunk(Job.fetch(parent.meta['child_ids'][0], connection=self.redis), self.redis, False)
+        self.assertEqual(Job.fetch(parent.meta['aggregate_id'], connection=self.redis).get_status(), JobStatus.DEFERRED)
+        SimpleWorker([self.queue], connection=self.redis).work(burst=True)
+        summary = Job.fetch(parent.id, connection=self.redis).meta['summary']
+        self.assertEqual((summary['chunks_total'], summary['chunks_done'], summary['chunks_failed']), (2, 2, 0))
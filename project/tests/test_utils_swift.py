@@ -0,0 +1,185 @@
+import gzip
+import hashlib
+import json
+import swiftclient
+import threading
+import unittest
+
+from unittest import mock
+
+from project.server.main import storage_manifest, utils_swift
+
+
+class FakeConnection:
+    # in-memory container objects shared by every connection, as a Swift account would be
+    objects = {}
+    created = []
+    authenticated = []
+
+    def __init__(self):
+        self.token = None
+        self.url = None
+        self.closed = False
+        self.thread = threading.get_ident()
+        self.created.append(self)
+
+    def get_auth(self):
+        self.authenticated.append(self)
+        return 'http://swift/v1/AUTH_test', 'token'
+
+    def close(self):
+        self.closed = True
+
+    def put_object(self, container, name, contents, **kwargs):
+        self.objects[(container, name)] = contents
+        return hashlib.md5(contents).hexdigest()
+
+    def get_object(self, container, name, resp_chunk_size=None):
+        if (container, name) not in self.objects:
+            raise swiftclient.ClientException('Object GET failed', http_status=404)
+        contents = self.objects[(container, name)]
+        if resp_chunk_size:
+            return {}, (contents[i:i + resp_chunk_size] for i in range(0, len(contents), resp_chunk_size))
+        return {}, contents
+
+    def head_object(self, container, name):
+        if (container, name) not in self.objects:
+            raise swiftclient.ClientException('Object HEAD failed', http_status=404)
+        contents = self.objects[(container, name)]
+        return {'etag': hashlib.md5(contents).hexdigest(), 'content-length': str(len(contents))}
+
+    def delete_object(self, container, name):
+        if self.objects.pop((container, name), None) is None:
+            raise swiftclient.ClientException('Object DELETE failed', http_status=404)
+
+    def get_container(self, container, prefix='', marker='', limit=10000):
+        names = sorted(name for c, name in self.objects if c == container and name.startswith(prefix) and name > marker)
+        return {}, [{'name': name, 'bytes': len(self.objects[(container, name)])} for name in names[:limit]]
+
+
+class UtilsSwiftTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeConnection.objects = {}
+        FakeConnection.created = []
+        FakeConnection.authenticated = []
+        patches = [
+            mock.patch.object(utils_swift, 'create_connection', FakeConnection),
+            mock.patch.object(utils_swift, 'storage_url', None),
+            mock.patch.dict(utils_swift.auth, {'url': None, 'token': None}),
+            mock.patch.object(storage_manifest, 'STORAGE_MANIFEST_ENABLED', False)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        utils_swift.local.connection = None
+        self.addCleanup(setattr, utils_swift.local, 'connection', None)
+
+    def test_connection_per_thread(self):
+        connection = utils_swift.get_connection()
+        self.assertIs(utils_swift.get_connection(), connection)
+        results = list(utils_swift.run_in_threads(
+            lambda _: (threading.get_ident(), utils_swift.get_connection()), range(50), 4))
+        per_thread = {}
+        for thread, thread_connection in results:
+            self.assertIs(per_thread.setdefault(thread, thread_connection), thread_connection)
+            self.assertEqual(thread_connection.thread, thread)
+        self.assertNotIn(connection, per_thread.values())
+        self.assertEqual(len(FakeConnection.created), len(per_thread) + 1)
+
+    def test_token_shared_between_threads(self):
+        connections = list(utils_swift.run_in_threads(lambda _: utils_swift.get_connection(), range(8), 4))
+        connections.append(utils_swift.get_connection())
+        self.assertLessEqual(len(FakeConnection.authenticated), 4)
+        self.assertTrue(all(c.token == 'token' and c.url == 'http://swift/v1/AUTH_test' for c in connections))
+        utils_swift.get_connection()
+        self.assertEqual(utils_swift.auth, {'url': 'http://swift/v1/AUTH_test', 'token': 'token'})
+
+    def test_pre_authenticated(self):
+        utils_swift.auth.update({'url': 'http://stub/v1/AUTH_x', 'token': 'stub'})
+        connection = utils_swift.get_connection()
+        self.assertEqual((connection.url, connection.token), ('http://stub/v1/AUTH_x', 'stub'))
+        self.assertEqual(FakeConnection.authenticated, [])
+
+    def test_reset_connection(self):
+        connection = utils_swift.get_connection()
+        utils_swift.reset_connection()
+        self.assertTrue(connection.closed)
+        self.assertEqual(utils_swift.auth, {'url': None, 'token': None})
+        self.assertIsNot(utils_swift.get_connection(), connection)
+
+    def test_run_in_threads_keeps_order(self):
+        self.assertEqual(list(utils_swift.run_in_threads(lambda x: x * 2, range(100), 8)), list(range(0, 200, 2)))
+
+    def test_upload_and_download_batch(self):
+        objects = [(f'raw/{i:02d}/{i}.xml', f'<record>{i}</record>'.encode('utf-8')) for i in range(20)]
+        urls = utils_swift.upload_bytes_batch('sudoc', objects, max_workers=4)
+        self.assertEqual(urls, [f'http://swift/v1/AUTH_test/sudoc/{name}' for name, _ in objects])
+        filenames = [name for name, _ in objects] + ['raw/99/missing.xml']
+        downloaded = list(utils_swift.download_bytes_batch('sudoc', filenames, max_workers=4))
+        self.assertEqual(downloaded, objects + [('raw/99/missing.xml', None)])
+
+    def test_delete_objects(self):
+        utils_swift.upload_bytes_batch('sudoc', [('parsed/01/1.json', b'{}'), ('parsed/02/2.json', b'{}')])
+        deleted = utils_swift.delete_objects('sudoc', ['parsed/01/1.json', 'parsed/03/3.json', 'parsed/02/2.json'])
+        self.assertEqual(deleted, ['parsed/01/1.json', 'parsed/02/2.json'])
+        self.assertEqual(FakeConnection.objects, {})
+
+    def test_listing_pages(self):
+        utils_swift.upload_bytes_batch('sudoc', [(f'raw/{i:02d}/{i}.xml', b'x') for i in range(25)])
+        utils_swift.upload_bytes('sudoc', 'parsed/00/0.json', b'{}')
+        pages = list(utils_swift.iter_listing_pages('sudoc', 'raw/', limit=10))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([obj['name'] for page in pages for obj in page], [f'raw/{i:02d}/{i}.xml' for i in range(25)])
+
+    def test_object_lines(self):
+        utils_swift.upload_bytes('sudoc', 'sudoc_ids/ids.gz', gzip.compress(b'123456789\n987654321\n'))
+        utils_swift.upload_bytes('sudoc', 'sudoc_ids/ids', b'123456789\n987654321')
+        for filename in ['sudoc_ids/ids.gz', 'sudoc_ids/ids']:
+            lines = [line for line in utils_swift.iter_object_lines('sudoc', filename, chunk_size=3) if line]
+            self.assertEqual(lines, [b'123456789', b'987654321'])
+        with self.assertRaises(FileNotFoundError):
+            list(utils_swift.iter_object_lines('sudoc', 'sudoc_ids/missing'))
+
+
+def split(contents: bytes, size: int) -> list:
+    return [contents[i:i + size] for i in range(0, len(contents), size)]
+
+
+class DecodersTest(unittest.TestCase):
+    # every chunk size, down to one byte, gives the same records
+
+    def assert_chunked(self, iterator, contents, expected):
+        for size in range(1, len(contents) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(list(iterator(split(contents, size))), expected)
+
+    def test_truncated_gzip(self):
+        contents = gzip.compress(b'123456789\n987654321\n')
+        for end in [len(contents) - 4, len(contents) // 2, 3]:
+            for size in [1, 7, len(contents)]:
+                with self.subTest(end=end, size=size), self.assertRaises(EOFError):
+                    list(utils_swift.iter_lines(split(contents[:end], size)))
+
+    def test_multi_member_gzip(self):
+        contents = gzip.compress(b'123456789\n') + gzip.compress(b'987654321\n') + b'\x00' * 8
+        self.assert_chunked(utils_swift.iter_lines, contents, [b'123456789', b'987654321', b''])
+
+    def test_json_array(self):
+        contents = b'[{"id": "123456789"}, {"id": "987654321"}]'
+        expected = [{'id': '123456789'}, {'id': '987654321'}]
+        self.assert_chunked(utils_swift.iter_json_records, contents, expected)
+        self.assert_chunked(utils_swift.iter_json_records, gzip.compress(contents), expected)
+
+    def test_jsonl_without_trailing_newline(self):
+        contents = '{"title": "Économie"}\n{"title": "Société"}'.encode('utf-8')
+        self.assert_chunked(utils_swift.iter_json_records, contents, [{'title': 'Économie'}, {'title': 'Société'}])
+
+    def test_numbers_split_across_chunks(self):
+        self.assert_chunked(utils_swift.iter_json_records, b'[1, 23, 456]', [1, 23, 456])
+        self.assert_chunked(utils_swift.iter_json_records, b'12\n345\n6789', [12, 345, 6789])
+        self.assert_chunked(utils_swift.iter_json_records, b'3.25', [3.25])
+
+    def test_truncated_json(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(utils_swift.iter_json_records([b'[{"id": "123', b'456789"']))